@@ -0,0 +1,160 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import FileResponse
+from pyramid.view import view_config
+from armonaut.utils import compression
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dist')
+MANIFEST = 'manifest.json'
+
+# Precompressed variants are written next to each asset with
+# these extensions at the highest level each codec offers.
+EXTENSIONS = {'gzip': '.gz', 'br': '.br', 'zstd': '.zst'}
+LEVELS = {'gzip': 9, 'br': 11, 'zstd': 19}
+
+# Built assets have the hash of their content in their name
+# so they can be cached for as long as browsers allow.
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _hashed_name(name, data):
+    root, ext = os.path.splitext(name)
+    digest = hashlib.blake2b(data, digest_size=8).hexdigest()
+    return f'{root}.{digest}{ext}'
+
+
+def _write(output, name, data):
+    path = os.path.join(output, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build(source: str=STATIC_DIR, output: str=BUILD_DIR) -> dict:
+    """Copies every file in ``source`` to ``output`` under a name with
+    its content hash, writes precompressed variants of each and a
+    manifest mapping the original names to the hashed names.
+    """
+    manifest = {}
+    for directory, _, filenames in os.walk(source):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, source).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            hashed_name = manifest[name] = _hashed_name(name, data)
+            _write(output, hashed_name, data)
+
+            # Variants that aren't smaller than the original aren't worth serving.
+            for encoding, ext in EXTENSIONS.items():
+                if encoding not in compression.CODECS:
+                    continue
+                compressed = compression.compress(data, encoding, LEVELS[encoding])
+                if len(compressed) < len(data):
+                    _write(output, hashed_name + ext, compressed)
+
+    _write(output, MANIFEST, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+class StaticAssets:
+    """The assets from the last build along with which precompressed
+    variants of each exist, loaded once so serving doesn't touch the
+    filesystem until the file itself is sent.
+    """
+    def __init__(self, source: str=STATIC_DIR, output: str=BUILD_DIR):
+        self.source = source
+        self.output = output
+
+        try:
+            with open(os.path.join(output, MANIFEST), 'rb') as f:
+                self.manifest = json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            self.manifest = {}
+
+        self.encodings = {}
+        for hashed_name in self.manifest.values():
+            path = os.path.join(output, *hashed_name.split('/'))
+            self.encodings[hashed_name] = [
+                encoding for encoding in compression.ENCODINGS
+                if encoding == 'identity' or os.path.exists(path + EXTENSIONS[encoding])
+            ]
+
+    def url_path(self, name: str) -> str:
+        # Without a build assets are served from the source directory.
+        return self.manifest.get(name, name)
+
+
+def asset_url(request, name):
+    assets = request.registry['static.assets']
+    return request.route_url('static', subpath=assets.url_path(name))
+
+
+@view_config(route_name='static')
+def static_view(request):
+    assets = request.registry['static.assets']
+    subpath = request.matchdict['subpath']
+    if not subpath or any(part in ('', '.', '..') for part in subpath):
+        raise HTTPNotFound()
+
+    name = '/'.join(subpath)
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    encodings = assets.encodings.get(name)
+    if encodings is None:
+        path = os.path.join(assets.source, *subpath)
+        if not os.path.isfile(path):
+            raise HTTPNotFound()
+        return FileResponse(path, request=request, content_type=content_type)
+
+    # Pick the precompressed variant the client prefers so
+    # no time is spent compressing assets per request.
+    encoding = request.accept_encoding.best_match(encodings, default_match='identity')
+    path = os.path.join(assets.output, *subpath)
+    if encoding != 'identity':
+        path += EXTENSIONS[encoding]
+
+    response = FileResponse(
+        path,
+        request=request,
+        content_type=content_type,
+        content_encoding=None if encoding == 'identity' else encoding
+    )
+    response.vary = ('Accept-Encoding',)
+    response.cache_control = CACHE_CONTROL
+    return response
+
+
+def includeme(config):
+    settings = config.registry.settings
+
+    config.registry['static.assets'] = StaticAssets(
+        source=settings.get('static.source', STATIC_DIR),
+        output=settings.get('static.output', BUILD_DIR)
+    )
+    config.add_request_method(asset_url, 'asset_url')
+
+
+if __name__ == '__main__':
+    manifest = build(*sys.argv[1:3])
+    print(f'Built {len(manifest)} static assets')
@@ -11,3 +11,47 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+import time
+import typing
+from collections.abc import Sequence
+from pyramid.response import Response
+
+__all__ = ['dump_response', 'load_response']
+
+# Headers that belong to one response and aren't stored with it.
+UNCACHED_HEADERS = frozenset({'set-cookie', 'age', 'x-cache', 'date'})
+
+
+def dump_response(response, max_bytes: int,
+                  exclude: typing.AbstractSet[str]=frozenset()) -> typing.Optional[dict]:
+    """Returns the status, headers and body of a response as a dict that
+    can be serialized or ``None`` if the body is larger than ``max_bytes``.
+    Streaming responses are only buffered if their length is known.
+    """
+    if (not isinstance(response.app_iter, Sequence) and
+            (response.content_length is None or response.content_length > max_bytes)):
+        return None
+    body = response.body
+    if len(body) > max_bytes:
+        return None
+
+    return {
+        'status': response.status,
+        'headers': [[name, value] for name, value in response.headerlist
+                    if name.lower() not in UNCACHED_HEADERS and name.lower() not in exclude],
+        'body': body
+    }
+
+
+def load_response(data: dict, stored: float) -> Response:
+    """Rebuilds a response from :func:`dump_response` that was stored at
+    the ``stored`` timestamp.
+    """
+    response = Response(
+        status=data['status'],
+        headerlist=[tuple(header) for header in data['headers']],
+        app_iter=[data['body']]
+    )
+    response.headers['Age'] = str(max(int(time.time() - stored), 0))
+    return response
@@ -0,0 +1,145 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import threading
+import typing
+import redis
+from armonaut.utils import connections
+
+__all__ = ['CompressedResponseCache']
+
+
+class CompressedResponseCache:
+    """Remembers the compressed body and ETag of responses so that the
+    same content is only compressed once per encoding.
+
+    Entries are evicted least recently used first once the bodies add up
+    to more than ``max_bytes``. If ``url`` is given entries are also kept
+    in redis for ``ttl`` seconds and shared between processes.
+    """
+    def __init__(self, max_bytes: int=32 * 1024 * 1024, url: str=None, ttl: int=3600,
+                 max_entry_bytes: int=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.redis = None
+        if url is not None:
+            self.redis = redis.StrictRedis(connection_pool=connections.get_connection_pool(url))
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _redis_key(key, encoding):
+        return f'armonaut/compressed/{encoding}/{key}'
+
+    def get(self, key: str, encoding: str) -> typing.Optional[typing.Tuple[bytes, str]]:
+        with self._lock:
+            entry = self._entries.get((key, encoding))
+            if entry is not None:
+                self._entries.move_to_end((key, encoding))
+                self.hits += 1
+                return entry
+
+        if self.redis is not None:
+            try:
+                data = self.redis.get(self._redis_key(key, encoding))
+            except (redis.ConnectionError, redis.TimeoutError):
+                data = None
+            if data is not None:
+                etag, _, body = data.partition(b'\n')
+                entry = (body, etag.decode('utf-8'))
+                self._store(key, encoding, entry)
+                with self._lock:
+                    self.redis_hits += 1
+                return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, encoding: str, body: bytes, etag: str):
+        if len(body) > self.max_entry_bytes:
+            return
+
+        self._store(key, encoding, (body, etag))
+        if self.redis is not None:
+            try:
+                self.redis.setex(self._redis_key(key, encoding), self.ttl,
+                                 etag.encode('utf-8') + b'\n' + body)
+            except (redis.ConnectionError, redis.TimeoutError):
+                pass
+
+    def _store(self, key, encoding, entry):
+        with self._lock:
+            previous = self._entries.pop((key, encoding), None)
+            if previous is not None:
+                self.bytes -= len(previous[0])
+
+            self._entries[(key, encoding)] = entry
+            self.bytes += len(entry[0])
+            while self.bytes > self.max_bytes:
+                _, (body, _) = self._entries.popitem(last=False)
+                self.bytes -= len(body)
+                self.evictions += 1
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            requests = self.hits + self.redis_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.redis_hits) / requests if requests else 0.0
+            }
+
+    @staticmethod
+    def key(request, response) -> typing.Optional[str]:
+        """The key for a response that can be cached or ``None``.
+
+        ETags only identify content for one URL so they're combined
+        with the path, otherwise the body itself is hashed. Version ETags
+        are the same for every variant of a URL so the request headers
+        the response varies on are part of the key too.
+        """
+        if request.method not in {'GET', 'HEAD'} or response.status_code != 200:
+            return None
+        cache_control = response.cache_control
+        if cache_control.no_store or cache_control.private:
+            return None
+
+        digest = hashlib.blake2b(digest_size=16)
+        etag = response.headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            vary = sorted({name.lower() for name in response.vary or ()} - {'accept-encoding'})
+            if '*' in vary:
+                return None
+            digest.update('\n'.join([
+                request.path_qs, etag,
+                *[f'{name}: {request.headers.get(name, "")}' for name in vary]
+            ]).encode('utf-8'))
+            return 'etag-' + digest.hexdigest()
+
+        digest.update(response.body)
+        return 'body-' + digest.hexdigest()
@@ -0,0 +1,92 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import hashlib
+from collections.abc import Sequence
+
+__all__ = ['ETagHasher', 'body_etag', 'version_etag', 'set_body_etag', 'set_encoded_etag']
+
+
+def _encode(digest: bytes) -> str:
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+
+class ETagHasher:
+    """Builds an ETag from a body a chunk at a time."""
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=16)
+
+    def update(self, chunk: bytes):
+        self._hash.update(chunk)
+
+    def etag(self) -> str:
+        return _encode(self._hash.digest())
+
+
+def body_etag(body: bytes) -> str:
+    hasher = ETagHasher()
+    hasher.update(body)
+    return hasher.etag()
+
+
+def version_etag(*parts) -> str:
+    """Builds an ETag from whatever identifies the version of a resource,
+    for example its id and when it was last updated. Views set it with
+    ``request.response.etag = version_etag(...)`` so the body is never
+    hashed to make one.
+    """
+    return _encode(hashlib.blake2b(
+        '\x1f'.join(str(part) for part in parts).encode('utf-8'), digest_size=16
+    ).digest())
+
+
+def set_body_etag(response):
+    """Sets the ETag of a response from its body. Streaming responses are
+    hashed as their chunks are read and are left buffered as those chunks.
+    """
+    hasher = ETagHasher()
+    app_iter = response.app_iter
+
+    if isinstance(app_iter, Sequence):
+        for chunk in app_iter:
+            hasher.update(chunk)
+    else:
+        chunks = []
+        try:
+            for chunk in app_iter:
+                hasher.update(chunk)
+                chunks.append(chunk)
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                close()
+
+        # Setting the app_iter forgets the Content-Length which is still right.
+        content_length = response.content_length
+        response.app_iter = chunks
+        response.content_length = content_length
+
+    response.etag = hasher.etag()
+
+
+def set_encoded_etag(response, encoding: str):
+    """Derives the ETag of an encoded response from the ETag of its
+    identity encoding without hashing anything again.
+    """
+    etag = response.etag
+    if etag is None:
+        return
+    weak = response.headers['ETag'].startswith('W/')
+    response.etag = (f'{etag}-{encoding}', not weak)
@@ -0,0 +1,298 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import functools
+import hashlib
+import os
+import threading
+import time
+import typing
+import redis
+from pyramid.exceptions import ConfigurationError
+from pyramid.response import Response
+from armonaut.cache import dump_response, load_response
+from armonaut.utils import connections, serialization
+
+__all__ = ['SingleFlight']
+
+SHARED, STALE = 'SHARED', 'STALE'
+
+
+class _Flight:
+    # A response being computed for a key. The result is left as None
+    # if the response couldn't be shared with the requests waiting on it.
+    __slots__ = ['done', 'result']
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """Lets only one request per key compute a response at a time.
+
+    Threads in this process are coalesced with a lock per key and other
+    processes with a lock in redis if ``url`` is given. The last response
+    for a key is kept for ``stale_ttl`` seconds and is served to requests
+    that arrive while it's being computed again. Requests without a copy
+    to serve wait up to ``wait_timeout`` seconds for the response before
+    computing it themselves, as they all do at once if the response
+    can't be shared.
+    """
+    def __init__(self, url: str=None, lock_timeout: float=30.0,
+                 wait_timeout: float=10.0, stale_ttl: int=300,
+                 max_entries: int=256, max_entry_bytes: int=1024 * 1024,
+                 poll_interval: float=0.05, serializer=None):
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_entry_bytes = max_entry_bytes
+        self.poll_interval = poll_interval
+        self.serializer = serializer or serialization.MsgpackSerializer()
+        self.redis = None
+        if url is not None:
+            self.redis = redis.StrictRedis(connection_pool=connections.get_connection_pool(url))
+
+        self._flights = {}
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.computed = 0
+        self.shared = 0
+        self.stale = 0
+
+    @staticmethod
+    def _lock_key(key):
+        return f'armonaut/flight/lock/{key}'
+
+    @staticmethod
+    def _result_key(key):
+        return f'armonaut/flight/result/{key}'
+
+    def _join(self, key) -> typing.Tuple[_Flight, bool]:
+        """Returns the flight for a key and whether we lead it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def _get(self, key) -> typing.Optional[dict]:
+        now = time.time()
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                if result['until'] > now:
+                    self._results.move_to_end(key)
+                    return result
+                del self._results[key]
+
+        if self.redis is None:
+            return None
+        try:
+            data = self.redis.get(self._result_key(key))
+        except (redis.ConnectionError, redis.TimeoutError):
+            return None
+        if data is None:
+            return None
+        result = self.serializer.loads(data)
+        self._put(key, result)
+        return result
+
+    def _put(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def _set(self, key, response) -> typing.Optional[dict]:
+        # Only complete and impersonal responses are shared.
+        if response.status_code != 200 or 'Set-Cookie' in response.headers:
+            return None
+        result = dump_response(response, self.max_entry_bytes)
+        if result is None:
+            return None
+
+        now = time.time()
+        result.update(finished=now, until=now + self.stale_ttl)
+        self._put(key, result)
+        if self.redis is not None:
+            try:
+                self.redis.setex(self._result_key(key), max(int(self.stale_ttl), 1),
+                                 self.serializer.dumps(result))
+            except (redis.ConnectionError, redis.TimeoutError):
+                pass
+        return result
+
+    def _acquire(self, key) -> typing.Optional[bytes]:
+        """Takes the redis lock for a key returning its token, ``None``
+        if there's no redis to coalesce with or ``b''`` if another
+        process holds the lock.
+        """
+        if self.redis is None:
+            return None
+        token = os.urandom(16)
+        try:
+            if self.redis.set(self._lock_key(key), token, nx=True,
+                              px=int(self.lock_timeout * 1000)):
+                return token
+        except (redis.ConnectionError, redis.TimeoutError):
+            return None
+        return b''
+
+    def _release(self, key, token):
+        # The lock is only deleted if it's still ours, it may have
+        # expired and been taken by another process since.
+        lock_key = self._lock_key(key)
+        try:
+            with self.redis.pipeline() as pipeline:
+                pipeline.watch(lock_key)
+                if pipeline.get(lock_key) == token:
+                    pipeline.multi()
+                    pipeline.delete(lock_key)
+                    pipeline.execute()
+        except (redis.ConnectionError, redis.TimeoutError, redis.WatchError):
+            pass
+
+    def _wait(self, key, started) -> typing.Optional[dict]:
+        # Polls redis for the result of another process until it
+        # releases the lock or we've waited long enough.
+        deadline = started + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            result = self._get(key)
+            if result is not None and result['finished'] >= started:
+                return result
+            try:
+                if not self.redis.exists(self._lock_key(key)):
+                    return self._get(key)
+            except (redis.ConnectionError, redis.TimeoutError):
+                return None
+        return None
+
+    def run(self, key: str, compute: typing.Callable[[], Response]) -> Response:
+        """Returns the response for a key calling ``compute`` only if no
+        other request is already computing it.
+        """
+        started = time.time()
+        flight, leader = self._join(key)
+
+        if not leader:
+            result = self._get(key)
+            if result is not None:
+                return self._response(result, STALE)
+            if flight.done.wait(self.wait_timeout) and flight.result is not None:
+                return self._response(flight.result, SHARED)
+            return self._compute(key, compute)
+
+        try:
+            token = self._acquire(key)
+            if token == b'':
+                result = self._get(key)
+                if result is not None:
+                    return self._response(result, STALE)
+                result = self._wait(key, started)
+                if result is not None:
+                    flight.result = result
+                    return self._response(result, SHARED)
+
+            try:
+                return self._compute(key, compute, flight)
+            finally:
+                if token:
+                    self._release(key, token)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _compute(self, key, compute, flight=None):
+        response = compute()
+        result = self._set(key, response)
+        if flight is not None:
+            flight.result = result
+        with self._lock:
+            self.computed += 1
+        return response
+
+    def _response(self, result, state):
+        with self._lock:
+            if state == STALE:
+                self.stale += 1
+            else:
+                self.shared += 1
+        return load_response(result, result['finished'])
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {
+                'entries': len(self._results),
+                'computed': self.computed,
+                'shared': self.shared,
+                'stale': self.stale
+            }
+
+
+def single_flight_view(view, info):
+    """Coalesces concurrent calls of a view declared with ``single_flight``.
+
+    The option is either ``True`` to coalesce requests for the same URL or
+    a callable given the context and request that returns the key to
+    coalesce on. Only views that return the same response to every user
+    should be coalesced so views using sessions can't be.
+    """
+    key_func = info.options.get('single_flight')
+    if not key_func or info.exception_only:
+        return view
+
+    # The response would carry one user's CSRF token or flash messages to others.
+    if info.options.get('uses_session'):
+        raise ConfigurationError(
+            f'{info.original_view!r} uses sessions and cannot use single_flight'
+        )
+
+    name = f'{info.original_view.__module__}.{getattr(info.original_view, "__qualname__", "")}'
+
+    @functools.wraps(view)
+    def wrapped(context, request):
+        if request.method not in {'GET', 'HEAD'}:
+            return view(context, request)
+        if key_func is True:
+            key = f'{request.host}{request.path_qs}'
+        else:
+            key = key_func(context, request)
+            if key is None:
+                return view(context, request)
+
+        key = hashlib.blake2b(f'{name}\n{key}'.encode('utf-8'), digest_size=16).hexdigest()
+        flight = request.registry['cache.flight']
+        return flight.run(key, lambda: view(context, request))
+
+    return wrapped
+
+
+single_flight_view.options = {'single_flight'}
+
+
+def includeme(config):
+    settings = config.registry.settings
+    config.registry['cache.flight'] = SingleFlight(
+        url=settings.get('single_flight.url'),
+        wait_timeout=settings.get('single_flight.wait_timeout', 10.0),
+        stale_ttl=settings.get('single_flight.stale_ttl', 300)
+    )
+    config.add_view_deriver(single_flight_view)
@@ -13,63 +13,185 @@
 # limitations under the License.
 
 import collections.abc
+import datetime
 import functools
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.tweens import EXCVIEW
+from armonaut.cache import etag
+from armonaut.cache.compressed import CompressedResponseCache
+from armonaut.utils import compression
+from armonaut.utils.compression import ENCODINGS
 
-__all__ = ['add_vary']
+__all__ = ['add_vary', 'ResponseFinaliser']
 
 BUFFER_MAX = 1024 * 1024
 
 
-def add_vary_callback(*varies):
-    def wrapped(request, response):
-        vary = set(response.vary if response.vary is not None else [])
-        vary |= set(varies)
-        response.vary = vary
-    return wrapped
-
-
 def add_vary(*varies):
+    varies = frozenset(varies)
+
     def wrapper(view):
         @functools.wraps(view)
         def wrapped(context, request):
-            request.add_response_callback(add_vary_callback(*varies))
+            # The headers are only recorded here and are added to
+            # the response when it's finalised.
+            vary = getattr(request, 'response_vary', None)
+            request.response_vary = varies if vary is None else vary | varies
             return view(context, request)
         return wrapped
     return wrapper
 
 
-def conditional_http_tween_factory(handler, registry):
-    def conditional_http_tween(request):
-        response = handler(request)
+def _matching_etag(request, tag):
+    # The client may have been sent any of the encoded variants of the
+    # ETag so those all match the ETag of the identity response.
+    for candidate in [tag] + [f'{tag}-{encoding}' for encoding in ENCODINGS[1:]]:
+        if candidate in request.if_none_match:
+            return candidate
+    return None
+
+
+def conditional_view(view, info):
+    """Lets a view declare a cheap ``validator`` that is checked before the
+    view is called so conditional requests get a 304 without rendering.
+
+    The validator is called with the context and request and returns the
+    version of the resource, either a token that the ETag is built from or
+    the :class:`datetime.datetime` it was last modified, or ``None``.
+    """
+    validator = info.options.get('validator')
+    if validator is None:
+        return view
+
+    @functools.wraps(view)
+    def wrapped(context, request):
+        version = validator(context, request)
+
+        tag = last_modified = None
+        if isinstance(version, datetime.datetime):
+            if version.tzinfo is None:
+                version = version.replace(tzinfo=datetime.timezone.utc)
+            # HTTP dates don't have fractions of a second.
+            last_modified = version.replace(microsecond=0)
+        elif version is not None:
+            tag = etag.version_etag(version)
+
+        if request.method in {'GET', 'HEAD'}:
+            # If-Modified-Since is only used when there's no If-None-Match.
+            matched = None
+            if 'If-None-Match' in request.headers:
+                matched = tag is not None and _matching_etag(request, tag)
+            elif last_modified is not None and request.if_modified_since is not None:
+                matched = last_modified <= request.if_modified_since
+
+            if matched:
+                response = HTTPNotModified()
+                if tag is not None:
+                    response.etag = matched
+                if last_modified is not None:
+                    response.last_modified = last_modified
+                return response
+
+        response = view(context, request)
+        if tag is not None and response.etag is None:
+            response.etag = tag
+        if last_modified is not None and response.last_modified is None:
+            response.last_modified = last_modified
+        response.conditional_response = True
+        return response
 
-        # If the Last-Modified header has been set enable
-        # conditional response handling.
-        if response.last_modified is not None:
-            response.conditional_response = True
+    return wrapped
+
+
+conditional_view.options = {'validator'}
+
+
+class ResponseFinaliser:
+    """Adds the Vary headers recorded by :func:`add_vary`, the ETag and
+    the compression to a response in a single response callback so the
+    headers are only read once and written once.
+    """
+    def __init__(self, policy: compression.CompressionPolicy=None,
+                 cache: CompressedResponseCache=None):
+        self.policy = policy or compression.DEFAULT_POLICY
+        self.cache = cache
+
+    def __call__(self, request, response):
+        vary = []
+        validated = encoded = False
+        for name, value in response.headerlist:
+            name = name.lower()
+            if name == 'vary':
+                vary.extend(token.strip() for token in value.split(',') if token.strip())
+            elif name in {'etag', 'last-modified'}:
+                validated = True
+            elif name == 'content-encoding':
+                encoded = True
+
+        varied = False
+        for token in getattr(request, 'response_vary', ()):
+            if token not in vary:
+                vary.append(token)
+                varied = True
 
         # Only enable conditional response handling for ETag if
-        # we're given an ETag or we have a buffered response and
+        # we're given a validator or we have a buffered response and
         # can generate the ETag header ourselves.
-        if response.etag is not None:
+        if validated:
             response.conditional_response = True
 
         elif response.status_code == 200 and request.method in {'GET', 'HEAD'}:
-            # If we're streaming a response and it's small enough we
-            # can buffer it in memory and generate an ETag.
+            # If we're not streaming or the response is small enough to
+            # buffer in memory we can generate an ETag as we read it.
             streaming = not isinstance(response.app_iter, collections.abc.Sequence)
-            if (streaming and response.content_length is not None and
-                    response.content_length <= BUFFER_MAX):
-                _ = response.body  # noqa
-                streaming = False
-
-            # If we're not streaming the response still we can generate an ETag.
-            if not streaming:
+            if not streaming or (response.content_length is not None and
+                                 response.content_length <= BUFFER_MAX):
                 response.conditional_response = True
-                response.md5_etag()
+                etag.set_body_etag(response)
+
+        compress = compression._compressible(request, response, vary, encoded, self.policy)
+        if compress and 'Accept-Encoding' not in vary:
+            vary.append('Accept-Encoding')
+            varied = True
+
+        if varied:
+            response.headers['Vary'] = ', '.join(vary)
+        if compress:
+            compression._encode(request, response, self.policy, self.cache)
+
+
+def response_finaliser_tween_factory(handler, registry):
+    settings = registry.settings
+
+    cache = None
+    if settings.get('compression.cache_bytes'):
+        cache = CompressedResponseCache(
+            max_bytes=settings['compression.cache_bytes'],
+            url=settings.get('compression.cache_url')
+        )
+    registry['compression.cache'] = cache
+
+    finaliser = ResponseFinaliser(
+        policy=compression.CompressionPolicy.from_settings(settings),
+        cache=cache
+    )
+
+    def response_finaliser_tween(request):
+        response = handler(request)
 
+        # We use a response callback so the response is finalised last
+        # after all of the other callbacks and tweens are called.
+        request.add_response_callback(finaliser)
         return response
-    return conditional_http_tween
+    return response_finaliser_tween
 
 
 def includeme(config):
-    config.add_tween('armonaut.cache.http.conditional_http_tween_factory')
+    config.add_tween(
+        'armonaut.cache.http.response_finaliser_tween_factory',
+        over=[
+            'pyramid_debugtoolbar.toolbar_tween_factory',
+            EXCVIEW
+        ]
+    )
+    config.add_view_deriver(conditional_view)
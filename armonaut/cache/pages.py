@@ -0,0 +1,336 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import threading
+import time
+import typing
+import redis
+from pyramid.response import Response
+from pyramid.tweens import EXCVIEW
+from armonaut.cache import dump_response, load_response
+from armonaut.utils import connections, serialization
+
+__all__ = ['PageCache']
+
+# Responses that vary on these are personal and never cached.
+PRIVATE_VARY = {'cookie', 'authorization', '*'}
+
+FRESH, STALE = 'HIT', 'STALE'
+
+
+def _hash(*parts) -> str:
+    return hashlib.blake2b('\n'.join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class PageCache:
+    """Stores whole responses to GET and HEAD requests.
+
+    Pages are looked up in two steps, first the headers the response for
+    a URL varies on are found and then the page is found by the URL and
+    the values of those request headers. Pages are kept in an LRU of at
+    most ``max_bytes`` and in redis if ``url`` is given. Pages are then
+    only kept locally for ``local_ttl`` seconds, whether they were read
+    from redis or stored by this process, so purges made by other
+    processes are seen quickly.
+    """
+    def __init__(self, max_bytes: int=32 * 1024 * 1024, url: str=None,
+                 local_ttl: int=5, max_entry_bytes: int=1024 * 1024,
+                 coalesce_timeout: float=5.0, serializer=None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.local_ttl = local_ttl
+        self.coalesce_timeout = coalesce_timeout
+        self.serializer = serializer or serialization.MsgpackSerializer()
+        self.redis = None
+        if url is not None:
+            self.redis = redis.StrictRedis(connection_pool=connections.get_connection_pool(url))
+
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def _redis_key(key):
+        return f'armonaut/pages/{key}'
+
+    @staticmethod
+    def _tag_key(tag):
+        return f'armonaut/pages/tag/{tag}'
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                value, expires, _, _ = item
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    return value
+                self._pop(key)
+
+        if self.redis is None:
+            return None
+        try:
+            data = self.redis.get(self._redis_key(key))
+        except (redis.ConnectionError, redis.TimeoutError):
+            return None
+        if data is None:
+            return None
+
+        value = self.serializer.loads(data)
+        self._put(key, value, min(now + self.local_ttl, value['until']), len(data), ())
+        return value
+
+    def _set(self, key, value, tags=()):
+        data = self.serializer.dumps(value)
+        now = time.time()
+        ttl = max(int(value['until'] - now), 1)
+
+        expires = value['until']
+        if self.redis is not None:
+            expires = min(now + self.local_ttl, expires)
+        self._put(key, value, expires, len(data), tags)
+        if self.redis is not None:
+            try:
+                pipeline = self.redis.pipeline()
+                pipeline.setex(self._redis_key(key), ttl, data)
+                for tag in tags:
+                    pipeline.sadd(self._tag_key(tag), key)
+                    pipeline.expire(self._tag_key(tag), ttl)
+                pipeline.execute()
+            except (redis.ConnectionError, redis.TimeoutError):
+                pass
+
+    def _put(self, key, value, expires, size, tags):
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, expires, size, frozenset(tags))
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self.bytes -= item[2]
+
+    @staticmethod
+    def _url_key(request):
+        # Pages link to absolute URLs so the scheme is part of the key.
+        return 'vary/' + _hash(request.scheme, request.host, request.path_qs)
+
+    @staticmethod
+    def _page_key(request, vary):
+        return 'page/' + _hash(
+            request.scheme, request.host, request.path_qs,
+            *[f'{name}: {request.headers.get(name, "")}' for name in vary]
+        )
+
+    def lookup(self, request) -> typing.Tuple[typing.Optional[str], typing.Optional[dict], str]:
+        """Finds the page for a request returning whether the page is
+        fresh or stale, the page and the key used to coalesce misses.
+        """
+        entry = self._get(self._url_key(request))
+        if entry is None:
+            self.misses += 1
+            return None, None, self._url_key(request)
+
+        key = self._page_key(request, entry['vary'])
+        page = self._get(key)
+        now = time.time()
+        if page is not None and page['expires'] > now:
+            self.hits += 1
+            return FRESH, page, key
+        if page is not None and page['until'] > now:
+            self.stale_hits += 1
+            return STALE, page, key
+
+        self.misses += 1
+        return None, None, key
+
+    def store(self, request, response):
+        """Stores a response if its ``Cache-Control`` allows it to be
+        kept in a shared cache for a while.
+        """
+        if request.method not in {'GET', 'HEAD'} or response.status_code != 200:
+            return
+        if 'Set-Cookie' in response.headers:
+            return
+
+        # Vary headers recorded with add_vary aren't on the response until
+        # it's finalised after the page is stored.
+        vary = sorted(set(response.vary or ()) | getattr(request, 'response_vary', frozenset()))
+        if PRIVATE_VARY & {name.lower() for name in vary}:
+            return
+
+        cache_control = response.cache_control
+        if cache_control.private or cache_control.no_store or cache_control.no_cache:
+            return
+        if 'Authorization' in request.headers and not (cache_control.public or
+                                                       cache_control.s_maxage):
+            return
+
+        max_age = cache_control.s_maxage
+        if max_age is None and cache_control.max_age is not None and cache_control.max_age >= 0:
+            max_age = cache_control.max_age
+        if not max_age or int(max_age) <= 0:
+            return
+
+        page = dump_response(response, self.max_entry_bytes, exclude={'vary'})
+        if page is None:
+            return
+
+        now = time.time()
+        expires = now + int(max_age)
+        page.update(
+            stored=now,
+            expires=expires,
+            until=expires + int(cache_control.stale_while_revalidate or 0)
+        )
+        if vary:
+            page['headers'].append(['Vary', ', '.join(vary)])
+        tags = response.headers.get('Surrogate-Key', '').split()
+
+        self._set(self._url_key(request), {'vary': vary, 'until': page['until']})
+        self._set(self._page_key(request, vary), page, tags)
+        self.stores += 1
+
+    def purge(self, *tags: str):
+        """Removes every page that was stored with any of the tags."""
+        tags = set(tags)
+        with self._lock:
+            for key in [key for key, item in self._entries.items() if item[3] & tags]:
+                self._pop(key)
+
+        if self.redis is not None:
+            try:
+                keys = set()
+                for tag in tags:
+                    keys.update(key.decode('utf-8')
+                                for key in self.redis.smembers(self._tag_key(tag)))
+                pipeline = self.redis.pipeline()
+                if keys:
+                    pipeline.delete(*[self._redis_key(key) for key in keys])
+                pipeline.delete(*[self._tag_key(tag) for tag in tags])
+                pipeline.execute()
+            except (redis.ConnectionError, redis.TimeoutError):
+                pass
+
+    def acquire(self, key: str) -> bool:
+        """Claims the right to render the page for a key. Only one request
+        in the process renders a missing or stale page at a time.
+        """
+        with self._lock:
+            if key in self._inflight:
+                return False
+            self._inflight[key] = threading.Event()
+            return True
+
+    def wait(self, key: str):
+        with self._lock:
+            event = self._inflight.get(key)
+        if event is not None:
+            event.wait(self.coalesce_timeout)
+
+    def release(self, key: str):
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    @staticmethod
+    def response(page: dict, state: str) -> Response:
+        response = load_response(page, page['stored'])
+        response.headers['X-Cache'] = state
+        response.conditional_response = True
+        return response
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0
+            }
+
+
+def page_cache_tween_factory(handler, registry):
+    cache = registry['cache.pages']
+
+    def page_cache_tween(request):
+        if request.method not in {'GET', 'HEAD'}:
+            return handler(request)
+
+        state, page, key = cache.lookup(request)
+        if state == FRESH:
+            return cache.response(page, state)
+
+        leader = cache.acquire(key)
+        if not leader:
+            # A stale page is served while another request renders it again.
+            if state == STALE:
+                return cache.response(page, state)
+
+            # Concurrent misses wait for that request to render the page.
+            cache.wait(key)
+            state, page, key = cache.lookup(request)
+            if state is not None:
+                return cache.response(page, state)
+            leader = cache.acquire(key)
+
+        # The page is stored from a response callback so it includes the Vary
+        # headers added by the view's callbacks. Waiting requests are released
+        # when the request finishes even if nothing was stored.
+        if leader:
+            request.add_finished_callback(lambda request: cache.release(key))
+        response = handler(request)
+        request.add_response_callback(cache.store)
+        return response
+
+    return page_cache_tween
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if not settings.get('page_cache.max_bytes'):
+        return
+
+    config.registry['cache.pages'] = PageCache(
+        max_bytes=settings['page_cache.max_bytes'],
+        url=settings.get('page_cache.url')
+    )
+    config.add_request_method(
+        lambda request, *tags: request.registry['cache.pages'].purge(*tags),
+        'purge_pages'
+    )
+
+    # Pages are stored before they're compressed and
+    # served without starting a transaction.
+    config.add_tween(
+        'armonaut.cache.pages.page_cache_tween_factory',
+        under='armonaut.cache.http.response_finaliser_tween_factory',
+        over=('pyramid_tm.tm_tween_factory', EXCVIEW)
+    )
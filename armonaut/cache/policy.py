@@ -0,0 +1,225 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import functools
+import logging
+import typing
+import urllib.error
+import urllib.request
+from pyramid.tweens import EXCVIEW
+
+__all__ = ['CachePolicy', 'LocalPurger', 'FastlyPurger']
+
+logger = logging.getLogger(__name__)
+
+# Statuses a shared cache may keep without being told how long to.
+CACHEABLE_STATUSES = {200, 203, 300, 301, 404, 410}
+
+# Responses that vary on these are personal and only cached by the browser.
+PRIVATE_VARY = {'cookie', 'authorization', '*'}
+
+
+class CachePolicy:
+    """How long the responses of a view may be cached for.
+
+    ``max_age`` is for browsers and ``s_maxage`` for shared caches and the
+    CDN which fall back to ``max_age`` if it isn't given. Stale responses
+    may be served for ``stale_while_revalidate`` seconds while they're
+    fetched again. ``surrogate_keys`` are formatted with the matchdict of
+    the request or may be a callable given the context and request.
+    """
+    def __init__(self, max_age: int=None, s_maxage: int=None,
+                 stale_while_revalidate: int=None,
+                 surrogate_keys: typing.Union[typing.Iterable[str], typing.Callable]=()):
+        self.max_age = max_age
+        self.s_maxage = s_maxage
+        self.stale_while_revalidate = stale_while_revalidate
+        if callable(surrogate_keys):
+            self.surrogate_keys = surrogate_keys
+        else:
+            self.surrogate_keys = tuple(surrogate_keys)
+
+    def keys(self, context, request) -> typing.List[str]:
+        if callable(self.surrogate_keys):
+            return list(self.surrogate_keys(context, request))
+        matchdict = request.matchdict or {}
+        return [key.format(**matchdict) for key in self.surrogate_keys]
+
+    def apply(self, context, request, response):
+        if request.method not in {'GET', 'HEAD'}:
+            return
+        if response.status_code not in CACHEABLE_STATUSES:
+            return
+
+        # Views that set these themselves know better.
+        cache_control = response.cache_control
+        if cache_control.no_store or cache_control.private or cache_control.no_cache:
+            return
+
+        vary = set(response.vary or ()) | set(getattr(request, 'response_vary', ()))
+        personal = ('Set-Cookie' in response.headers or
+                    PRIVATE_VARY & {name.lower() for name in vary})
+        if personal:
+            if self.max_age is not None:
+                cache_control.private = True
+                cache_control.max_age = self.max_age
+            return
+
+        cache_control.public = True
+        if self.max_age is not None:
+            cache_control.max_age = self.max_age
+        if self.s_maxage is not None:
+            cache_control.s_maxage = self.s_maxage
+        if self.stale_while_revalidate is not None:
+            cache_control.stale_while_revalidate = self.stale_while_revalidate
+
+        shared_max_age = self.s_maxage if self.s_maxage is not None else self.max_age
+        if shared_max_age is not None:
+            surrogate_control = [f'max-age={shared_max_age}']
+            if self.stale_while_revalidate is not None:
+                surrogate_control.append(
+                    f'stale-while-revalidate={self.stale_while_revalidate}'
+                )
+            response.headers['Surrogate-Control'] = ', '.join(surrogate_control)
+
+        keys = response.headers.get('Surrogate-Key', '').split()
+        for key in self.keys(context, request):
+            if key not in keys:
+                keys.append(key)
+        if keys:
+            response.headers['Surrogate-Key'] = ' '.join(keys)
+
+
+class LocalPurger:
+    """Remembers the last ``max_keys`` keys it's asked to purge instead
+    of purging a CDN.
+    """
+    def __init__(self, max_keys: int=1000):
+        self.purged = collections.deque(maxlen=max_keys)
+
+    def purge(self, keys: typing.Iterable[str]):
+        self.purged.extend(keys)
+
+
+class FastlyPurger:
+    """Purges surrogate keys from a Fastly service."""
+    api_url = 'https://api.fastly.com'
+
+    # Fastly purges at most this many keys per request.
+    batch_size = 256
+
+    def __init__(self, service_id: str, api_key: str, timeout: float=5.0):
+        self.service_id = service_id
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def purge(self, keys: typing.Iterable[str]):
+        keys = list(keys)
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            request = urllib.request.Request(
+                f'{self.api_url}/service/{self.service_id}/purge',
+                method='POST',
+                headers={
+                    'Accept': 'application/json',
+                    'Fastly-Key': self.api_key,
+                    'Surrogate-Key': ' '.join(batch)
+                }
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout):
+                    pass
+            except (urllib.error.URLError, OSError):
+                logger.warning('Unable to purge %d surrogate keys', len(batch), exc_info=True)
+
+
+PURGERS = {'local': LocalPurger, 'fastly': FastlyPurger}
+
+
+def cache_policy_view(view, info):
+    """Records the cache policy declared with the ``max_age``, ``s_maxage``,
+    ``stale_while_revalidate`` and ``surrogate_keys`` view options for
+    :func:`cache_policy_tween_factory` to apply to the response.
+    """
+    options = {name: info.options[name] for name in cache_policy_view.options
+               if info.options.get(name) is not None}
+    if not options or info.exception_only:
+        return view
+    policy = CachePolicy(**options)
+
+    @functools.wraps(view)
+    def wrapped(context, request):
+        request.cache_policy = policy
+        return view(context, request)
+
+    return wrapped
+
+
+cache_policy_view.options = {'max_age', 's_maxage', 'stale_while_revalidate', 'surrogate_keys'}
+
+
+def cache_policy_tween_factory(handler, registry):
+    def cache_policy_tween(request):
+        response = handler(request)
+        policy = getattr(request, 'cache_policy', None)
+        if policy is not None:
+            policy.apply(getattr(request, 'context', None), request, response)
+        return response
+    return cache_policy_tween
+
+
+def purge_cache(request, *keys: str):
+    """Purges the surrogate keys from the page cache and the CDN once
+    the transaction of the request has been committed.
+    """
+    def purge(success=True):
+        if not success:
+            return
+        pages = request.registry.get('cache.pages')
+        if pages is not None:
+            pages.purge(*keys)
+        request.registry['cache.purger'].purge(keys)
+
+    tm = getattr(request, 'tm', None)
+    if tm is None:
+        purge()
+    else:
+        tm.get().addAfterCommitHook(purge)
+
+
+def includeme(config):
+    settings = config.registry.settings
+
+    purger_cls = PURGERS[settings.get('cache.purger', 'local')]
+    purger_options = {}
+    if purger_cls is FastlyPurger:
+        purger_options = {
+            'service_id': settings['cache.fastly_service_id'],
+            'api_key': settings['cache.fastly_api_key']
+        }
+    config.registry['cache.purger'] = purger_cls(**purger_options)
+    config.add_request_method(purge_cache, 'purge_cache')
+
+    config.add_view_deriver(cache_policy_view)
+
+    # The headers are added before the page cache stores the response.
+    config.add_tween(
+        'armonaut.cache.policy.cache_policy_tween_factory',
+        under=(
+            'armonaut.cache.pages.page_cache_tween_factory',
+            'armonaut.cache.http.response_finaliser_tween_factory'
+        ),
+        over=('pyramid_tm.tm_tween_factory', EXCVIEW)
+    )
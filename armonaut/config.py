@@ -18,7 +18,6 @@ import typing
 import transaction
 from pyramid.config import Configurator as _Configurator
 from pyramid.security import Allow
-from pyramid.tweens import EXCVIEW
 
 
 class Environment(enum.Enum):
@@ -65,6 +64,14 @@ def maybe_set(settings: typing.Dict[str, typing.Any],
         settings.setdefault(name, default)
 
 
+def _as_bool(value: str) -> bool:
+    return value.lower() in {'1', 'true', 'yes', 'on'}
+
+
+def _as_list(value: str) -> typing.List[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
 def _tm_activate_hook(request) -> bool:
     # Don't activate our transaction manager on the debug toolbar
     # or on static resources
@@ -85,10 +92,70 @@ def configure(settings=None) -> Configurator:
 
     maybe_set(settings, 'sessions.url', 'REDIS_URL')
     maybe_set(settings, 'sessions.secret', 'ARMONAUT_SECRET')
+    maybe_set(settings, 'sessions.backend', 'SESSIONS_BACKEND', default='redis')
+    maybe_set(settings, 'sessions.cookie_max_size', 'SESSIONS_COOKIE_MAX_SIZE',
+              coercer=int, default=1024)
+    maybe_set(settings, 'sessions.cookie_encrypt', 'SESSIONS_COOKIE_ENCRYPT',
+              coercer=_as_bool, default=False)
+    maybe_set(settings, 'sessions.cache_size', 'SESSIONS_CACHE_SIZE', coercer=int, default=0)
+    maybe_set(settings, 'sessions.cache_ttl', 'SESSIONS_CACHE_TTL', coercer=int, default=30)
+    maybe_set(settings, 'sessions.storage', 'SESSIONS_STORAGE', default='string')
+    maybe_set(settings, 'sessions.max_age', 'SESSIONS_MAX_AGE', coercer=int)
+    maybe_set(settings, 'sessions.serializer', 'SESSIONS_SERIALIZER', default='msgpack')
+    maybe_set(settings, 'sessions.compression', 'SESSIONS_COMPRESSION')
+    maybe_set(settings, 'sessions.compression_threshold', 'SESSIONS_COMPRESSION_THRESHOLD',
+              coercer=int)
+    maybe_set(settings, 'sessions.refresh_interval', 'SESSIONS_REFRESH_INTERVAL', coercer=int)
+    maybe_set(settings, 'sessions.max_connections', 'SESSIONS_MAX_CONNECTIONS',
+              coercer=int, default=20)
+    maybe_set(settings, 'sessions.pool_timeout', 'SESSIONS_POOL_TIMEOUT',
+              coercer=float, default=5.0)
+    maybe_set(settings, 'sessions.socket_timeout', 'SESSIONS_SOCKET_TIMEOUT', coercer=float)
+    maybe_set(settings, 'sessions.socket_connect_timeout', 'SESSIONS_SOCKET_CONNECT_TIMEOUT',
+              coercer=float)
+    maybe_set(settings, 'sessions.socket_keepalive', 'SESSIONS_SOCKET_KEEPALIVE',
+              coercer=_as_bool)
+    maybe_set(settings, 'sessions.health_check_interval', 'SESSIONS_HEALTH_CHECK_INTERVAL',
+              coercer=int)
+
+    maybe_set(settings, 'compression.min_size', 'COMPRESSION_MIN_SIZE', coercer=int)
+    maybe_set(settings, 'compression.allow', 'COMPRESSION_ALLOW', coercer=_as_list)
+    maybe_set(settings, 'compression.deny', 'COMPRESSION_DENY', coercer=_as_list)
+    maybe_set(settings, 'compression.max_load', 'COMPRESSION_MAX_LOAD', coercer=float)
+    maybe_set(settings, 'compression.cache_bytes', 'COMPRESSION_CACHE_BYTES',
+              coercer=int, default=32 * 1024 * 1024)
+    maybe_set(settings, 'compression.cache_url', 'COMPRESSION_CACHE_URL')
+
+    maybe_set(settings, 'page_cache.max_bytes', 'PAGE_CACHE_MAX_BYTES',
+              coercer=int, default=32 * 1024 * 1024)
+    maybe_set(settings, 'page_cache.url', 'PAGE_CACHE_URL')
+
+    maybe_set(settings, 'cache.purger', 'CACHE_PURGER', default='local')
+    maybe_set(settings, 'cache.fastly_service_id', 'FASTLY_SERVICE_ID')
+    maybe_set(settings, 'cache.fastly_api_key', 'FASTLY_API_KEY')
+
+    maybe_set(settings, 'single_flight.url', 'SINGLE_FLIGHT_URL')
+    maybe_set(settings, 'single_flight.wait_timeout', 'SINGLE_FLIGHT_WAIT_TIMEOUT',
+              coercer=float, default=10.0)
+    maybe_set(settings, 'single_flight.stale_ttl', 'SINGLE_FLIGHT_STALE_TTL',
+              coercer=int, default=300)
 
     maybe_set(settings, 'celery.broker_url', 'REDIS_URL')
     maybe_set(settings, 'celery.result_url', 'REDIS_URL')
     maybe_set(settings, 'celery.scheduler_url', 'REDIS_URL')
+    maybe_set(settings, 'celery.max_connections', 'CELERY_MAX_CONNECTIONS',
+              coercer=int, default=20)
+    maybe_set(settings, 'celery.environment_pool_size', 'CELERY_ENVIRONMENT_POOL_SIZE',
+              coercer=int, default=4)
+    maybe_set(settings, 'celery.serializer', 'CELERY_SERIALIZER', default='armonaut+zlib')
+    maybe_set(settings, 'celery.compression_threshold', 'CELERY_COMPRESSION_THRESHOLD',
+              coercer=int, default=1024)
+    maybe_set(settings, 'celery.result_policy', 'CELERY_RESULT_POLICY', default='ignore')
+    maybe_set(settings, 'celery.result_ttl', 'CELERY_RESULT_TTL', coercer=int, default=86400)
+    maybe_set(settings, 'celery.publish_async', 'CELERY_PUBLISH_ASYNC',
+              coercer=_as_bool, default=False)
+    maybe_set(settings, 'celery.publish_queue_size', 'CELERY_PUBLISH_QUEUE_SIZE',
+              coercer=int, default=1000)
 
     # Setup our development environment
     if settings['armonaut.env'] == Environment.DEVELOPMENT:
@@ -151,14 +218,24 @@ def configure(settings=None) -> Configurator:
     # Register support for tasks
     config.include('.tasks')
 
+    # Register support for built static assets
+    config.include('.assets')
+
+    # Register conditional HTTP responses and the
+    # finalisation of every response
+    config.include('.cache.http')
+
+    # Register the full page response cache
+    config.include('.cache.pages')
+
+    # Register the cache policies of views and purging the CDN
+    config.include('.cache.policy')
+
+    # Register coalescing of concurrent requests to expensive views
+    config.include('.cache.flight')
+
     # Register HTTP compression
-    config.add_tween(
-        'armonaut.utils.compression.compression_tween_factory',
-        over=[
-            'pyramid_debugtoolbar.toolbar_tween_factory',
-            EXCVIEW
-        ]
-    )
+    config.add_view_deriver('armonaut.utils.compression.compression_view')
 
     # Scan everything for additional configuration
     config.scan(ignore=[
@@ -15,3 +15,4 @@
 
 def includeme(config):
     config.add_route('index', '/')
+    config.add_route('static', '/static/*subpath')
@@ -12,17 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
+import collections
 import functools
+import logging
+import os
+import threading
 import time
-import msgpack
-import msgpack.exceptions
 from zope.interface import implementer
 from pyramid.viewderivers import INGRESS
 from pyramid.interfaces import ISession, ISessionFactory
 import redis
-from armonaut.utils import crypto
+from armonaut.utils import connections, crypto, hashring, serialization
 from armonaut.cache.http import add_vary
 
+logger = logging.getLogger(__name__)
+
 
 def _invalid_method(method):
     @functools.wraps(method)
@@ -79,6 +84,9 @@ class InvalidSession(dict):
     def should_save(self):
         self._error_message()
 
+    def touch(self):
+        self._error_message()
+
     @property
     def sid(self):
         self._error_message()
@@ -92,6 +100,48 @@ class InvalidSession(dict):
         self._error_message()
 
 
+def _lazy_method(name):
+    def wrapped(self, *args, **kwargs):
+        return getattr(self._load(), name)(*args, **kwargs)
+    wrapped.__name__ = name
+    return wrapped
+
+
+@implementer(ISession)
+class LazySession:
+    """Proxy for a session that isn't loaded until it's first used.
+
+    Neither the cookie signature is verified nor is redis queried
+    until an item or attribute of the session is accessed.
+    """
+    def __init__(self, loader):
+        self._loader = loader
+        self._session = None
+
+    @property
+    def loaded(self):
+        return self._session is not None
+
+    def _load(self):
+        if self._session is None:
+            self._session = self._loader()
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    __contains__ = _lazy_method('__contains__')
+    __delitem__ = _lazy_method('__delitem__')
+    __setitem__ = _lazy_method('__setitem__')
+    __getitem__ = _lazy_method('__getitem__')
+    __iter__ = _lazy_method('__iter__')
+    __len__ = _lazy_method('__len__')
+    __eq__ = _lazy_method('__eq__')
+    __ne__ = _lazy_method('__ne__')
+    __repr__ = _lazy_method('__repr__')
+    __hash__ = None
+
+
 def _changed_method(method):
     @functools.wraps(method)
     def wrapped(self, *args, **kwargs):
@@ -106,17 +156,31 @@ class Session(dict):
     _csrf_token_key = '_csrf_token'
     _flash_key = '_flash_messages'
 
-    __delitem__ = _changed_method(dict.__delitem__)
     clear = _changed_method(dict.clear)
-    pop = _changed_method(dict.pop)
-    popitem = _changed_method(dict.popitem)
-    update = _changed_method(dict.update)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._key_changed(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            self._key_changed(key)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._key_changed(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
 
     def setdefault(self, k, default=None):
         changed = k not in self
         ret = dict.setdefault(self, k, default)
         if changed:
-            self.changed()
+            self._key_changed(k)
         return ret
 
     def __setitem__(self, key, value):
@@ -124,33 +188,60 @@ class Session(dict):
         if key in self and self[key] == value:
             return
         dict.__setitem__(self, key, value)
-        self.changed()
+        self._key_changed(key)
 
-    def __init__(self, data=None, session_id=None, new=True):
+    def __init__(self, data=None, session_id=None, new=True, version=None):
         if data is None:
             data = {}
         super().__init__(data)
 
         self._sid = session_id
         self._changed = False
+        self._dirty = set()
+        self.touched = False
         self.new = new
+        self.version = version
         self.created = int(time.time())
         self.invalidated = set()
 
+        # Whether the session was loaded from redis and so should
+        # only be written back if it's still there.
+        self.stored = False
+
     @property
     def sid(self):
         if self._sid is None:
             self._sid = crypto.random_token()
         return self._sid
 
+    @property
+    def dirty(self):
+        """The keys that have been modified since the session was
+        loaded or ``None`` if the entire session must be written.
+        """
+        return self._dirty
+
     def changed(self):
+        # We can't know which value was mutated in place
+        # so the entire session has to be written.
         self._changed = True
+        self._dirty = None
+
+    def touch(self):
+        # Refresh the expiry of the session without saving it.
+        self.touched = True
+
+    def _key_changed(self, key):
+        self._changed = True
+        if self._dirty is not None:
+            self._dirty.add(key)
 
     def invalidate(self):
         self.clear()
         self.new = True
         self.created = int(time.time())
         self._changed = False
+        self._dirty = set()
 
         if self._sid is not None:
             self.invalidated.add(self._sid)
@@ -167,6 +258,7 @@ class Session(dict):
         if not allow_duplicate and msg in self.get(queue_key, []):
             return
         self.setdefault(queue_key, []).append(msg)
+        self._key_changed(queue_key)
 
     def peek_flash(self, queue=''):
         return self.get(self._get_flash_queue_key(queue), [])
@@ -188,25 +280,361 @@ class Session(dict):
         return token
 
 
+def _used_session(request):
+    # Returns the session of the request if it was used.
+    session = request.session
+    if isinstance(session, InvalidSession):
+        return None
+
+    # If the session was never loaded there's nothing to save.
+    if isinstance(session, LazySession):
+        if not session.loaded:
+            return None
+        session = session._load()
+    return session
+
+
+def _copy_data(value):
+    # Session data only ever contains msgpack types so a small
+    # structural copy is all that's needed to keep cached values
+    # from being mutated by the request that's using them.
+    if isinstance(value, dict):
+        return {k: _copy_data(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_copy_data(v) for v in value]
+    return value
+
+
+class SessionCache:
+    """Per-process LRU cache of decoded session data.
+
+    Entries are keyed by the session id and the version stamp that
+    is carried in the signed session cookie. Every save writes a new
+    version so a session saved by another worker produces a cookie
+    that will miss this cache instead of reading stale data. Entries
+    also expire after ``ttl`` seconds to bound how long concurrent
+    requests carrying an older cookie can observe an older version.
+    Sessions invalidated by another worker are evicted by
+    :class:`SessionCacheEvents`, without it they stay readable from the
+    cache for up to ``ttl`` seconds after being logged out.
+    """
+    def __init__(self, max_size=1024, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id, version):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if (entry is None or entry[0] != version or
+                    entry[1] < time.monotonic()):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            data = entry[2]
+
+        return _copy_data(data)
+
+    def set(self, session_id, version, data):
+        entry = (version, time.monotonic() + self.ttl, _copy_data(data))
+        with self._lock:
+            self._entries[session_id] = entry
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SessionCacheEvents:
+    """Evicts sessions from a :class:`SessionCache` when they're deleted
+    or expire in redis so sessions logged out by another worker are no
+    longer read from the cache.
+
+    A thread in each process subscribes to the ``del`` and ``expired``
+    keyspace events of every redis node, which needs
+    ``notify-keyspace-events`` to include ``Egx``. It's enabled when the
+    thread starts if the server allows ``CONFIG SET``. Events arrive
+    asynchronously so a deleted session is readable for as long as its
+    event takes to be delivered. The cache is cleared whenever the thread
+    (re)subscribes because events published before then are lost.
+    """
+    events = ('del', 'expired')
+    retry_delay = 1.0
+
+    def __init__(self, cache: SessionCache, prefix: str):
+        self.cache = cache
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self, clients):
+        # Threads don't survive a fork so each process starts its own.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for client in clients:
+                threading.Thread(
+                    target=self._run, args=(client,),
+                    name='armonaut-session-events', daemon=True
+                ).start()
+
+    def _enable(self, client):
+        try:
+            flags = client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+            # 'A' is an alias for every class of event including 'g' and 'x'.
+            missing = set('Egx') - set(flags.replace('A', 'gx'))
+            if missing:
+                client.config_set('notify-keyspace-events', flags + ''.join(sorted(missing)))
+        except redis.ResponseError:
+            logger.warning(
+                'Unable to enable keyspace notifications, sessions logged out by other '
+                'workers may be read from the cache for %d seconds', self.cache.ttl
+            )
+
+    def _run(self, client):
+        db = client.connection_pool.connection_kwargs.get('db', 0)
+        channels = [f'__keyevent@{db}__:{event}' for event in self.events]
+        while True:
+            try:
+                self._enable(client)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(*channels)
+                self.cache.clear()
+                for message in pubsub.listen():
+                    self._evict(message['data'])
+            except (redis.ConnectionError, redis.TimeoutError):
+                logger.warning('Lost keyspace notifications from redis', exc_info=True)
+            self.cache.clear()
+            time.sleep(self.retry_delay)
+
+    def _evict(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        if key.startswith(self.prefix):
+            self.cache.invalidate(key[len(self.prefix):])
+
+
+# Writes the changed fields of a hash session if the hash still exists.
+# ARGV is the expiry, whether to replace every field, the number of fields
+# to write followed by those fields and values and then the fields to delete.
+_SAVE_HASH_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[2] == '1' then
+    redis.call('del', KEYS[1])
+end
+local count = tonumber(ARGV[3])
+for i = 4, 3 + count * 2, 2 do
+    redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+for i = 4 + count * 2, #ARGV do
+    redis.call('hdel', KEYS[1], ARGV[i])
+end
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+"""
+
+
 @implementer(ISessionFactory)
 class RedisSessionFactory:
     cookie_name = 'session'
     max_age = 12 * 60 * 60
 
-    def __init__(self, secret, url):
-        self.redis = redis.StrictRedis.from_url(url)
-        self.signer = crypto.TimestampSigner(secret, salt='session')
+    # Number of recently verified cookies whose signature check is skipped.
+    signature_cache_size = 1024
+
+    storages = ('string', 'hash')
+
+    def __init__(self, secret, url, cache=None, storage='string',
+                 max_age=None, refresh_interval=None, pool_options=None,
+                 serializer=None, cache_events=False):
+        if storage not in self.storages:
+            raise ValueError(f'Unknown session storage {storage!r}')
+
+        # Several comma separated URLs shard sessions across redis nodes.
+        if isinstance(url, str):
+            url = url.split(',')
+        urls = [shard_url.strip() for shard_url in url if shard_url.strip()]
+
+        self.shards = {
+            shard_url: redis.StrictRedis(
+                connection_pool=connections.get_connection_pool(
+                    shard_url, **(pool_options or {})
+                )
+            )
+            for shard_url in urls
+        }
+        if len(urls) == 1:
+            self.redis = self.shards[urls[0]]
+            self.ring = None
+        else:
+            self.redis = None
+            self.ring = hashring.HashRing(urls)
+        self.signer = crypto.TimestampSigner(
+            secret, salt='session', cache_size=self.signature_cache_size
+        )
+        self.cache = cache
+        self.cache_events = None
+        if cache is not None and cache_events:
+            self.cache_events = SessionCacheEvents(cache, self._redis_key(''))
+        self.storage = storage
+        self.serializer = serializer or serialization.MsgpackSerializer()
+        if max_age is not None:
+            self.max_age = max_age
+
+        # If set sessions are given a sliding expiry which is refreshed
+        # when the session is used and its cookie is older than this.
+        self.refresh_interval = refresh_interval
 
     def __call__(self, request):
-        return self._process_request(request)
+        request.add_response_callback(self._process_response)
+        return LazySession(functools.partial(self._process_request, request))
 
     @staticmethod
     def _redis_key(session_id):
         return f'armonaut/session/{session_id}'
 
-    def _process_request(self, request):
-        request.add_response_callback(self._process_response)
+    def _shard(self, session_id):
+        if self.ring is None:
+            return None
+        return self.ring.get_node(session_id)
+
+    def _client(self, shard):
+        if shard is None:
+            return self.redis
+        return self.shards[shard]
+
+    def _pipeline(self, pipelines, shard):
+        pipeline = pipelines.get(shard)
+        if pipeline is None:
+            pipeline = pipelines[shard] = self._client(shard).pipeline()
+        return pipeline
+
+    def _delete_sessions(self, pipelines, session_ids):
+        keys = collections.defaultdict(list)
+        for session_id in session_ids:
+            keys[self._shard(session_id)].append(self._redis_key(session_id))
+        for shard, shard_keys in keys.items():
+            self._pipeline(pipelines, shard).delete(*shard_keys)
+
+        if self.cache is not None:
+            for session_id in session_ids:
+                self.cache.invalidate(session_id)
+
+    def _execute(self, pipelines, session):
+        for shard, pipeline in pipelines.items():
+            if not len(pipeline):
+                continue
+            try:
+                pipeline.execute()
+            except (redis.ConnectionError, redis.TimeoutError):
+                # An unreachable shard loses the writes for this response,
+                # the session will be fresh on the next request.
+                logger.warning('Unable to write sessions to redis', exc_info=True)
+                if (self.cache is not None and session._sid is not None and
+                        self._shard(session._sid) == shard):
+                    self.cache.invalidate(session._sid)
+
+    def _pack(self, value):
+        return self.serializer.dumps(value)
+
+    def _unpack(self, data):
+        return self.serializer.loads(data)
+
+    def _get_data(self, session_id):
+        key = self._redis_key(session_id)
+        client = self._client(self._shard(session_id))
+
+        # With hash storage every key of the session is
+        # a field of the hash that is packed separately.
+        if self.storage == 'hash':
+            fields = client.hgetall(key)
+            if not fields:
+                return None
+            return {k.decode('utf-8'): self._unpack(v) for k, v in fields.items()}
+
+        data = client.get(key)
+        if data is None:
+            return None
+        return self._unpack(data)
+
+    def _save_data(self, pipeline, session):
+        key = self._redis_key(session.sid)
+
+        # Use SETEX to allow the value to expire after `max_age` seconds.
+        # Sessions loaded from redis are only written if they haven't
+        # been invalidated by another request in the meantime.
+        if self.storage == 'string':
+            if session.stored and not session.new:
+                pipeline.set(key, self._pack(session), ex=self.max_age, xx=True)
+            else:
+                pipeline.setex(key, self.max_age, self._pack(session))
+            return
+
+        # With hash storage only the fields that have changed are written
+        # unless this is a new session or it was changed in an unknown way.
+        dirty = session.dirty
+        replace = session.new or dirty is None
+        if replace:
+            dirty = session.keys()
+
+        fields = {k: self._pack(session[k]) for k in dirty if k in session}
+        deleted = [k for k in dirty if k not in session]
+
+        # Writing a field would recreate a hash that was deleted when another
+        # request invalidated the session, so stored sessions are written by
+        # a script that checks the hash still exists.
+        if session.stored and not session.new:
+            args = [self.max_age, int(replace), len(fields)]
+            for field, value in fields.items():
+                args.extend((field, value))
+            args.extend(deleted)
+            pipeline.eval(_SAVE_HASH_SCRIPT, 1, key, *args)
+            return
 
+        if replace:
+            pipeline.delete(key)
+        if fields:
+            pipeline.hset(key, mapping=fields)
+        if deleted:
+            pipeline.hdel(key, *deleted)
+        pipeline.expire(key, self.max_age)
+
+    def _set_cookie(self, request, response, session):
+        # Set the cookie to be the session id and version
+        cookie = session.sid
+        if session.version is not None:
+            cookie = f'{cookie}.{session.version}'
+
+        self._write_cookie(request, response, self.signer.sign(cookie.encode('utf-8')))
+
+    def _write_cookie(self, request, response, value):
+        # Set the cookie with MaxAge, HttpOnly, and Secure
+        response.set_cookie(
+            self.cookie_name,
+            value,
+            max_age=self.max_age,
+            httponly=True,
+            secure=request.scheme == 'https'
+        )
+
+    def _process_request(self, request):
         session_id = request.cookies.get(self.cookie_name)
 
         # The request didn't claim to have a session
@@ -218,70 +646,212 @@ class RedisSessionFactory:
         # and return a fresh session if the session_id
         # is expired or tampered with.
         try:
-            session_id = self.signer.unsign(session_id, max_age=self.max_age)
+            session_id, signed_at = self.signer.unsign(
+                session_id,
+                max_age=self.max_age,
+                return_timestamp=True
+            )
             session_id = session_id.decode('utf-8')
         except crypto.BadSignature:
             return Session()
 
-        # Grab the packed session data from redis
-        data = self.redis.get(self._redis_key(session_id))
+        refresh = self._should_refresh(signed_at)
+
+        # The cookie carries the version of the session that was
+        # last saved, cookies from before versioning have none.
+        session_id, _, version = session_id.partition('.')
+        version = version or None
+
+        # Check the local cache before making a round trip to redis.
+        if self.cache is not None and version is not None:
+            if self.cache_events is not None:
+                self.cache_events.start(
+                    [self._client(shard) for shard in (self.shards if self.ring else [None])]
+                )
+            data = self.cache.get(session_id, version)
+            if data is not None:
+                return self._make_session(data, session_id, version, refresh)
+
+        # Grab and unpack the session data from redis
+        try:
+            data = self._get_data(session_id)
+        # If the session data is invalid give the user a new session
+        except serialization.SerializationError:
+            return Session()
+        # If the shard holding the session can't be reached
+        # the user gets a new session instead of an error.
+        except (redis.ConnectionError, redis.TimeoutError):
+            return Session()
 
         # If the session didn't exist in redis give the user
         # a new session.
         if data is None:
             return Session()
 
-        # Unpack the session data into objects and values
-        try:
-            data = msgpack.unpackb(data, encoding='utf-8', use_list=True)
-        # If the session data is invalid give the user a new session
-        except (msgpack.exceptions.UnpackException,
-                msgpack.exceptions.ExtraData):
-            return Session()
+        if self.cache is not None and version is not None:
+            self.cache.set(session_id, version, data)
 
         # We were able to load an existing sessions data
-        return Session(data, session_id, False)
+        return self._make_session(data, session_id, version, refresh)
+
+    def _should_refresh(self, signed_at):
+        # The cookie is re-signed whenever the session is saved or touched
+        # so its timestamp limits how often we refresh the expiry.
+        return (
+            self.refresh_interval is not None and
+            time.time() - calendar.timegm(signed_at.utctimetuple()) >= self.refresh_interval
+        )
+
+    @staticmethod
+    def _make_session(data, session_id, version, refresh):
+        session = Session(data, session_id, False, version)
+        session.stored = session_id is not None
+        if refresh:
+            session.touch()
+        return session
 
     def _process_response(self, request, response):
-        if isinstance(request.session, InvalidSession):
+        session = _used_session(request)
+        if session is None:
             return
 
+        # All of the changes to redis for this response are queued
+        # and sent in a single MULTI/EXEC round trip to each shard.
+        pipelines = {}
+
         # If our session has been invalidated we need to clean
         # up old sessions and potentially delete the cookie
-        if request.session.invalidated:
+        if session.invalidated:
             # Delete all old session ids
-            for invalid_id in request.session.invalidated:
-                self.redis.delete(self._redis_key(invalid_id))
+            self._delete_sessions(pipelines, session.invalidated)
 
             # If no new session was created after an invalidate
             # then don't send a cookie with a session.
-            if not request.session.should_save():
+            if not session.should_save():
                 response.delete_cookie(self.cookie_name)
 
         # If the session has been modified we need to save
         # the session to redis and the cookie with newly
         # signed values.
-        if request.session.should_save():
-            # Use SETEX to allow the value to expire after `max_age` seconds.
-            self.redis.setex(
-                self._redis_key(request.session.sid),
-                self.max_age,
-                msgpack.packb(
-                    request.session,
-                    encoding='utf-8',
-                    use_bin_type=True
-                )
-            )
+        if session.should_save():
+            # Every save gets a new version so that other workers
+            # caching this session will miss on the next request.
+            session.version = crypto.random_token(6)
 
-            # Set the cookie to be the session id and also
-            # set MaxAge, HttpOnly, and Secure
-            response.set_cookie(
-                self.cookie_name,
-                self.signer.sign(request.session.sid.encode('utf-8')),
-                max_age=self.max_age,
-                httponly=True,
-                secure=request.scheme == 'https'
-            )
+            self._save_data(self._pipeline(pipelines, self._shard(session.sid)), session)
+
+            if self.cache is not None:
+                self.cache.set(session.sid, session.version, session)
+
+            self._set_cookie(request, response, session)
+
+        # If the session was only touched we refresh the expiry
+        # of both redis and the cookie without writing the session.
+        elif session.touched and not session.new:
+            pipeline = self._pipeline(pipelines, self._shard(session.sid))
+            pipeline.expire(self._redis_key(session.sid), self.max_age)
+            self._set_cookie(request, response, session)
+
+        self._execute(pipelines, session)
+
+
+@implementer(ISessionFactory)
+class CookieSessionFactory(RedisSessionFactory):
+    """Stores sessions in a signed and optionally encrypted cookie.
+
+    Sessions that don't fit in ``max_size`` bytes are stored in redis
+    the same way :class:`RedisSessionFactory` stores them and are moved
+    back into the cookie if they shrink again.
+    """
+    # Cookies containing the session itself start with this prefix
+    # which never appears in the cookies of sessions stored in redis.
+    cookie_prefix = '~'
+
+    def __init__(self, secret, url, max_size=1024, encrypt=False, **kwargs):
+        super().__init__(secret, url, **kwargs)
+        self.max_size = max_size
+        self.cookie_serializer = crypto.URLSafeSerializer(secret, salt='session-cookie')
+        self.encrypter = None
+        if encrypt:
+            self.encrypter = crypto.Encrypter(secret, 'session-cookie')
+
+    def _dumps_cookie(self, session):
+        value = self.cookie_serializer.dumps(dict(session))
+        if self.encrypter is not None:
+            value = self.encrypter.encrypt(value.encode('utf-8')).decode('utf-8')
+        return self.cookie_prefix + value
+
+    def _loads_cookie(self, value):
+        value = value[len(self.cookie_prefix):]
+        if self.encrypter is not None:
+            value = self.encrypter.decrypt(value.encode('utf-8')).decode('utf-8')
+
+        payload, signed_at = self.cookie_serializer.make_signer().unsign(
+            value,
+            max_age=self.max_age,
+            return_timestamp=True
+        )
+        return self.cookie_serializer.load_payload(payload), signed_at
+
+    def _process_request(self, request):
+        value = request.cookies.get(self.cookie_name)
+
+        # Sessions that aren't stored in the cookie are loaded from redis.
+        if value is None or not value.startswith(self.cookie_prefix):
+            return super()._process_request(request)
+
+        try:
+            data, signed_at = self._loads_cookie(value)
+        except (crypto.BadData, UnicodeError):
+            return Session()
+
+        if not isinstance(data, dict):
+            return Session()
+
+        return self._make_session(data, None, None, self._should_refresh(signed_at))
+
+    def _process_response(self, request, response):
+        session = _used_session(request)
+        if session is None:
+            return
+
+        in_cookie = request.cookies.get(self.cookie_name, '').startswith(self.cookie_prefix)
+
+        if session.should_save():
+            value = self._dumps_cookie(session)
+
+            # If the session is too large for a cookie it's stored in redis.
+            # Sessions coming from the cookie aren't in redis yet so all of
+            # their keys are written and not only the ones that changed.
+            if len(value) > self.max_size:
+                if session._sid is None:
+                    session.changed()
+                super()._process_response(request, response)
+                return
+
+            # Sessions that were stored in redis are removed from
+            # redis now that they're being stored in the cookie.
+            if session._sid is not None:
+                session.invalidated.add(session._sid)
+            if session.invalidated:
+                pipelines = {}
+                self._delete_sessions(pipelines, session.invalidated)
+                self._execute(pipelines, session)
+
+            self._write_cookie(request, response, value)
+
+        elif not in_cookie:
+            super()._process_response(request, response)
+
+        # If the session was invalidated and nothing new was stored.
+        elif session.new:
+            response.delete_cookie(self.cookie_name)
+
+        elif session.touched:
+            self._write_cookie(request, response, self._dumps_cookie(session))
+
+
+_unset = object()
 
 
 def session_view(view, info):
@@ -296,8 +866,10 @@ def session_view(view, info):
         # that ensures that the session is an `InvalidSession`.
         @functools.wraps(view)
         def wrapped(context, request):
-            # Store the original session so it can be restored.
-            original_session = request.session
+            # Store the original session so it can be restored. The
+            # session is looked up without calling the session factory
+            # so views that don't use sessions don't pay for them.
+            original_session = vars(request).get('session', _unset)
             request.session = InvalidSession()
 
             try:
@@ -305,7 +877,10 @@ def session_view(view, info):
             finally:
                 # Restore the previous session so that
                 # the debug toolbar can use it.
-                request.session = original_session
+                if original_session is _unset:
+                    del request.session
+                else:
+                    request.session = original_session
 
         return wrapped
 
@@ -313,11 +888,69 @@ def session_view(view, info):
 session_view.options = {'uses_session'}
 
 
+_pool_settings = {
+    'sessions.max_connections': 'max_connections',
+    'sessions.pool_timeout': 'timeout',
+    'sessions.socket_timeout': 'socket_timeout',
+    'sessions.socket_connect_timeout': 'socket_connect_timeout',
+    'sessions.socket_keepalive': 'socket_keepalive',
+    'sessions.health_check_interval': 'health_check_interval'
+}
+
+
+_serializer_settings = {
+    'sessions.compression': 'compression',
+    'sessions.compression_threshold': 'threshold'
+}
+
+
 def includeme(config):
+    settings = config.registry.settings
+
+    # Every redis connection pool in the process is created with these
+    # so the caches and result backend can't race the session store.
+    connections.configure(**{
+        option: settings[name]
+        for name, option in _pool_settings.items()
+        if settings.get(name) is not None
+    })
+
+    serializer_options = {
+        option: settings[name]
+        for name, option in _serializer_settings.items()
+        if settings.get(name) is not None
+    }
+    serializer = serialization.SERIALIZERS[
+        settings.get('sessions.serializer', 'msgpack')
+    ](**serializer_options)
+
+    cache = None
+    if settings.get('sessions.cache_size'):
+        cache = SessionCache(
+            max_size=settings['sessions.cache_size'],
+            ttl=settings.get('sessions.cache_ttl', 30)
+        )
+
+    factory_options = {}
+    factory_cls = RedisSessionFactory
+    if settings.get('sessions.backend', 'redis') == 'cookie':
+        factory_cls = CookieSessionFactory
+        factory_options = {
+            'max_size': settings.get('sessions.cookie_max_size', 1024),
+            'encrypt': settings.get('sessions.cookie_encrypt', False)
+        }
+
     config.set_session_factory(
-        RedisSessionFactory(
-            config.registry.settings['sessions.secret'],
-            config.registry.settings['sessions.url']
+        factory_cls(
+            settings['sessions.secret'],
+            settings['sessions.url'],
+            cache=cache,
+            storage=settings.get('sessions.storage', 'string'),
+            max_age=settings.get('sessions.max_age'),
+            refresh_interval=settings.get('sessions.refresh_interval'),
+            serializer=serializer,
+            cache_events=True,
+            **factory_options
         )
     )
     config.add_view_deriver(
@@ -12,13 +12,95 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import functools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import typing
 import celery
+import celery.backends.redis
+import celery.signals
+import celery.schedules
 import pyramid.scripting
 import pyramid_retry
 import transaction
 import venusian
-from pyramid.threadlocal import get_current_request
+from kombu import serialization as kombu_serialization
+from kombu.utils.encoding import bytes_to_str
+from pyramid.threadlocal import RequestContext, get_current_request
+from armonaut.utils import connections, serialization
+
+logger = logging.getLogger(__name__)
+
+# Every variant of our serializer shares a content type because
+# any of them can load the payloads written by the others.
+CONTENT_TYPE = 'application/x-armonaut-msgpack'
+
+
+class EnvironmentPool:
+    """Keeps prepared Pyramid environments for the tasks of a worker.
+
+    Preparing an environment builds a request and applies every request
+    extension to it, so instead environments are returned to the pool
+    after a task and reset to how they were when they were prepared.
+    At most ``size`` idle environments are kept.
+    """
+    def __init__(self, size: int=4):
+        self.size = size
+        self._idle = []
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, registry):
+        with self._lock:
+            env = self._idle.pop() if self._idle else None
+
+        if env is None:
+            env = pyramid.scripting.prepare(registry=registry)
+            env['request'].tm = transaction.TransactionManager(explicit=True)
+            request = env['request']
+            self._snapshots[id(env)] = (dict(vars(request)), dict(request.environ)
+                                        if hasattr(request, 'environ') else None)
+        else:
+            RequestContext(env['request']).begin()
+        return env
+
+    def release(self, env):
+        request = env['request']
+        request._process_finished_callbacks()
+        env['closer']()
+
+        snapshot = self._snapshots.get(id(env))
+        if snapshot is None:
+            return
+
+        with self._lock:
+            if len(self._idle) >= self.size:
+                del self._snapshots[id(env)]
+                return
+
+        # Anything the task set on the request or its environ is
+        # forgotten so the next task gets a request like a new one.
+        attributes, environ = snapshot
+        vars(request).clear()
+        vars(request).update(attributes)
+        if environ is not None:
+            request.environ = dict(environ)
+        request.tm = transaction.TransactionManager(explicit=True)
+
+        with self._lock:
+            self._idle.append(env)
+
+
+def _environments(app) -> EnvironmentPool:
+    pool = getattr(app, 'pyramid_environments', None)
+    if pool is None:
+        pool = app.pyramid_environments = EnvironmentPool()
+    return pool
 
 
 class Task(celery.Task):
@@ -50,17 +132,14 @@ class Task(celery.Task):
     def get_request(self):
         if not hasattr(self.request, 'pyramid_env'):
             registry = self.app.pyramid_config.registry
-            env = pyramid.scripting.prepare(registry=registry)
-            env['request'].tm = transaction.TransactionManager(explicit=True)
+            env = _environments(self.app).acquire(registry)
             self.request.update(pyramid_env=env)
 
         return self.request.pyramid_env['request']
 
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
         if hasattr(self.request, 'pyramid_env'):
-            pyramid_env = self.request.pyramid_env
-            pyramid_env['request']._process_finished_callbacks()
-            pyramid_env['closer']()
+            _environments(self.app).release(self.request.pyramid_env)
 
     def apply_async(self, *args, **kwargs):
         request = get_current_request()
@@ -68,20 +147,289 @@ class Task(celery.Task):
         if request is None or not hasattr(request, 'tm'):
             return super().apply_async(*args, **kwargs)
 
-        request.tm.get().addAfterCommitHook(
-            self._after_commit_hook,
-            args=args,
-            kwargs=kwargs
+        # Tasks are collected per transaction and published
+        # together in the order they were applied once it commits.
+        _pending_tasks(request.tm.get(), self.app).append((self, args, kwargs))
+
+    def _publish(self, producer, args, kwargs):
+        kwargs.setdefault('producer', producer)
+        return super().apply_async(*args, **kwargs)
+
+
+def _pending_tasks(txn, app):
+    try:
+        return txn.data(app)
+    except KeyError:
+        pending = []
+        txn.set_data(app, pending)
+        txn.addAfterCommitHook(_after_commit_hook, args=(app, pending))
+        return pending
+
+
+def _publish_batch(app, pending) -> typing.List[tuple]:
+    """Publishes tasks with one producer and returns the tasks that
+    couldn't be published with their exceptions. A task that can't be
+    published doesn't stop the tasks after it.
+    """
+    failed = []
+    published = 0
+    try:
+        with app.producer_or_acquire() as producer:
+            for item in pending:
+                task, args, kwargs = item
+                try:
+                    task._publish(producer, args, dict(kwargs))
+                except Exception as exc:
+                    failed.append((item, exc))
+                published += 1
+    except Exception as exc:
+        failed.extend((item, exc) for item in pending[published:])
+    return failed
+
+
+def _log_failed(failed):
+    for (task, _, _), exc in failed:
+        logger.error('Unable to publish task %s', task.name, exc_info=exc)
+
+
+def _after_commit_hook(success, app, pending):
+    if not success:
+        return
+
+    publisher = getattr(app, 'task_publisher', None)
+    if publisher is not None:
+        publisher.submit(pending)
+    else:
+        _log_failed(_publish_batch(app, pending))
+
+
+class TaskPublisher:
+    """Publishes the tasks of committed transactions from a background
+    thread so requests don't wait on the broker.
+
+    At most ``max_size`` batches wait to be published. When the queue is
+    full a request waits up to ``put_timeout`` seconds for room and then
+    publishes its batch itself. Tasks that fail are retried ``retries``
+    times after a jittered exponential delay. The queue is flushed when
+    the process exits.
+    """
+    def __init__(self, app, max_size: int=1000, put_timeout: float=1.0,
+                 retries: int=3, retry_delay: float=0.1):
+        self.app = app
+        self.max_size = max_size
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self.batches = 0
+        self.published = 0
+        self.failed = 0
+        self.retried = 0
+        self.overflowed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _start(self):
+        # Threads don't survive a fork so each process starts its own.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue(maxsize=self.max_size)
+                self._thread = threading.Thread(
+                    target=self._run, name='armonaut-task-publisher', daemon=True
+                )
+                self._thread.start()
+            return self._queue
+
+    def submit(self, pending: typing.List[tuple]):
+        tasks_queue = self._start()
+        try:
+            tasks_queue.put((time.monotonic(), pending), timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self.overflowed += 1
+            self._publish(time.monotonic(), pending, retries=0)
+
+    def _run(self):
+        tasks_queue = self._queue
+        while True:
+            item = tasks_queue.get()
+            try:
+                if item is None:
+                    return
+                self._publish(*item)
+            except Exception:  # pragma: no cover
+                logger.exception('Task publisher failed')
+            finally:
+                tasks_queue.task_done()
+
+    def _publish(self, submitted, pending, retries=None):
+        retries = self.retries if retries is None else retries
+        failed = _publish_batch(self.app, pending)
+        for attempt in range(retries):
+            if not failed:
+                break
+            with self._lock:
+                self.retried += len(failed)
+            time.sleep(self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5))
+            failed = _publish_batch(self.app, [item for item, _ in failed])
+
+        _log_failed(failed)
+        latency = time.monotonic() - submitted
+        with self._lock:
+            self.batches += 1
+            self.published += len(pending) - len(failed)
+            self.failed += len(failed)
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def flush(self, timeout: float=None) -> bool:
+        """Waits until every submitted batch has been published."""
+        tasks_queue = self._queue
+        if tasks_queue is None or self._pid != os.getpid():
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with tasks_queue.all_tasks_done:
+            while tasks_queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                tasks_queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout: float=10.0):
+        """Publishes the queued batches for up to ``timeout`` seconds and
+        stops the thread. Batches that are still queued are dropped with
+        the daemon thread when the process exits.
+        """
+        if self._queue is None or self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        if not self.flush(timeout):
+            logger.warning('Dropping %d task batches that were not published',
+                           self._queue.qsize())
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        else:
+            self._thread.join(max(deadline - time.monotonic(), 0))
+        self._pid = None
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {
+                'depth': self._queue.qsize() if self._queue is not None else 0,
+                'max_size': self.max_size,
+                'batches': self.batches,
+                'published': self.published,
+                'failed': self.failed,
+                'retried': self.retried,
+                'overflowed': self.overflowed,
+                'latency_avg': self.latency_total / self.batches if self.batches else 0.0,
+                'latency_max': self.latency_max
+            }
+
+
+class RedisBackend(celery.backends.redis.RedisBackend):
+    def _store_result(self, task_id, result, state, traceback=None, request=None, **kwargs):
+        task = self.app.tasks.get(getattr(request, 'task', None))
+        policy = getattr(task, 'result_policy', None)
+        if policy is None:
+            return super()._store_result(task_id, result, state, traceback=traceback,
+                                         request=request, **kwargs)
+
+        # Backends aren't shared between threads so the serializer
+        # and expiry of the task can be swapped in while it's stored.
+        serializer, expires = self.serializer, self.expires
+        self.serializer = _result_serializer(policy, serializer)
+        self.expires = getattr(task, 'result_ttl', None) or expires
+        try:
+            return super()._store_result(task_id, result, state, traceback=traceback,
+                                         request=request, **kwargs)
+        finally:
+            self.serializer, self.expires = serializer, expires
+
+    def _get_pool(self, **params):
+        if self.url is None:
+            return super()._get_pool(**params)
+
+        # Share the connection pool of this process for the URL
+        # so we don't open more connections than we need to redis.
+        return connections.get_connection_pool(self.url)
+
+
+def _result_backend(url):
+    # Redis result backends use our backend so they can share
+    # connection pools with the session store.
+    if url.startswith(('redis://', 'rediss://')):
+        return f'armonaut.tasks:RedisBackend+{url}'
+    return url
+
+
+def serializer_name(compression: typing.Optional[str]=None) -> str:
+    if compression is None:
+        return 'armonaut'
+    if compression not in serialization.COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression!r}')
+    return f'armonaut+{compression}'
+
+
+def register_serializers(threshold: int=1024):
+    """Registers our msgpack serializer with kombu once for each
+    compression. Payloads larger than ``threshold`` bytes are compressed.
+    """
+    for compression in [None] + sorted(serialization.COMPRESSIONS):
+        serializer = serialization.MsgpackSerializer(
+            compression=compression,
+            threshold=threshold
+        )
+        kombu_serialization.register(
+            serializer_name(compression),
+            serializer.dumps,
+            serializer.loads,
+            content_type=CONTENT_TYPE,
+            content_encoding='binary'
         )
 
-    def _after_commit_hook(self, success, *args, **kwargs):
-        if success:
-            super().apply_async(*args, **kwargs)
+
+# The serializer results are stored with for each result policy.
+RESULT_POLICIES = {
+    'ignore': None,
+    'store': serializer_name(),
+    'compressed': serializer_name('zlib')
+}
+
+
+def _result_serializer(policy: str, serializer: str) -> str:
+    # Results are loaded by the content type of the result serializer
+    # so a policy only swaps it for another variant of ours.
+    if kombu_serialization.registry.name_to_type.get(serializer) != CONTENT_TYPE:
+        return serializer
+    return RESULT_POLICIES[policy] or serializer
 
 
 def task(**kwargs):
     kwargs.setdefault('shared', False)
 
+    # The compression of a task's messages picks the variant of our
+    # serializer instead of Celery compressing every message.
+    if 'compression' in kwargs:
+        kwargs['serializer'] = serializer_name(kwargs.pop('compression'))
+
+    # Results are ignored unless the task or the project says otherwise.
+    # Stored results expire after `result_ttl` seconds.
+    if 'result' in kwargs:
+        policy = kwargs.pop('result')
+        if policy not in RESULT_POLICIES:
+            raise ValueError(f'Unknown result policy {policy!r}')
+        kwargs['ignore_result'] = policy == 'ignore'
+        kwargs['result_policy'] = policy
+
     def deco(wrapped):
         def callback(scanner, name, wrapped):
             celery_app = scanner.config.registry['celery.app']
@@ -92,6 +440,48 @@ def task(**kwargs):
     return deco
 
 
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@task()
+def expire_results(request, batch_size: int=500):
+    """Gives every stored result without an expiry one, a batch of keys
+    at a time. Results stored before they had a TTL would otherwise never
+    be reclaimed by redis. Returns the number of results given an expiry.
+    """
+    backend = request.registry['celery.app'].backend
+    if not isinstance(backend, RedisBackend):
+        return 0
+
+    client = backend.client
+    ttl = backend.expires or request.registry.settings.get('celery.result_ttl', 86400)
+    pattern = bytes_to_str(backend.task_keyprefix) + '*'
+    expired = 0
+    for keys in _batches(client.scan_iter(match=pattern, count=batch_size), batch_size):
+        pipeline = client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.ttl(key)
+        persistent = [key for key, key_ttl in zip(keys, pipeline.execute())
+                      if key_ttl is None or key_ttl < 0]
+
+        if persistent:
+            pipeline = client.pipeline(transaction=False)
+            for key in persistent:
+                pipeline.expire(key, ttl)
+            pipeline.execute()
+            expired += len(persistent)
+
+    return expired
+
+
 def _get_task(celery_app, task_func):
     task_name = celery_app.gen_task_name(
         task_func.__name__,
@@ -130,24 +520,53 @@ def _add_periodic_task(config, schedule, func, args=(), kwargs=(), name=None, **
 def includeme(config):
     settings = config.registry.settings
 
+    register_serializers(threshold=settings.get('celery.compression_threshold', 1024))
+    serializer = settings.get('celery.serializer', serializer_name('zlib'))
+    result_policy = settings.get('celery.result_policy', 'ignore')
+    if result_policy not in RESULT_POLICIES:
+        raise ValueError(f'Unknown result policy {result_policy!r}')
+
     config.registry['celery.app'] = celery.Celery(
         'armonaut',
         autofinalize=False,
         set_as_current=False
     )
     config.registry['celery.app'].conf.update(
-        accept_content=['msgpack', 'json'],
+        accept_content=['armonaut', 'msgpack', 'json'],
+        broker_pool_limit=settings.get('celery.max_connections'),
+        broker_transport_options={
+            'max_connections': settings.get('celery.max_connections')
+        },
         broker_url=settings['celery.broker_url'],
-        result_backend=settings['celery.result_url'],
-        result_compression='gzip',
-        result_serializer='json',
+        redis_max_connections=settings.get('celery.max_connections'),
+        result_backend=_result_backend(settings['celery.result_url']),
+        result_serializer=_result_serializer(result_policy, serializer),
         task_queue_ha_policy='all',
-        task_serializer='json',
+        task_serializer=serializer,
         worker_disable_rate_limits=True,
+        task_ignore_result=result_policy == 'ignore',
+        result_expires=settings.get('celery.result_ttl', 86400),
         REDBEAT_REDIS_URL=settings['celery.scheduler_url']
     )
 
     config.registry['celery.app'].Task = Task
+    config.registry['celery.app'].pyramid_environments = EnvironmentPool(
+        size=settings.get('celery.environment_pool_size', 4)
+    )
+
+    if settings.get('celery.publish_async'):
+        publisher = TaskPublisher(
+            config.registry['celery.app'],
+            max_size=settings.get('celery.publish_queue_size', 1000)
+        )
+        config.registry['celery.app'].task_publisher = publisher
+
+        # Tasks still waiting to be published are flushed when the
+        # web or worker process shuts down.
+        atexit.register(publisher.close)
+        celery.signals.worker_process_shutdown.connect(
+            lambda **kwargs: publisher.close(), weak=False
+        )
     config.registry['celery.app'].pyramid_config = config
 
     config.action(
@@ -164,3 +583,6 @@ def includeme(config):
     config.add_directive('make_celery_app', _get_celery_app, action_wrap=False)
     config.add_directive('task', _get_task_from_config, action_wrap=False)
     config.add_request_method(_get_task_from_request, name='task', reify=True)
+
+    # Reclaim results that were stored without an expiry every hour.
+    config.add_periodic_task(celery.schedules.crontab(minute=0), expire_results)
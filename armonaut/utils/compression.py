@@ -12,36 +12,238 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64
-import hashlib
+import fnmatch
+import functools
+import os
+import time
+import typing
+import zlib
 from collections.abc import Sequence
+from armonaut.cache import etag
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
 
-ENCODINGS = ['identity', 'br', 'gzip']
 DEFAULT_ENCODING = 'identity'
 BUFFER_MAX = 1 * 1024 * 1024
 
+# Streamed responses are flushed after the first chunk so the client
+# gets the first bytes early and after that whenever this much input
+# has been compressed since the last flush.
+FLUSH_SIZE = 16 * 1024
+
+
+def _gzip(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (
+        compressor.compress,
+        functools.partial(compressor.flush, zlib.Z_SYNC_FLUSH),
+        compressor.flush
+    )
+
+
+def _brotli(level):
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.flush, compressor.finish
+
+
+def _zstd(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return (
+        compressor.compress,
+        functools.partial(compressor.flush, zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+        compressor.flush
+    )
+
+
+# Each codec returns `compress`, `flush` and `finish` functions
+# for a new compressor at the given level.
+CODECS = {'gzip': (_gzip, 6)}
+if brotli is not None:
+    CODECS['br'] = (_brotli, 5)
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd, 3)
+
+# Encodings in order of preference when the client accepts several equally.
+ENCODINGS = ['identity'] + [encoding for encoding in ('zstd', 'br', 'gzip')
+                            if encoding in CODECS]
+
+
+# Fast, default and best levels for each codec.
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 5, 8), 'zstd': (1, 3, 9)}
+
+
+class CompressionPolicy:
+    """Decides whether a response is worth compressing and at what level.
+
+    Responses smaller than ``min_size`` aren't compressed and neither are
+    content types that don't match ``allow`` or do match ``deny`` which
+    are lists of ``fnmatch`` patterns. Small responses get the best level,
+    large ones the fastest and the level drops a step further when the
+    load average per CPU is at least ``max_load``.
+    """
+    min_size = 256
+    small_size = 64 * 1024
+    large_size = 1024 * 1024
+    max_load = 1.0
+
+    allow = (
+        'text/*', 'application/json', 'application/*+json', 'application/javascript',
+        'application/xml', 'application/*+xml', 'image/svg+xml'
+    )
+    # Event streams are denied because compressors buffer their output.
+    deny = ('text/event-stream',)
+
+    def __init__(self, min_size: int=None, allow: typing.Iterable[str]=None,
+                 deny: typing.Iterable[str]=None, max_load: float=None):
+        if min_size is not None:
+            self.min_size = min_size
+        if allow is not None:
+            self.allow = tuple(allow)
+        if deny is not None:
+            self.deny = tuple(deny)
+        if max_load is not None:
+            self.max_load = max_load
+
+        self._load = 0.0
+        self._load_checked = None
+
+    def should_compress(self, response) -> bool:
+        if response.content_length is not None and response.content_length < self.min_size:
+            return False
+
+        content_type = response.content_type
+        if not content_type:
+            return False
+        if any(fnmatch.fnmatchcase(content_type, pattern) for pattern in self.deny):
+            return False
+        return any(fnmatch.fnmatchcase(content_type, pattern) for pattern in self.allow)
+
+    def load(self) -> float:
+        # The load average only changes every few seconds so don't
+        # ask the kernel for it on every single response.
+        now = time.monotonic()
+        if self._load_checked is None or now - self._load_checked >= 1.0:
+            self._load_checked = now
+            try:
+                self._load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            except OSError:  # pragma: no cover
+                self._load = 0.0
+        return self._load
+
+    def level(self, encoding: str, size: int=None) -> int:
+        if size is None:
+            tier = 1
+        elif size <= self.small_size:
+            tier = 2
+        elif size >= self.large_size:
+            tier = 0
+        else:
+            tier = 1
+
+        if tier and self.load() >= self.max_load:
+            tier -= 1
+        return LEVELS[encoding][tier]
 
-def _compressor(request, response):
+    @classmethod
+    def from_settings(cls, settings) -> 'CompressionPolicy':
+        return cls(
+            min_size=settings.get('compression.min_size'),
+            allow=settings.get('compression.allow'),
+            deny=settings.get('compression.deny'),
+            max_load=settings.get('compression.max_load')
+        )
+
+
+DEFAULT_POLICY = CompressionPolicy()
+
+
+def _codec(encoding, level=None):
+    codec, default_level = CODECS[encoding]
+    return codec(default_level if level is None else level)
+
+
+def compress(data: bytes, encoding: str, level: int=None) -> bytes:
+    compress, _, finish = _codec(encoding, level)
+    return compress(data) + finish()
+
+
+class CompressedAppIter:
+    """Wraps a WSGI ``app_iter`` and compresses it chunk by chunk.
+
+    Only the compressor's window is held in memory so responses of any
+    size are compressed in constant memory as they are streamed.
+    """
+    def __init__(self, app_iter, encoding: str, level: int=None,
+                 flush_size: int=FLUSH_SIZE):
+        self.app_iter = app_iter
+        self.encoding = encoding
+        self.level = level
+        self.flush_size = flush_size
+
+    def __iter__(self):
+        compress, flush, finish = _codec(self.encoding, self.level)
+        pending = None
+
+        for chunk in self.app_iter:
+            if not chunk:
+                continue
+
+            data = compress(chunk)
+            if pending is None or pending + len(chunk) >= self.flush_size:
+                data += flush()
+                pending = 0
+            else:
+                pending += len(chunk)
+
+            if data:
+                yield data
+
+        yield finish()
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def _compressible(request, response, vary, encoded, policy) -> bool:
     # Skip items with a Vary: Cookie/Authorization because we
     # don't know if they're vulnerable to CRIME-esque attacks.
-    if (response.vary is not None and
-            set(response.vary) & {'Cookie', 'Authorization'}):
-        return
+    if 'Cookie' in vary or 'Authorization' in vary:
+        return False
 
     # Avoid compression if there's already an encoding
-    if 'Content-Encoding' in response.headers:
-        return
+    if encoded is None:
+        encoded = 'Content-Encoding' in response.headers
+    if encoded:
+        return False
+
+    # Views can turn compression off or force it on with the
+    # `compress` view option, otherwise the policy decides.
+    compress_option = getattr(request, 'compress', None)
+    if compress_option is False:
+        return False
+    if compress_option is None and not policy.should_compress(response):
+        return False
+    return True
 
-    # Ensure that the Accept-Encoding header gets added to the response.
-    vary = set(response.vary if response.vary is not None else [])
-    vary.add('Accept-Encoding')
-    response.vary = vary
 
+def _encode(request, response, policy=DEFAULT_POLICY, cache=None):
     # Determine the correct encoding from our request.
     target_encoding = request.accept_encoding.best_match(
         ENCODINGS,
         default_match=DEFAULT_ENCODING
     )
+    if target_encoding == 'identity':
+        return
 
     # If we have a Sequence instead of an iterable we'll
     # assume the response isn't streaming.
@@ -56,37 +258,62 @@ def _compressor(request, response):
 
     if streaming:
         # If we're streaming we need to lazily encode the content.
-        response.encode_content(encoding=target_encoding, lazy=True)
+        response.app_iter = CompressedAppIter(
+            response.app_iter,
+            target_encoding,
+            level=policy.level(target_encoding)
+        )
+        response.content_encoding = target_encoding
 
         # We no longer know the Content-Length of the response due to encoding.
         response.content_length = None
 
-        # If an ETag header is already calculated we need to create a new one
-        # based on the old one so add some data to the old ETag and rehash it.
-        if response.etag is not None:
-            md5_digest = hashlib.md5((response.etag + ';gzip').encode('utf-8'))
-            md5_digest = base64.b64encode(md5_digest.digest()).replace(b'\n', b'').decode('utf-8')
-            response.etag = md5_digest.rstrip('=')
+        # If an ETag header is already calculated the encoded
+        # response gets one derived from it.
+        etag.set_encoded_etag(response, target_encoding)
 
     else:
-        original_length = len(response.body)
-        response.encode_content(encoding=target_encoding, lazy=False)
+        # The ETag of the encoded response is derived from the ETag
+        # of the identity response so the same content always gets
+        # the same ETag no matter how it was compressed.
+        if response.etag is None:
+            etag.set_body_etag(response)
+
+        # Content that has already been compressed for
+        # this encoding is served from the cache.
+        key = cache.key(request, response) if cache is not None else None
+        if key is not None:
+            cached = cache.get(key, target_encoding)
+            if cached is not None:
+                response.body = cached[0]
+                response.content_encoding = target_encoding
+                etag.set_encoded_etag(response, target_encoding)
+                return
+
+        body = response.body
+        compressed = compress(body, target_encoding, policy.level(target_encoding, len(body)))
+
+        # If encoding the content is actually longer we leave it alone.
+        if len(compressed) < len(body):
+            response.body = compressed
+            response.content_encoding = target_encoding
+            etag.set_encoded_etag(response, target_encoding)
+
+            if key is not None:
+                cache.set(key, target_encoding, compressed, response.etag)
+
 
-        # If encoding the content is actually longer now we should revert.
-        if original_length < len(response.body):
-            response.decode_content()
+def compression_view(view, info):
+    compress = info.options.get('compress')
+    if compress is None:
+        return view
 
-        # If we've added an encoding we should recompute the ETag
-        if response.content_encoding is not None:
-            response.md5_etag()
+    @functools.wraps(view)
+    def wrapped(context, request):
+        request.compress = compress
+        return view(context, request)
 
+    return wrapped
 
-def compression_tween_factory(handler, registry):
-    def compression_tween(request):
-        response = handler(request)
 
-        # We use a response callback so compression is applied last
-        # after all of the other callbacks and tweens are called.
-        request.add_response_callback(_compressor)
-        return response
-    return compression_tween
+compression_view.options = {'compress'}
@@ -0,0 +1,135 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+import typing
+import urllib.parse
+import redis
+
+__all__ = [
+    'InstrumentedConnectionPool', 'configure', 'get_connection_pool', 'pool_metrics'
+]
+
+logger = logging.getLogger(__name__)
+
+_pools = {}
+_pool_options = {}
+_pools_lock = threading.Lock()
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """A bounded connection pool that records how it is being used.
+
+    Once ``max_connections`` are checked out callers wait up to
+    ``timeout`` seconds for one to be released instead of opening
+    more connections to redis.
+    """
+    def reset(self):
+        self._metrics_lock = threading.Lock()
+        self._started = time.monotonic()
+        self._in_use = 0
+        self._created = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        super().reset()
+
+    def make_connection(self):
+        with self._metrics_lock:
+            self._created += 1
+        return super().make_connection()
+
+    def get_connection(self, *args, **options):
+        # Newer versions of redis-py no longer pass the command name.
+        start = time.monotonic()
+        connection = super().get_connection(*args, **options)
+        waited = time.monotonic() - start
+
+        with self._metrics_lock:
+            self._in_use += 1
+            self._waits += 1
+            self._wait_time += waited
+        return connection
+
+    def release(self, connection):
+        if connection.pid == self.pid:
+            with self._metrics_lock:
+                self._in_use = max(0, self._in_use - 1)
+        super().release(connection)
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        with self._metrics_lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                'max_connections': self.max_connections,
+                'in_use': self._in_use,
+                'idle': max(0, len(self._connections) - self._in_use),
+                'created': self._created,
+                'creation_rate': self._created / elapsed if elapsed else 0.0,
+                'wait_time': self._wait_time,
+                'average_wait_time': self._wait_time / self._waits if self._waits else 0.0
+            }
+
+
+def _redact(url: str) -> str:
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.password is None:
+        return url
+    netloc = parsed.netloc.replace(f':{parsed.password}@', ':***@')
+    return urllib.parse.urlunsplit(parsed._replace(netloc=netloc))
+
+
+def configure(**options):
+    """Sets the options every connection pool in this process is created
+    with. Pools that already exist keep the options they were created with.
+    """
+    with _pools_lock:
+        _pool_options.clear()
+        _pool_options.update(options)
+
+
+def get_connection_pool(url: str, **options) -> InstrumentedConnectionPool:
+    """Gets the connection pool for a redis URL, creating it with the
+    options given to :func:`configure` if this process doesn't have a
+    pool for it yet.
+
+    Everything in the process connecting to the same URL shares one pool
+    so the number of connections a worker makes to redis stays bounded.
+    Options given here override the process wide ones but only when the
+    pool is created, so a warning is logged if they're ignored.
+    """
+    with _pools_lock:
+        pool = _pools.get(url)
+        if pool is None:
+            pool_options = {**_pool_options, **options}
+            pool = InstrumentedConnectionPool.from_url(url, **pool_options)
+            pool.options = pool_options
+            _pools[url] = pool
+        else:
+            ignored = {name: value for name, value in options.items()
+                       if pool.options.get(name) != value}
+            if ignored:
+                logger.warning(
+                    'Connection pool for %s already exists, ignoring options %r',
+                    _redact(url), ignored
+                )
+        return pool
+
+
+def pool_metrics() -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """Returns the metrics of every connection pool in this process."""
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {_redact(url): pool.metrics() for url, pool in pools}
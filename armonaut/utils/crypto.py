@@ -14,37 +14,166 @@
 
 import os
 import base64
+import calendar
+import collections
 import hashlib
+import hmac
+import threading
 from itsdangerous import (
     BadData, SignatureExpired,
     BadSignature, Signer as _Signer,
     TimestampSigner as _TimestampSigner,
     URLSafeSerializer as _URLSafeSerializer
 )
+from itsdangerous.signer import HMACAlgorithm as _HMACAlgorithm
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # pragma: no cover
+    Fernet = None
 
 __all__ = [
     'BadSignature', 'BadData', 'SignatureExpired',
     'Signer', 'TimestampSigner', 'URLSafeSerializer',
-    'random_token'
+    'Encrypter', 'random_token'
 ]
 
 
-def random_token() -> str:
-    """Generates a random URL-safe token.
+def random_token(nbytes: int=32) -> str:
+    """Generates a random URL-safe token from ``nbytes`` of randomness.
     """
-    token = base64.urlsafe_b64encode(os.urandom(32)).decode('utf-8').rstrip('=')
+    token = base64.urlsafe_b64encode(os.urandom(nbytes)).decode('utf-8').rstrip('=')
     return token
 
 
-class Signer(_Signer):
+class HMACAlgorithm(_HMACAlgorithm):
+    """HMAC signing algorithm that keeps a keyed HMAC object per key
+    and copies it for each signature instead of re-keying every time.
+    """
+    def __init__(self, digest_method=None):
+        super().__init__(digest_method)
+        self._macs = {}
+
+    def get_signature(self, key: bytes, value: bytes) -> bytes:
+        mac = self._macs.get(key)
+        if mac is None:
+            mac = self._macs[key] = hmac.new(key, digestmod=self.digest_method)
+        mac = mac.copy()
+        mac.update(value)
+        return mac.digest()
+
+
+class _CachedKeyMixin:
+    """Derives the signing key once per secret key rather than on
+    every call to ``sign()`` and ``unsign()``.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._derived_keys = {}
+        if type(self.algorithm) is _HMACAlgorithm:
+            self.algorithm = HMACAlgorithm(self.algorithm.digest_method)
+
+    def derive_key(self, secret_key=None) -> bytes:
+        if secret_key is None:
+            secret_key = self.secret_keys[-1]
+        key = self._derived_keys.get(secret_key)
+        if key is None:
+            key = self._derived_keys[secret_key] = super().derive_key(secret_key)
+        return key
+
+
+class Signer(_CachedKeyMixin, _Signer):
     default_digest_method = hashlib.sha512
     default_key_derivation = 'hmac'
 
 
-class TimestampSigner(_TimestampSigner):
+class TimestampSigner(_CachedKeyMixin, _TimestampSigner):
+    """Timestamp signer that can remember up to ``cache_size`` recently
+    verified values. Verifying one of those again skips the HMAC and
+    only checks ``max_age`` against the remembered timestamp.
+    """
     default_digest_method = hashlib.sha512
     default_key_derivation = 'hmac'
 
+    def __init__(self, *args, cache_size: int=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_size = cache_size
+        self._verified = collections.OrderedDict()
+        self._verified_lock = threading.Lock()
+
+    def unsign(self, signed_value, max_age=None, return_timestamp=False):
+        if not self.cache_size:
+            return super().unsign(signed_value, max_age=max_age,
+                                  return_timestamp=return_timestamp)
+
+        if isinstance(signed_value, str):
+            signed_value = signed_value.encode('utf-8')
+
+        with self._verified_lock:
+            verified = self._verified.get(signed_value)
+            if verified is not None:
+                self._verified.move_to_end(signed_value)
+
+        # Only values with a valid signature are ever remembered so a
+        # hit on the exact same bytes is as good as checking the HMAC.
+        if verified is None:
+            value, signed_at = super().unsign(signed_value, return_timestamp=True)
+            verified = (value, calendar.timegm(signed_at.utctimetuple()))
+            with self._verified_lock:
+                self._verified[signed_value] = verified
+                while len(self._verified) > self.cache_size:
+                    self._verified.popitem(last=False)
+
+        value, timestamp = verified
+        if max_age is not None:
+            age = self.get_timestamp() - timestamp
+            if age > max_age:
+                message = f'Signature age {age} > {max_age} seconds'
+            elif age < 0:
+                message = f'Signature age {age} < 0 seconds'
+            else:
+                message = None
+            if message is not None:
+                raise SignatureExpired(
+                    message,
+                    payload=value,
+                    date_signed=self.timestamp_to_datetime(timestamp)
+                )
+
+        if return_timestamp:
+            return value, self.timestamp_to_datetime(timestamp)
+        return value
+
 
 class URLSafeSerializer(_URLSafeSerializer):
     default_signer = TimestampSigner
+
+    def make_signer(self, salt=None):
+        # Reusing the signer per salt keeps its derived keys around.
+        signers = self.__dict__.setdefault('_signers', {})
+        signer = signers.get(salt)
+        if signer is None:
+            signer = signers[salt] = super().make_signer(salt)
+        return signer
+
+
+class Encrypter:
+    """Encrypts values with a key derived from a secret and a salt.
+
+    Requires the optional ``cryptography`` package.
+    """
+    def __init__(self, secret: str, salt: str):
+        if Fernet is None:
+            raise RuntimeError('The cryptography package is required for encryption')
+
+        key = hmac.new(secret.encode('utf-8'), salt.encode('utf-8'), hashlib.sha256).digest()
+        self._fernet = Fernet(base64.urlsafe_b64encode(key))
+
+    def encrypt(self, value: bytes) -> bytes:
+        return self._fernet.encrypt(value)
+
+    def decrypt(self, token: bytes) -> bytes:
+        try:
+            return self._fernet.decrypt(token)
+        except InvalidToken:
+            raise BadData('Unable to decrypt value')
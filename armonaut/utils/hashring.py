@@ -0,0 +1,50 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import hashlib
+import typing
+
+__all__ = ['HashRing']
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping keys onto a set of nodes.
+
+    Each node is placed on the ring ``replicas`` times so that keys are
+    spread evenly and adding or removing a node only moves the keys
+    that belong to it, about ``1 / len(nodes)`` of them.
+    """
+    def __init__(self, nodes: typing.Iterable[str], replicas: int=160):
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise ValueError('A hash ring requires at least one node')
+
+        points = sorted(
+            (_hash(f'{node}#{i}'), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, _hash(key))
+        if index == len(self._hashes):
+            index = 0
+        return self._nodes[index]
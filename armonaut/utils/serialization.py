@@ -0,0 +1,134 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import typing
+import zlib
+import msgpack
+import msgpack.exceptions
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+__all__ = [
+    'SerializationError', 'MsgpackSerializer', 'CompactSerializer',
+    'INTERNED_KEYS', 'COMPRESSIONS', 'SERIALIZERS'
+]
+
+# Well-known keys that are stored as small integer tags. Payloads
+# refer to keys by their index so this tuple must only be appended to.
+INTERNED_KEYS = ('_csrf_token', '_flash_messages')
+_INTERNED_TAGS = {key: tag for tag, key in enumerate(INTERNED_KEYS)}
+
+# 0xC1 is never used by msgpack so payloads that start with it
+# can't be confused with payloads that were written without a header.
+_HEADER = 0xC1
+_FLAG_INTERNED = 0x10
+_CODEC_MASK = 0x0F
+
+COMPRESSIONS = {'zlib': 1}
+_compressors = {1: (lambda data: zlib.compress(data, 1), zlib.decompress)}
+if lz4 is not None:
+    COMPRESSIONS['lz4'] = 2
+    _compressors[2] = (lz4.frame.compress, lz4.frame.decompress)
+
+
+class SerializationError(ValueError):
+    pass
+
+
+class MsgpackSerializer:
+    """Serializes values with msgpack.
+
+    Payloads larger than ``threshold`` bytes are compressed when a
+    ``compression`` is given and ``intern_keys`` replaces the well-known
+    keys of a dictionary with string keys by integer tags. Either adds a two byte header
+    to the payload. Every serializer can load every payload, so switching
+    between serializers doesn't invalidate data that's already stored.
+    """
+    def __init__(self,
+                 compression: typing.Optional[str]=None,
+                 threshold: int=1024,
+                 intern_keys: bool=False):
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression!r}')
+
+        self.codec = COMPRESSIONS.get(compression, 0)
+        self.threshold = threshold
+        self.intern_keys = intern_keys
+
+    def dumps(self, value: typing.Any) -> bytes:
+        flags = 0
+        # Integer tags could be confused with integer keys so only
+        # dictionaries with string keys are interned.
+        if (self.intern_keys and isinstance(value, dict) and
+                all(isinstance(k, str) for k in value)):
+            value = {_INTERNED_TAGS.get(k, k): v for k, v in value.items()}
+            flags |= _FLAG_INTERNED
+
+        data = msgpack.packb(value, encoding='utf-8', use_bin_type=True)
+
+        if self.codec and len(data) > self.threshold:
+            data = _compressors[self.codec][0](data)
+            flags |= self.codec
+
+        if not flags:
+            return data
+        return bytes((_HEADER, flags)) + data
+
+    def loads(self, data: bytes) -> typing.Any:
+        try:
+            flags = 0
+            if data[:1] == b'\xc1':
+                flags = data[1]
+                data = data[2:]
+                if flags & _CODEC_MASK:
+                    data = _compressors[flags & _CODEC_MASK][1](data)
+
+            value = msgpack.unpackb(data, encoding='utf-8', use_list=True)
+
+            if flags & _FLAG_INTERNED:
+                value = {
+                    INTERNED_KEYS[k] if isinstance(k, int) else k: v
+                    for k, v in value.items()
+                }
+            return value
+
+        except (msgpack.exceptions.UnpackException,
+                msgpack.exceptions.ExtraData,
+                ValueError, KeyError, IndexError,
+                AttributeError, zlib.error, RuntimeError) as e:
+            raise SerializationError(str(e)) from e
+
+
+class CompactSerializer(MsgpackSerializer):
+    """Serializer that interns well-known keys and compresses
+    payloads larger than ``threshold`` bytes with zlib by default.
+    """
+    def __init__(self,
+                 compression: typing.Optional[str]='zlib',
+                 threshold: int=1024,
+                 intern_keys: bool=True):
+        super().__init__(
+            compression=compression,
+            threshold=threshold,
+            intern_keys=intern_keys
+        )
+
+
+SERIALIZERS = {
+    'msgpack': MsgpackSerializer,
+    'compact': CompactSerializer
+}
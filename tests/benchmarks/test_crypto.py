@@ -0,0 +1,45 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import timeit
+from itsdangerous import TimestampSigner as _TimestampSigner
+from armonaut.utils import crypto
+from ..common import requires_benchmarks
+
+ITERATIONS = 20000
+
+
+@requires_benchmarks
+def test_benchmark_session_cookie_unsign():
+    signers = {
+        # What every request paid before: a key derivation and a fresh HMAC.
+        'itsdangerous': _TimestampSigner(
+            'secret', salt='session', digest_method=hashlib.sha512, key_derivation='hmac'
+        ),
+        'cached key': crypto.TimestampSigner('secret', salt='session'),
+        'cached verify': crypto.TimestampSigner('secret', salt='session', cache_size=1024)
+    }
+    cookie = signers['itsdangerous'].sign(b'N2bS4sSXOHAl89wtOHJpvAKemq8-S6aHniRDcEWKZr0.a1b2c3d4')
+    results = {}
+
+    for name, signer in signers.items():
+        results[name] = timeit.timeit(
+            lambda: signer.unsign(cookie, max_age=43200, return_timestamp=True),
+            number=ITERATIONS
+        )
+        print(f'\n{name:>14}: {results[name] * 1e6 / ITERATIONS:6.2f}us/unsign', end='')
+
+    assert results['cached key'] < results['itsdangerous']
+    assert results['cached verify'] < results['cached key']
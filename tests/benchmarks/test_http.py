@@ -0,0 +1,139 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import collections.abc
+import hashlib
+import time
+from pyramid.request import Request
+from pyramid.response import Response
+from armonaut.cache.http import ResponseFinaliser, add_vary
+from ..common import requires_benchmarks
+
+ITERATIONS = 20000
+
+
+def _responses():
+    # A small page the policy won't compress so only the overhead is measured.
+    responses = []
+    for _ in range(ITERATIONS):
+        response = Response(body=b'<p>ok</p>', content_type='text/html')
+        response.etag = 'abc'
+        responses.append(response)
+    return responses
+
+
+# What every request paid before: a closure per add_vary, the ETag
+# checked in a tween and the compressor in another callback.
+
+def _add_vary_callback(*varies):
+    def wrapped(request, response):
+        vary = set(response.vary if response.vary is not None else [])
+        vary |= set(varies)
+        response.vary = vary
+    return wrapped
+
+
+def _conditional_http(request, response):
+    if response.last_modified is not None:
+        response.conditional_response = True
+
+    if response.etag is not None:
+        response.conditional_response = True
+
+    elif response.status_code == 200 and request.method in {'GET', 'HEAD'}:
+        streaming = not isinstance(response.app_iter, collections.abc.Sequence)
+        if (streaming and response.content_length is not None and
+                response.content_length <= 1024 * 1024):
+            _ = response.body  # noqa
+            streaming = False
+
+        if not streaming:
+            response.conditional_response = True
+            response.md5_etag()
+
+
+def _compressor(request, response):
+    if (response.vary is not None and
+            set(response.vary) & {'Cookie', 'Authorization'}):
+        return
+
+    if 'Content-Encoding' in response.headers:
+        return
+
+    vary = set(response.vary if response.vary is not None else [])
+    vary.add('Accept-Encoding')
+    response.vary = vary
+
+    target_encoding = request.accept_encoding.best_match(
+        ['identity', 'br', 'gzip'],
+        default_match='identity'
+    )
+
+    streaming = not isinstance(response.app_iter, collections.abc.Sequence)
+    if (streaming and response.content_length is not None and
+            response.content_length < 1024 * 1024):
+        _ = response.body  # noqa
+        streaming = False
+
+    if streaming:
+        response.encode_content(encoding=target_encoding, lazy=True)
+        response.content_length = None
+        if response.etag is not None:
+            md5_digest = hashlib.md5((response.etag + ';gzip').encode('utf-8'))
+            md5_digest = base64.b64encode(md5_digest.digest()).replace(b'\n', b'').decode('utf-8')
+            response.etag = md5_digest.rstrip('=')
+
+    else:
+        original_length = len(response.body)
+        response.encode_content(encoding=target_encoding, lazy=False)
+        if original_length < len(response.body):
+            response.decode_content()
+        if response.content_encoding is not None:
+            response.md5_etag()
+
+
+def _before(request, response):
+    callbacks = [_add_vary_callback('Accept-Language')]
+    _conditional_http(request, response)
+    callbacks.append(_compressor)
+
+    for callback in callbacks:
+        callback(request, response)
+
+
+def _finaliser():
+    view = add_vary('Accept-Language')(lambda context, request: None)
+    finaliser = ResponseFinaliser()
+
+    def finalise(request, response):
+        view(None, request)
+        finaliser(request, response)
+    return finalise
+
+
+@requires_benchmarks
+def test_benchmark_response_finalisation():
+    request = Request.blank('/', headers={'Accept-Encoding': 'gzip'})
+    results = {}
+
+    for name, finalise in [('before', _before), ('finaliser', _finaliser())]:
+        responses = _responses()
+        start = time.perf_counter()
+        for response in responses:
+            finalise(request, response)
+        results[name] = time.perf_counter() - start
+        print(f'\n{name:>10}: {results[name] * 1e6 / ITERATIONS:6.2f}us/response', end='')
+
+    assert results['finaliser'] < results['before']
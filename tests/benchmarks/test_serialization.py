@@ -0,0 +1,137 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import timeit
+import pytest
+from kombu import compression, serialization as kombu_serialization
+from armonaut import tasks
+from armonaut.utils import serialization
+from armonaut.utils.serialization import CompactSerializer, MsgpackSerializer
+from ..common import requires_benchmarks
+
+ITERATIONS = 2000
+
+SESSIONS = {
+    'anonymous': {
+        '_csrf_token': 'N2bS4sSXOHAl89wtOHJpvAKemq8-S6aHniRDcEWKZr0'
+    },
+    'flash': {
+        '_csrf_token': 'N2bS4sSXOHAl89wtOHJpvAKemq8-S6aHniRDcEWKZr0',
+        '_flash_messages': ['Your project has been created.'],
+        '_flash_messages.error': ['The build for Armonaut/Armonaut#12 failed.'],
+        'user_id': 1024
+    },
+    'dashboard': {
+        '_csrf_token': 'N2bS4sSXOHAl89wtOHJpvAKemq8-S6aHniRDcEWKZr0',
+        '_flash_messages': [],
+        'user_id': 1024,
+        'recent_projects': [f'Armonaut/project-{i}' for i in range(50)],
+        'build_filters': {'branch': 'master', 'status': ['failed', 'errored'], 'limit': 25},
+        'dismissed_notices': list(range(100))
+    }
+}
+
+SERIALIZERS = {
+    'msgpack': MsgpackSerializer(),
+    'compact': CompactSerializer(),
+    'compact+zlib>256': CompactSerializer(threshold=256)
+}
+if 'lz4' in serialization.COMPRESSIONS:
+    SERIALIZERS['compact+lz4>256'] = CompactSerializer(compression='lz4', threshold=256)
+
+
+@requires_benchmarks
+@pytest.mark.parametrize('shape', sorted(SESSIONS))
+def test_benchmark_session_serializers(shape):
+    session = SESSIONS[shape]
+    results = {}
+
+    for name, serializer in SERIALIZERS.items():
+        data = serializer.dumps(session)
+        dumps = timeit.timeit(lambda: serializer.dumps(session), number=ITERATIONS)
+        loads = timeit.timeit(lambda: serializer.loads(data), number=ITERATIONS)
+        results[name] = len(data)
+
+        print(f'\n{shape:>10} {name:>18}: {len(data):>5} bytes, '
+              f'dumps {dumps * 1e6 / ITERATIONS:6.2f}us, '
+              f'loads {loads * 1e6 / ITERATIONS:6.2f}us', end='')
+
+    assert results['compact'] <= results['msgpack']
+
+
+# Bodies of the tasks and results a CI service sends most often.
+TASK_PAYLOADS = {
+    'status': ((1024, 'passed'), {'finished_at': '2018-06-01T12:00:00Z'}, {}),
+    'webhook': (
+        ({
+            'ref': 'refs/heads/master',
+            'repository': {'id': 1, 'full_name': 'Armonaut/armonaut', 'private': False},
+            'commits': [{
+                'id': f'{i:040x}',
+                'message': f'Fix the flaky test number {i}',
+                'author': {'name': 'Armonaut', 'email': 'armonaut@example.com'},
+                'modified': ['armonaut/tasks.py', 'tests/unit/test_tasks.py']
+            } for i in range(20)]
+        },),
+        {},
+        {}
+    ),
+    'log': ({'job': 4096, 'log': '\n'.join(f'test_{i} PASSED' for i in range(4000))},)
+}
+
+
+def _gzip_json(body):
+    # What results paid before: JSON with every payload gzipped.
+    content_type, content_encoding, data = kombu_serialization.dumps(body, serializer='json')
+    return compression.compress(data.encode('utf-8'), 'application/x-gzip')[0]
+
+
+def _gunzip_json(data):
+    return kombu_serialization.loads(
+        compression.decompress(data, 'application/x-gzip'), 'application/json', 'binary'
+    )
+
+
+@requires_benchmarks
+@pytest.mark.parametrize('shape', sorted(TASK_PAYLOADS))
+def test_benchmark_task_serializers(shape):
+    tasks.register_serializers()
+    body = TASK_PAYLOADS[shape]
+    codecs = {
+        'json': (
+            lambda body: kombu_serialization.dumps(body, serializer='json')[2],
+            lambda data: kombu_serialization.loads(data, 'application/json', 'utf-8')
+        ),
+        'json+gzip': (_gzip_json, _gunzip_json)
+    }
+    for name in ['armonaut'] + [tasks.serializer_name(name) for name in serialization.COMPRESSIONS]:
+        codecs[name] = (
+            lambda body, name=name: kombu_serialization.dumps(body, serializer=name)[2],
+            lambda data: kombu_serialization.loads(data, tasks.CONTENT_TYPE, 'binary',
+                                                   accept={tasks.CONTENT_TYPE})
+        )
+    results = {}
+
+    for name, (dumps, loads) in codecs.items():
+        data = dumps(body)
+        dumps_time = timeit.timeit(lambda: dumps(body), number=ITERATIONS)
+        loads_time = timeit.timeit(lambda: loads(data), number=ITERATIONS)
+        results[name] = (len(data), dumps_time + loads_time)
+
+        print(f'\n{shape:>8} {name:>14}: {len(data):>6} bytes, '
+              f'dumps {dumps_time * 1e6 / ITERATIONS:7.2f}us, '
+              f'loads {loads_time * 1e6 / ITERATIONS:7.2f}us', end='')
+
+    assert results['armonaut'][0] < results['json'][0]
+    assert results['armonaut+zlib'][1] < results['json+gzip'][1]
@@ -0,0 +1,102 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import fakeredis
+import pretend
+from armonaut.sessions import RedisSessionFactory, Session
+from ..common import requires_benchmarks
+
+# Simulated network round trip to redis.
+LATENCY = 0.0005
+ITERATIONS = 200
+
+
+class LatencyRedis:
+    """Wraps a FakeStrictRedis and adds latency to every round trip."""
+    def __init__(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.round_trips = 0
+
+    def _round_trip(self):
+        self.round_trips += 1
+        time.sleep(LATENCY)
+
+    def pipeline(self):
+        pipeline = self.redis.pipeline()
+        execute = pipeline.execute
+
+        def delayed_execute():
+            self._round_trip()
+            return execute()
+
+        pipeline.execute = delayed_execute
+        return pipeline
+
+    def __getattr__(self, name):
+        self._round_trip()
+        return getattr(self.redis, name)
+
+
+def _login_rotation(factory, request):
+    session = Session({'user': 1}, 'old', False)
+    session.invalidated.update({'older', 'oldest'})
+    session.invalidate()
+    session['user'] = 2
+    request.session = session
+    return session
+
+
+def _sequential_process_response(factory, request, response):
+    # The behaviour before pipelining: one DELETE per invalidated
+    # session and a separate SETEX for the new session.
+    session = request.session
+    for invalid_id in session.invalidated:
+        factory.redis.delete(factory._redis_key(invalid_id))
+    factory.redis.setex(
+        factory._redis_key(session.sid),
+        factory.max_age,
+        factory._pack(session)
+    )
+    factory._set_cookie(request, response, session)
+
+
+@requires_benchmarks
+def test_benchmark_login_rotation(pyramid_request):
+    factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+    factory.redis = LatencyRedis()
+    pyramid_request.scheme = 'https'
+    response = pretend.stub(set_cookie=lambda *a, **kw: None)
+
+    def run(process_response):
+        factory.redis.round_trips = 0
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            _login_rotation(factory, pyramid_request)
+            process_response(pyramid_request, response)
+        return time.perf_counter() - start, factory.redis.round_trips / ITERATIONS
+
+    sequential, sequential_trips = run(
+        lambda request, response: _sequential_process_response(factory, request, response)
+    )
+    pipelined, pipelined_trips = run(factory._process_response)
+
+    print(f'\nsequential: {sequential * 1000 / ITERATIONS:.3f}ms/request '
+          f'({sequential_trips:.0f} round trips)')
+    print(f'pipelined:  {pipelined * 1000 / ITERATIONS:.3f}ms/request '
+          f'({pipelined_trips:.0f} round trips)')
+
+    assert pipelined_trips == 1
+    assert pipelined < sequential
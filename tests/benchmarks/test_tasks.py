@@ -0,0 +1,56 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import pyramid.scripting
+import transaction
+from armonaut.tasks import EnvironmentPool
+from ..common import requires_benchmarks
+
+ITERATIONS = 2000
+
+
+def _task(request):
+    # A small task touches the request and runs in a transaction.
+    with request.tm:
+        return request.registry.settings['armonaut.env']
+
+
+@requires_benchmarks
+def test_benchmark_task_environment(app_config):
+    registry = app_config.registry
+    pool = EnvironmentPool()
+    results = {}
+
+    def prepared():
+        # What every task paid before: a new environment torn down after.
+        env = pyramid.scripting.prepare(registry=registry)
+        env['request'].tm = transaction.TransactionManager(explicit=True)
+        _task(env['request'])
+        env['request']._process_finished_callbacks()
+        env['closer']()
+
+    def pooled():
+        env = pool.acquire(registry)
+        _task(env['request'])
+        pool.release(env)
+
+    for name, run in [('prepare', prepared), ('pool', pooled)]:
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            run()
+        results[name] = ITERATIONS / (time.perf_counter() - start)
+        print(f'\n{name:>8}: {results[name]:8.0f} tasks/s', end='')
+
+    assert results['pool'] > results['prepare']
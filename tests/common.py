@@ -21,3 +21,9 @@ requires_external_services = pytest.mark.skipif(
     reason='Test only runs while external services are available.',
     explcitly=1
 )
+
+
+requires_benchmarks = pytest.mark.skipif(
+    not bool('BENCHMARKS' in os.environ),
+    reason='Benchmarks only run when explicitly requested.'
+)
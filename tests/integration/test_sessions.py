@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import pretend
+from pyramid.interfaces import ISessionFactory
+from webtest import TestApp
 from armonaut.sessions import RedisSessionFactory
 from ..common import requires_external_services
 
@@ -42,3 +44,15 @@ def test_session_added_and_getting_from_redis(app_config, pyramid_request):
 
     session2 = factory(request)
     assert session2['a'] == 1
+
+
+def test_session_less_requests_make_no_redis_calls(app_config):
+    factory = app_config.registry.queryUtility(ISessionFactory)
+    factory.redis = pretend.stub()
+    factory.signer = pretend.stub()
+
+    webtest = TestApp(app_config.make_wsgi_app())
+    webtest.set_cookie('session', 'signed-session-id')
+
+    for _ in range(10):
+        assert webtest.get('/').status_code == 200
@@ -13,7 +13,86 @@
 # limitations under the License.
 
 
+import webtest as _webtest
+
+
 def test_simple_index(webtest):
     resp = webtest.get('/')
 
     assert resp.status_code == 200
+
+
+def test_static_asset(webtest):
+    index = webtest.get('/')
+    resp = webtest.get('/static/css/armonaut.css')
+
+    assert 'http://localhost/static/css/armonaut.css' in index.text
+    assert resp.status_code == 200
+    assert resp.content_type == 'text/css'
+
+
+def test_conditional_view(app_config):
+    renders = []
+
+    def polled(request):
+        renders.append(request)
+        return 'status: passed'
+
+    app_config.add_route('polled', '/polled')
+    app_config.add_view(polled, route_name='polled', renderer='string',
+                        validator=lambda context, request: 'build-1')
+    webtest = _webtest.TestApp(app_config.make_wsgi_app())
+
+    resp = webtest.get('/polled')
+    not_modified = webtest.get('/polled', headers={'If-None-Match': resp.headers['ETag']},
+                               status=304)
+
+    assert resp.text == 'status: passed'
+    assert not_modified.headers['ETag'] == resp.headers['ETag']
+    assert len(renders) == 1
+
+
+def test_page_cache(app_config):
+    renders = []
+
+    def badge(request):
+        renders.append(request)
+        request.response.cache_control = 'public, max-age=60'
+        return 'passing'
+
+    app_config.add_route('badge', '/badge')
+    app_config.add_view(badge, route_name='badge', renderer='string')
+    webtest = _webtest.TestApp(app_config.make_wsgi_app())
+
+    first = webtest.get('/badge')
+    second = webtest.get('/badge')
+
+    assert first.text == second.text == 'passing'
+    assert second.headers['X-Cache'] == 'HIT'
+    assert len(renders) == 1
+
+
+def test_cache_policy(app_config):
+    renders = []
+
+    def project(request):
+        renders.append(request)
+        if request.method == 'POST':
+            request.purge_cache(f'project/{request.matchdict["name"]}')
+        return 'armonaut'
+
+    app_config.add_route('project', '/projects/{name}')
+    app_config.add_view(project, route_name='project', renderer='string', request_method='GET',
+                        max_age=60, s_maxage=300, surrogate_keys=['project/{name}'])
+    app_config.add_view(project, route_name='project', renderer='string', request_method='POST')
+    webtest = _webtest.TestApp(app_config.make_wsgi_app())
+
+    first = webtest.get('/projects/armonaut')
+    webtest.post('/projects/armonaut')
+    second = webtest.get('/projects/armonaut')
+
+    assert first.headers['Surrogate-Key'] == 'project/armonaut'
+    assert first.headers['Surrogate-Control'] == 'max-age=300'
+    assert 'X-Cache' not in second.headers
+    assert len(renders) == 3
+    assert list(app_config.registry['cache.purger'].purged) == ['project/armonaut']
@@ -0,0 +1,143 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fakeredis
+import pretend
+import pytest
+import redis
+from pyramid.request import Request
+from pyramid.response import Response
+from armonaut.cache.compressed import CompressedResponseCache
+from armonaut.utils import connections
+
+
+def test_cache_get_and_set():
+    cache = CompressedResponseCache()
+
+    assert cache.get('key', 'gzip') is None
+    cache.set('key', 'gzip', b'body', 'etag')
+
+    assert cache.get('key', 'gzip') == (b'body', 'etag')
+    assert cache.get('key', 'br') is None
+    assert cache.metrics() == {
+        'entries': 1,
+        'bytes': 4,
+        'hits': 1,
+        'redis_hits': 0,
+        'misses': 2,
+        'evictions': 0,
+        'hit_rate': 1 / 3
+    }
+
+
+def test_cache_evicts_by_size():
+    cache = CompressedResponseCache(max_bytes=10)
+    cache.set('a', 'gzip', b'x' * 4, 'a')
+    cache.set('b', 'gzip', b'x' * 4, 'b')
+    cache.get('a', 'gzip')
+    cache.set('c', 'gzip', b'x' * 4, 'c')
+
+    assert cache.get('b', 'gzip') is None
+    assert cache.get('a', 'gzip') is not None
+    assert cache.get('c', 'gzip') is not None
+    assert cache.bytes == 8
+    assert cache.evictions == 1
+
+
+def test_cache_replaces_entry():
+    cache = CompressedResponseCache()
+    cache.set('a', 'gzip', b'x' * 4, 'a')
+    cache.set('a', 'gzip', b'x' * 2, 'b')
+
+    assert cache.get('a', 'gzip') == (b'xx', 'b')
+    assert cache.bytes == 2
+
+
+def test_cache_skips_large_entries():
+    cache = CompressedResponseCache(max_entry_bytes=3)
+    cache.set('a', 'gzip', b'x' * 4, 'a')
+
+    assert cache.get('a', 'gzip') is None
+
+
+def test_cache_redis_tier(monkeypatch):
+    monkeypatch.setattr(connections, 'get_connection_pool', lambda url: None)
+    shared = fakeredis.FakeStrictRedis()
+    shared.flushall()
+
+    first = CompressedResponseCache(url='redis://localhost:6379/0')
+    second = CompressedResponseCache(url='redis://localhost:6379/0')
+    first.redis = second.redis = shared
+
+    first.set('a', 'gzip', b'body\nwith newline', 'etag')
+
+    assert second.get('a', 'gzip') == (b'body\nwith newline', 'etag')
+    assert second.get('a', 'gzip') == (b'body\nwith newline', 'etag')
+    assert (second.redis_hits, second.hits) == (1, 1)
+    assert shared.ttl('armonaut/compressed/gzip/a') > 0
+
+
+def test_cache_redis_unavailable(monkeypatch):
+    monkeypatch.setattr(connections, 'get_connection_pool', lambda url: None)
+    cache = CompressedResponseCache(url='redis://localhost:6379/0')
+
+    def unavailable(*args):
+        raise redis.ConnectionError()
+
+    cache.redis = pretend.stub(get=unavailable, setex=unavailable)
+    cache.set('a', 'gzip', b'body', 'etag')
+
+    assert cache.get('b', 'gzip') is None
+    assert cache.get('a', 'gzip') == (b'body', 'etag')
+
+
+@pytest.mark.parametrize(
+    ['method', 'status', 'headers', 'cacheable'],
+    [
+        ('GET', 200, {}, True),
+        ('HEAD', 200, {}, True),
+        ('POST', 200, {}, False),
+        ('GET', 404, {}, False),
+        ('GET', 200, {'Cache-Control': 'no-store'}, False),
+        ('GET', 200, {'Cache-Control': 'private, max-age=60'}, False)
+    ]
+)
+def test_cache_key_cacheable(method, status, headers, cacheable):
+    request = Request.blank('/', method=method)
+    response = Response(body=b'body', status=status)
+    response.headers.update(headers)
+
+    assert (CompressedResponseCache.key(request, response) is not None) is cacheable
+
+
+def test_cache_key():
+    def key(path, body, request_headers=None, **headers):
+        response = Response(body=body)
+        response.headers.update(headers)
+        return CompressedResponseCache.key(Request.blank(path, headers=request_headers), response)
+
+    assert key('/', b'a') == key('/other', b'a')
+    assert key('/', b'a') != key('/', b'b')
+    assert key('/', b'a', ETag='"1"') == key('/', b'b', ETag='"1"')
+    assert key('/', b'a', ETag='"1"') != key('/other', b'a', ETag='"1"')
+    assert key('/', b'a', ETag='W/"1"') == key('/', b'a')
+
+    def varied(language, vary='Accept-Language, Accept-Encoding'):
+        return key('/', b'a', {'Accept-Language': language, 'Accept-Encoding': 'gzip'},
+                   ETag='"1"', Vary=vary)
+
+    assert varied('en') == varied('en')
+    assert varied('en') != varied('fr')
+    assert varied('en', 'Accept-Encoding') == key('/', b'a', ETag='"1"')
+    assert varied('en', '*') is None
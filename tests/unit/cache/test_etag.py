@@ -0,0 +1,75 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pretend
+import pytest
+from pyramid.response import Response
+from armonaut.cache import etag
+
+
+def test_etag_hasher_is_incremental():
+    hasher = etag.ETagHasher()
+    for chunk in [b'a', b'bc', b'']:
+        hasher.update(chunk)
+
+    assert hasher.etag() == etag.body_etag(b'abc')
+    assert etag.body_etag(b'abc') != etag.body_etag(b'abd')
+    assert len(etag.body_etag(b'abc')) == 22
+
+
+def test_version_etag():
+    assert etag.version_etag('project', 1) == etag.version_etag('project', 1)
+    assert etag.version_etag('project', 1) != etag.version_etag('project', 2)
+    assert etag.version_etag('a', 'bc') != etag.version_etag('ab', 'c')
+
+
+def test_set_body_etag():
+    response = Response(app_iter=[b'a', b'bc'])
+
+    etag.set_body_etag(response)
+
+    assert response.etag == etag.body_etag(b'abc')
+
+
+def test_set_body_etag_streaming():
+    app_iter = pretend.stub(
+        __iter__=lambda: iter([b'a', b'bc']),
+        close=pretend.call_recorder(lambda: None)
+    )
+    response = Response(app_iter=app_iter, content_length=3)
+
+    etag.set_body_etag(response)
+
+    assert response.etag == etag.body_etag(b'abc')
+    assert response.body == b'abc'
+    assert response.content_length == 3
+    assert app_iter.close.calls == [pretend.call()]
+
+
+@pytest.mark.parametrize(
+    ['header', 'expected'],
+    [
+        ('"abc"', '"abc-gzip"'),
+        ('W/"abc"', 'W/"abc-gzip"'),
+        (None, None)
+    ]
+)
+def test_set_encoded_etag(header, expected):
+    response = Response()
+    if header is not None:
+        response.headers['ETag'] = header
+
+    etag.set_encoded_etag(response, 'gzip')
+
+    assert response.headers.get('ETag') == expected
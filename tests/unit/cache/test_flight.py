@@ -0,0 +1,320 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import fakeredis
+import pretend
+import pytest
+from pyramid.exceptions import ConfigurationError
+from pyramid.request import Request
+from pyramid.response import Response
+from armonaut.cache import flight
+from armonaut.cache.flight import SingleFlight, single_flight_view
+from armonaut.utils import connections
+
+
+def _compute(body=b'page', **kwargs):
+    return pretend.call_recorder(lambda: Response(body=body, **kwargs))
+
+
+def test_run_computes_and_keeps_result():
+    single = SingleFlight()
+    compute = _compute()
+
+    response = single.run('key', compute)
+
+    assert response.body == b'page'
+    assert len(compute.calls) == 1
+    assert single._get('key')['body'] == b'page'
+    assert single.metrics() == {'entries': 1, 'computed': 1, 'shared': 0, 'stale': 0}
+    assert len(single._flights) == 0
+
+
+@pytest.mark.parametrize(
+    'response',
+    [
+        Response(body=b'missing', status=404),
+        Response(body=b'page', headerlist=[('Set-Cookie', 'session=1')]),
+        Response(app_iter=iter([b'page']))
+    ]
+)
+def test_run_doesnt_keep_unshareable(response):
+    single = SingleFlight()
+
+    assert single.run('key', lambda: response) is response
+    assert single._get('key') is None
+
+
+def test_run_serves_stale_while_computing():
+    single = SingleFlight()
+    single.run('key', _compute(body=b'old'))
+    started = threading.Event()
+    finish = threading.Event()
+
+    def slow():
+        started.set()
+        finish.wait(1)
+        return Response(body=b'new')
+
+    thread = threading.Thread(target=single.run, args=('key', slow))
+    thread.start()
+    started.wait(1)
+    compute = _compute()
+    stale = single.run('key', compute)
+    finish.set()
+    thread.join()
+
+    assert stale.body == b'old'
+    assert 'Age' in stale.headers
+    assert compute.calls == []
+    assert single._get('key')['body'] == b'new'
+    assert single.metrics()['stale'] == 1
+
+
+def test_run_coalesces_threads():
+    single = SingleFlight()
+    started = threading.Event()
+    compute = pretend.call_recorder(lambda: started.set() or time.sleep(0.05) or
+                                    Response(body=b'leader'))
+    results = []
+
+    def run():
+        results.append(single.run('key', compute).body)
+
+    leader = threading.Thread(target=run)
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(target=run) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert results == [b'leader'] * 5
+    assert len(compute.calls) == 1
+    assert single.metrics()['shared'] == 4
+
+
+def test_run_computes_after_failed_leader():
+    single = SingleFlight()
+
+    def fail():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        single.run('key', fail)
+
+    assert single.run('key', _compute()).body == b'page'
+
+
+def test_run_computes_after_wait_timeout():
+    single = SingleFlight(wait_timeout=0.01)
+    single._flights['key'] = flight._Flight()
+    compute = _compute()
+
+    assert single.run('key', compute).body == b'page'
+    assert len(compute.calls) == 1
+
+
+def test_run_computes_unshareable_in_parallel():
+    single = SingleFlight()
+    started = threading.Event()
+
+    def missing():
+        started.set()
+        time.sleep(0.2)
+        return Response(body=b'missing', status=404)
+
+    leader = threading.Thread(target=single.run, args=('key', missing))
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(target=single.run, args=('key', missing))
+                 for _ in range(4)]
+    begun = time.time()
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert time.time() - begun < 0.6
+    assert single.metrics()['computed'] == 5
+    assert len(single._flights) == 0
+
+
+def _redis_flights(monkeypatch, **kwargs):
+    monkeypatch.setattr(connections, 'get_connection_pool', lambda url: None)
+    shared = fakeredis.FakeStrictRedis()
+    shared.flushall()
+    first = SingleFlight(url='redis://localhost:6379/0', **kwargs)
+    second = SingleFlight(url='redis://localhost:6379/0', **kwargs)
+    first.redis = second.redis = shared
+    return first, second
+
+
+def test_redis_lock_released(monkeypatch):
+    first, second = _redis_flights(monkeypatch)
+
+    first.run('key', _compute())
+
+    assert first.redis.keys('armonaut/flight/lock/*') == []
+    assert second._get('key')['body'] == b'page'
+
+
+def test_redis_lock_not_released_when_taken_over(monkeypatch):
+    first, _ = _redis_flights(monkeypatch)
+
+    def compute():
+        first.redis.set(first._lock_key('key'), b'other')
+        return Response(body=b'page')
+
+    first.run('key', compute)
+
+    assert first.redis.get(first._lock_key('key')) == b'other'
+
+
+def test_redis_serves_stale_from_other_process(monkeypatch):
+    first, second = _redis_flights(monkeypatch)
+    first.run('key', _compute(body=b'old'))
+    first._results.clear()
+    second._results.clear()
+    first.redis.set(first._lock_key('key'), b'other')
+    compute = _compute()
+
+    response = second.run('key', compute)
+
+    assert response.body == b'old'
+    assert compute.calls == []
+
+
+def test_redis_waits_for_other_process(monkeypatch):
+    first, second = _redis_flights(monkeypatch, poll_interval=0.01)
+    token = first._acquire('key')
+
+    def leader():
+        time.sleep(0.05)
+        first._set('key', Response(body=b'leader'))
+        first._release('key', token)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    compute = _compute()
+    response = second.run('key', compute)
+    thread.join()
+
+    assert response.body == b'leader'
+    assert compute.calls == []
+
+
+def test_redis_computes_when_other_process_gives_up(monkeypatch):
+    first, second = _redis_flights(monkeypatch, poll_interval=0.01)
+    token = first._acquire('key')
+
+    def leader():
+        time.sleep(0.05)
+        first._release('key', token)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    compute = _compute()
+    response = second.run('key', compute)
+    thread.join()
+
+    assert response.body == b'page'
+    assert len(compute.calls) == 1
+
+
+def _view(body=b'page'):
+    return pretend.call_recorder(lambda context, request: Response(body=body))
+
+
+def _info(view, **options):
+    return pretend.stub(options=options, exception_only=False, original_view=view)
+
+
+def _request(path='/projects', method='GET', single=None):
+    request = Request.blank(path, method=method)
+    request.registry = {'cache.flight': single or SingleFlight()}
+    return request
+
+
+def test_view_without_option():
+    view = _view()
+
+    assert single_flight_view(view, _info(view)) is view
+
+
+def test_view_coalesces_on_url():
+    view = _view()
+    wrapped = single_flight_view(view, _info(view, single_flight=True))
+    request = _request()
+
+    wrapped(None, request)
+
+    single = request.registry['cache.flight']
+    assert len(view.calls) == 1
+    assert len(single._results) == 1
+
+
+def test_view_key_function():
+    view = _view()
+    key = pretend.call_recorder(lambda context, request: 'project-1')
+    wrapped = single_flight_view(view, _info(view, single_flight=key))
+    single = SingleFlight()
+
+    wrapped(None, _request('/a', single=single))
+    wrapped(None, _request('/b', single=single))
+
+    assert len(key.calls) == 2
+    assert len(single._results) == 1
+
+
+def test_view_using_session_refused():
+    view = _view()
+
+    with pytest.raises(ConfigurationError):
+        single_flight_view(view, _info(view, single_flight=True, uses_session=True))
+
+
+@pytest.mark.parametrize(
+    ['method', 'key'],
+    [
+        ('POST', True),
+        ('GET', lambda context, request: None)
+    ]
+)
+def test_view_not_coalesced(method, key):
+    view = _view()
+    wrapped = single_flight_view(view, _info(view, single_flight=key))
+    request = _request(method=method)
+
+    wrapped(None, request)
+
+    assert len(view.calls) == 1
+    assert request.registry['cache.flight']._results == {}
+
+
+def test_includeme():
+    registry = {}
+    config = pretend.stub(
+        registry=pretend.stub(settings={'single_flight.stale_ttl': 60},
+                              __setitem__=registry.__setitem__),
+        add_view_deriver=pretend.call_recorder(lambda deriver: None)
+    )
+
+    flight.includeme(config)
+
+    assert registry['cache.flight'].stale_ttl == 60
+    assert registry['cache.flight'].redis is None
+    assert config.add_view_deriver.calls == [pretend.call(single_flight_view)]
@@ -12,129 +12,110 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import gzip
 import pytest
 import pretend
+from pyramid.registry import Registry
+from pyramid.request import Request
+from pyramid.response import Response
+from armonaut.cache.compressed import CompressedResponseCache
+from armonaut.cache.etag import body_etag, version_etag
 from armonaut.cache.http import (
-    add_vary, includeme, conditional_http_tween_factory
+    add_vary, includeme, conditional_view, ResponseFinaliser,
+    response_finaliser_tween_factory
 )
 
 
-@pytest.mark.parametrize(
-    'vary',
-    [None,
-     [],
-     ['bar'],
-     ['foo', 'bar'],
-     ['foobar']]
-)
-def test_add_vary(vary):
-    """Assert that the add_vary() directive correctly adds
-    a non-duplicate value to the Vary HTTP header."""
-    class FakeRequest:
-        def __init__(self):
-            self.callbacks = []
+def test_add_vary():
+    view = pretend.call_recorder(lambda context, request: response)
+    request = pretend.stub()
+    response = pretend.stub()
 
-        def add_response_callback(self, callback):
-            self.callbacks.append(callback)
+    assert add_vary('Cookie')(view)(None, request) is response
+    assert request.response_vary == {'Cookie'}
 
-    request = FakeRequest()
-    context = pretend.stub()
-    response = pretend.stub(vary=vary)
+    add_vary('Accept-Language', 'Cookie')(view)(None, request)
+    assert request.response_vary == {'Cookie', 'Accept-Language'}
+    assert len(view.calls) == 2
 
-    def view(context, request):
-        return response
 
-    assert add_vary('foobar')(view)(context, request) is response
-    assert len(request.callbacks) == 1
+def _finalise(response=None, body=b'x' * 1000, method='GET', vary=None,
+              finaliser=None, **headers):
+    request = Request.blank('/', method=method, headers=headers)
+    if vary is not None:
+        request.response_vary = frozenset(vary)
+    if response is None:
+        response = Response(body=body)
+    (finaliser or ResponseFinaliser())(request, response)
+    return response
 
-    request.callbacks[0](request, response)
 
-    if vary is None:
-        vary = []
+@pytest.mark.parametrize(
+    ['header', 'recorded', 'expected'],
+    [
+        (None, None, None),
+        (None, ['Accept-Language'], 'Accept-Language'),
+        ('Origin', ['Accept-Language'], 'Origin, Accept-Language'),
+        ('Origin, Accept-Language', ['Accept-Language'], 'Origin, Accept-Language')
+    ]
+)
+def test_finaliser_adds_vary(header, recorded, expected):
+    response = Response(body=b'data')
+    if header is not None:
+        response.headers['Vary'] = header
 
-    assert response.vary == {'foobar'} | set(vary)
+    _finalise(response, vary=recorded)
 
+    assert response.headers.get('Vary') == expected
+    assert len(response.headers.getall('Vary')) == (expected is not None)
 
-def test_has_last_modified():
-    response = pretend.stub(
-        last_modified=pretend.stub(),
-        status_code=200,
-        etag=None,
-        conditional_response=False,
-        app_iter=iter([b'data']),
-        content_length=None
-    )
-    handler = pretend.call_recorder(lambda request: response)
-    request = pretend.stub(method='GET')
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+def test_finaliser_keeps_validators():
+    response = Response(body=b'data')
+    response.etag = 'abc'
 
-    assert tween(request) is response
-    assert handler.calls == [pretend.call(request)]
+    _finalise(response)
+
+    assert response.etag == 'abc'
     assert response.conditional_response
 
 
-def test_has_etag():
-    response = pretend.stub(
-        last_modified=None,
-        status_code=200,
-        etag='abc',
-        conditional_response=False,
-        app_iter=iter([b'data']),
-        content_length=None
-    )
-    handler = pretend.call_recorder(lambda request: response)
-    request = pretend.stub(method='GET')
+def test_finaliser_has_last_modified():
+    response = Response(app_iter=iter([b'data']))
+    response.last_modified = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    _finalise(response)
 
-    assert tween(request) is response
-    assert handler.calls == [pretend.call(request)]
+    assert response.etag is None
     assert response.conditional_response
 
 
 @pytest.mark.parametrize('method', ['GET', 'HEAD'])
-def test_generate_etag(method):
-    response = pretend.stub(
-        last_modified=None,
-        status_code=200,
-        etag=None,
-        conditional_response=False,
-        app_iter=[b'data'],
-        content_length=4,
-        md5_etag=pretend.call_recorder(lambda: None)
-    )
-    handler = pretend.call_recorder(lambda request: response)
-    request = pretend.stub(method=method)
+def test_finaliser_generates_etag(method):
+    response = Response(app_iter=[b'da', b'ta'])
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    _finalise(response, method=method)
 
-    assert tween(request) is response
-    assert handler.calls == [pretend.call(request)]
     assert response.conditional_response
-    assert response.md5_etag.calls == [pretend.call()]
-
-
-def test_buffered_body():
-    response = pretend.stub(
-        last_modified=None,
-        status_code=200,
-        etag=None,
-        conditional_response=False,
-        app_iter=iter([b'data']),
-        content_length=4,
-        md5_etag=pretend.call_recorder(lambda: None),
-        body=None
+    assert response.etag == body_etag(b'data')
+
+
+def test_finaliser_buffers_body():
+    app_iter = pretend.stub(
+        __iter__=lambda: iter([b'da', b'ta']),
+        close=pretend.call_recorder(lambda: None)
     )
-    handler = pretend.call_recorder(lambda request: response)
-    request = pretend.stub(method='GET')
+    response = Response(app_iter=app_iter)
+    response.content_length = 4
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    _finalise(response)
 
-    assert tween(request) is response
-    assert handler.calls == [pretend.call(request)]
     assert response.conditional_response
-    assert response.md5_etag.calls == [pretend.call()]
+    assert response.etag == body_etag(b'data')
+    assert response.app_iter == [b'da', b'ta']
+    assert response.content_length == 4
+    assert app_iter.close.calls == [pretend.call()]
 
 
 @pytest.mark.parametrize(
@@ -142,31 +123,191 @@ def test_buffered_body():
     [('GET', (1024 * 1024) + 1),
      ('POST', 4)]
 )
-def test_unbuffered_body(method, size):
-    response = pretend.stub(
-        last_modified=None,
-        status_code=200,
-        etag=None,
-        conditional_response=False,
-        app_iter=iter([b'data']),
-        content_length=size,
-        md5_etag=pretend.call_recorder(lambda: None),
-        body=None
-    )
+def test_finaliser_unbuffered_body(method, size):
+    response = Response(app_iter=iter([b'data']))
+    response.content_length = size
+
+    _finalise(response, method=method)
+
+    assert not response.conditional_response
+    assert response.etag is None
+
+
+def test_finaliser_compresses():
+    response = _finalise(**{'Accept-Encoding': 'gzip'})
+
+    assert response.content_encoding == 'gzip'
+    assert response.vary == ('Accept-Encoding',)
+    assert gzip.decompress(response.body) == b'x' * 1000
+    assert response.etag == body_etag(b'x' * 1000) + '-gzip'
+
+
+@pytest.mark.parametrize('recorded', [['Cookie'], ['Authorization']])
+def test_finaliser_does_not_compress_personal(recorded):
+    response = _finalise(vary=recorded, **{'Accept-Encoding': 'gzip'})
+
+    assert response.content_encoding is None
+    assert response.vary == tuple(recorded)
+
+
+def test_finaliser_does_not_compress_encoded():
+    response = Response(body=b'x' * 1000)
+    response.content_encoding = 'gzip'
+
+    _finalise(response, **{'Accept-Encoding': 'gzip'})
+
+    assert response.body == b'x' * 1000
+    assert response.vary is None
+
+
+def test_finaliser_uses_cache():
+    finaliser = ResponseFinaliser(cache=CompressedResponseCache())
+
+    first = _finalise(finaliser=finaliser, **{'Accept-Encoding': 'gzip'})
+    second = _finalise(finaliser=finaliser, **{'Accept-Encoding': 'gzip'})
+
+    assert second.body == first.body
+    assert finaliser.cache.hits == 1
+
+
+def test_finaliser_cache_respects_vary():
+    finaliser = ResponseFinaliser(cache=CompressedResponseCache())
+
+    def finalise(language):
+        response = Response(body=language.encode('utf-8') * 500)
+        response.etag = version_etag('project', 1)
+        return _finalise(response, vary=['Accept-Language'], finaliser=finaliser,
+                         **{'Accept-Encoding': 'gzip', 'Accept-Language': language})
+
+    assert gzip.decompress(finalise('en').body) == b'en' * 500
+    assert gzip.decompress(finalise('fr').body) == b'fr' * 500
+    assert gzip.decompress(finalise('en').body) == b'en' * 500
+    assert finaliser.cache.hits == 1
+
+
+def test_response_finaliser_tween_factory():
+    registry = Registry()
+    registry.settings = {'compression.min_size': 10}
+    request = pretend.stub(add_response_callback=pretend.call_recorder(lambda callback: None))
+    response = pretend.stub()
     handler = pretend.call_recorder(lambda request: response)
-    request = pretend.stub(method=method)
 
-    tween = conditional_http_tween_factory(handler, pretend.stub())
+    tween = response_finaliser_tween_factory(handler, registry)
 
     assert tween(request) is response
     assert handler.calls == [pretend.call(request)]
-    assert not response.conditional_response
-    assert response.md5_etag.calls == []
+    finaliser, = request.add_response_callback.calls[0].args
+    assert isinstance(finaliser, ResponseFinaliser)
+    assert finaliser.policy.min_size == 10
+    assert finaliser.cache is None
+    assert registry['compression.cache'] is None
+
+    # The same finaliser is used for every request.
+    tween(request)
+    assert request.add_response_callback.calls[1].args[0] is finaliser
+
+
+def test_response_finaliser_tween_factory_cache():
+    registry = Registry()
+    registry.settings = {'compression.cache_bytes': 1024}
+
+    response_finaliser_tween_factory(lambda request: None, registry)
+
+    assert registry['compression.cache'].max_bytes == 1024
+    assert registry['compression.cache'].redis is None
 
 
 def test_includeme():
-    config = pretend.stub(add_tween=pretend.call_recorder(lambda _: None))
+    config = pretend.stub(
+        add_tween=pretend.call_recorder(lambda *args, **kwargs: None),
+        add_view_deriver=pretend.call_recorder(lambda _: None)
+    )
 
     includeme(config)
 
-    assert config.add_tween.calls == [pretend.call('armonaut.cache.http.conditional_http_tween_factory')]
+    assert [call.args for call in config.add_tween.calls] == [
+        ('armonaut.cache.http.response_finaliser_tween_factory',)
+    ]
+    assert config.add_view_deriver.calls == [pretend.call(conditional_view)]
+
+
+def _conditional_view(validator, body=b'rendered'):
+    view = pretend.call_recorder(lambda context, request: Response(body=body))
+    return view, conditional_view(view, pretend.stub(options={'validator': validator}))
+
+
+def test_conditional_view_without_validator():
+    view = pretend.stub()
+
+    assert conditional_view(view, pretend.stub(options={})) is view
+    assert conditional_view.options == {'validator'}
+
+
+@pytest.mark.parametrize(
+    ['if_none_match', 'not_modified'],
+    [
+        (None, False),
+        ('"other"', False),
+        ('*', True),
+        (f'"{version_etag(42)}"', True),
+        (f'"other", "{version_etag(42)}-gzip"', True)
+    ]
+)
+def test_conditional_view_etag(if_none_match, not_modified):
+    view, wrapped = _conditional_view(lambda context, request: 42)
+    headers = {'If-None-Match': if_none_match} if if_none_match else {}
+    request = Request.blank('/', headers=headers)
+
+    response = wrapped(None, request)
+
+    assert (response.status_code == 304) is not_modified
+    assert (view.calls == []) is not_modified
+    if not not_modified:
+        assert response.etag == version_etag(42)
+        assert response.conditional_response
+    elif if_none_match != '*':
+        assert response.etag in if_none_match
+
+
+@pytest.mark.parametrize(
+    ['if_modified_since', 'not_modified'],
+    [
+        (None, False),
+        ('Mon, 01 Jan 2018 11:59:59 GMT', False),
+        ('Mon, 01 Jan 2018 12:00:00 GMT', True)
+    ]
+)
+def test_conditional_view_last_modified(if_modified_since, not_modified):
+    last_modified = datetime.datetime(2018, 1, 1, 12, 0, 0, 500)
+    view, wrapped = _conditional_view(lambda context, request: last_modified)
+    headers = {'If-Modified-Since': if_modified_since} if if_modified_since else {}
+    request = Request.blank('/', headers=headers)
+
+    response = wrapped(None, request)
+
+    assert (response.status_code == 304) is not_modified
+    assert (view.calls == []) is not_modified
+    assert response.last_modified == last_modified.replace(
+        microsecond=0, tzinfo=datetime.timezone.utc
+    )
+
+
+def test_conditional_view_if_none_match_wins():
+    last_modified = datetime.datetime(2018, 1, 1)
+    view, wrapped = _conditional_view(lambda context, request: last_modified)
+    request = Request.blank('/', headers={
+        'If-None-Match': '"other"',
+        'If-Modified-Since': 'Mon, 01 Jan 2018 12:00:00 GMT'
+    })
+
+    assert wrapped(None, request).status_code == 200
+
+
+@pytest.mark.parametrize('version', [None, 42])
+def test_conditional_view_unsafe_methods_and_no_version(version):
+    view, wrapped = _conditional_view(lambda context, request: version)
+    method = 'POST' if version is not None else 'GET'
+    request = Request.blank('/', method=method, headers={'If-None-Match': '*'})
+
+    assert wrapped(None, request).status_code == 200
+    assert len(view.calls) == 1
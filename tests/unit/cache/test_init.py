@@ -0,0 +1,51 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import pytest
+from pyramid.response import Response
+from armonaut.cache import dump_response, load_response
+
+
+def test_dump_and_load_response():
+    response = Response(body=b'page', headerlist=[
+        ('Content-Type', 'text/html'), ('Set-Cookie', 'session=1'),
+        ('Vary', 'Accept-Language'), ('Date', 'today')
+    ])
+
+    data = dump_response(response, 1024, exclude={'vary'})
+
+    assert data == {
+        'status': '200 OK',
+        'headers': [['Content-Type', 'text/html'], ['Content-Length', '4']],
+        'body': b'page'
+    }
+
+    loaded = load_response(data, time.time() - 10)
+    assert loaded.body == b'page'
+    assert loaded.content_type == 'text/html'
+    assert 'Set-Cookie' not in loaded.headers
+    assert int(loaded.headers['Age']) >= 10
+
+
+@pytest.mark.parametrize(
+    'response',
+    [
+        Response(body=b'x' * 11),
+        Response(app_iter=iter([b'page'])),
+        Response(app_iter=iter([b'x' * 11]), content_length=11)
+    ]
+)
+def test_dump_response_too_large(response):
+    assert dump_response(response, 10) is None
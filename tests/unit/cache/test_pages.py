@@ -0,0 +1,301 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import fakeredis
+import pretend
+import pytest
+from pyramid.request import Request
+from pyramid.response import Response
+from armonaut.cache import pages
+from armonaut.cache.pages import PageCache, page_cache_tween_factory
+from armonaut.utils import connections
+
+
+def _request(path='/status', **headers):
+    return Request.blank(path, headers=headers)
+
+
+def _response(body=b'page', cache_control='public, max-age=60', **headers):
+    response = Response(body=body)
+    response.headers['Cache-Control'] = cache_control
+    response.headers.update(headers)
+    return response
+
+
+def test_store_and_lookup():
+    cache = PageCache()
+
+    assert cache.lookup(_request())[0] is None
+    cache.store(_request(), _response(ETag='"v1"'))
+    state, page, _ = cache.lookup(_request())
+    response = cache.response(page, state)
+
+    assert state == 'HIT'
+    assert response.body == b'page'
+    assert response.etag == 'v1'
+    assert response.headers['X-Cache'] == 'HIT'
+    assert response.headers['Age'] == '0'
+    assert cache.lookup(_request('/other'))[0] is None
+    assert cache.metrics()['stores'] == 1
+
+
+def test_lookup_varies():
+    cache = PageCache()
+    cache.store(_request(**{'Accept-Language': 'en'}), _response(Vary='Accept-Language'))
+
+    assert cache.lookup(_request(**{'Accept-Language': 'en'}))[0] == 'HIT'
+    assert cache.lookup(_request(**{'Accept-Language': 'de'}))[0] is None
+    assert cache.lookup(_request())[0] is None
+
+
+@pytest.mark.parametrize(
+    ['method', 'response', 'headers'],
+    [
+        ('POST', _response(), {}),
+        ('GET', _response(Vary='Cookie'), {}),
+        ('GET', _response(Vary='Accept-Encoding, Authorization'), {}),
+        ('GET', _response(**{'Set-Cookie': 'session=1'}), {}),
+        ('GET', _response(cache_control='private, max-age=60'), {}),
+        ('GET', _response(cache_control='no-store'), {}),
+        ('GET', _response(cache_control='no-cache'), {}),
+        ('GET', _response(cache_control='max-age=0'), {}),
+        ('GET', _response(cache_control=''), {}),
+        ('GET', _response(cache_control='max-age=60'), {'Authorization': 'token'}),
+        ('GET', Response(body=b'missing', status=404, cache_control='max-age=60'), {})
+    ]
+)
+def test_store_skips_uncacheable(method, response, headers):
+    cache = PageCache()
+    request = Request.blank('/status', method=method, headers=headers)
+
+    cache.store(request, response)
+
+    assert cache.metrics()['entries'] == 0
+
+
+def test_store_recorded_vary():
+    cache = PageCache()
+    request = _request(**{'Accept-Language': 'en'})
+    request.response_vary = frozenset(['Accept-Language'])
+    cache.store(request, _response())
+    personal = _request('/personal')
+    personal.response_vary = frozenset(['Cookie'])
+    cache.store(personal, _response())
+
+    state, page, _ = cache.lookup(_request(**{'Accept-Language': 'en'}))
+
+    assert state == 'HIT'
+    assert cache.response(page, state).vary == ('Accept-Language',)
+    assert cache.lookup(_request(**{'Accept-Language': 'de'}))[0] is None
+    assert cache.lookup(_request('/personal'))[0] is None
+
+
+def test_store_shared_max_age():
+    cache = PageCache()
+    cache.store(_request(Authorization='token'), _response(cache_control='s-maxage=60'))
+
+    assert cache.lookup(_request())[0] == 'HIT'
+
+
+def test_stale_while_revalidate(monkeypatch):
+    cache = PageCache()
+    now = time.time()
+    cache.store(_request(), _response(cache_control='max-age=10, stale-while-revalidate=20'))
+
+    monkeypatch.setattr(time, 'time', lambda: now + 15)
+    assert cache.lookup(_request())[0] == 'STALE'
+
+    monkeypatch.setattr(time, 'time', lambda: now + 31)
+    assert cache.lookup(_request())[0] is None
+
+
+def test_evicts_by_size():
+    cache = PageCache(max_bytes=1000)
+    for i in range(10):
+        cache.store(_request(f'/{i}'), _response(body=b'x' * 100))
+
+    assert cache.bytes <= 1000
+    assert cache.lookup(_request('/0'))[0] is None
+    assert cache.lookup(_request('/9'))[0] == 'HIT'
+
+
+def test_purge_tags():
+    cache = PageCache()
+    cache.store(_request('/a'), _response(**{'Surrogate-Key': 'project-1 builds'}))
+    cache.store(_request('/b'), _response(**{'Surrogate-Key': 'project-2'}))
+
+    cache.purge('project-1')
+
+    assert cache.lookup(_request('/a'))[0] is None
+    assert cache.lookup(_request('/b'))[0] == 'HIT'
+
+
+def _redis_caches(monkeypatch):
+    monkeypatch.setattr(connections, 'get_connection_pool', lambda url: None)
+    shared = fakeredis.FakeStrictRedis()
+    shared.flushall()
+    first = PageCache(url='redis://localhost:6379/0')
+    second = PageCache(url='redis://localhost:6379/0')
+    first.redis = second.redis = shared
+    return first, second
+
+
+def test_redis_tier(monkeypatch):
+    first, second = _redis_caches(monkeypatch)
+    first.store(_request(**{'Accept-Language': 'en'}), _response(Vary='Accept-Language'))
+
+    state, page, _ = second.lookup(_request(**{'Accept-Language': 'en'}))
+
+    assert state == 'HIT'
+    assert page['body'] == b'page'
+    assert second.metrics()['entries'] == 2
+
+
+def test_redis_purge(monkeypatch):
+    first, second = _redis_caches(monkeypatch)
+    first.store(_request(), _response(**{'Surrogate-Key': 'project-1'}))
+
+    second.purge('project-1')
+
+    assert first.redis.keys('armonaut/pages/page/*') == []
+    assert first.redis.keys('armonaut/pages/tag/*') == []
+    assert second.lookup(_request())[0] is None
+
+
+def test_redis_purge_reaches_pages_stored_by_other_workers(monkeypatch):
+    first, second = _redis_caches(monkeypatch)
+    first.local_ttl = 0.05
+    first.store(_request(), _response(**{'Surrogate-Key': 'project-1'}))
+    assert first.lookup(_request())[0] == 'HIT'
+
+    second.purge('project-1')
+    time.sleep(0.1)
+
+    assert first.lookup(_request())[0] is None
+
+
+def test_lookup_by_scheme():
+    cache = PageCache()
+    cache.store(Request.blank('https://example.com/status'), _response())
+
+    assert cache.lookup(Request.blank('https://example.com/status'))[0] == 'HIT'
+    assert cache.lookup(Request.blank('http://example.com/status'))[0] is None
+
+
+def test_coalescing():
+    cache = PageCache()
+
+    assert cache.acquire('key')
+    assert not cache.acquire('key')
+    cache.release('key')
+    assert cache.acquire('key')
+
+
+def _tween(cache, response=None):
+    handler = pretend.call_recorder(lambda request: response or _response())
+    return handler, page_cache_tween_factory(handler, {'cache.pages': cache})
+
+
+def _run(tween, request):
+    response = tween(request)
+    request._process_response_callbacks(response)
+    request._process_finished_callbacks()
+    return response
+
+
+def test_tween_miss_then_hit():
+    cache = PageCache()
+    handler, tween = _tween(cache)
+
+    miss = _run(tween, _request())
+    hit = _run(tween, _request())
+
+    assert 'X-Cache' not in miss.headers
+    assert hit.headers['X-Cache'] == 'HIT'
+    assert hit.body == b'page'
+    assert len(handler.calls) == 1
+    assert cache._inflight == {}
+
+
+def test_tween_skips_unsafe_methods():
+    cache = PageCache()
+    handler, tween = _tween(cache)
+
+    tween(Request.blank('/', method='POST'))
+
+    assert len(handler.calls) == 1
+    assert cache.lookup(_request('/'))[0] is None
+
+
+def test_tween_serves_stale_while_revalidating(monkeypatch):
+    cache = PageCache()
+    now = time.time()
+    cache.store(_request(), _response(cache_control='max-age=10, stale-while-revalidate=20'))
+    monkeypatch.setattr(time, 'time', lambda: now + 15)
+    handler, tween = _tween(cache, _response(body=b'new'))
+
+    _, _, key = cache.lookup(_request())
+    cache.acquire(key)
+    stale = _run(tween, _request())
+    cache.release(key)
+    fresh = _run(tween, _request())
+
+    assert stale.headers['X-Cache'] == 'STALE'
+    assert stale.body == b'page'
+    assert fresh.body == b'new'
+    assert len(handler.calls) == 1
+
+
+def test_tween_coalesces_misses():
+    cache = PageCache()
+    handler, tween = _tween(cache)
+    key = cache.lookup(_request())[2]
+    cache.acquire(key)
+
+    def leader():
+        time.sleep(0.05)
+        cache.store(_request(), _response(body=b'leader'))
+        cache.release(key)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    response = _run(tween, _request())
+    thread.join()
+
+    assert response.body == b'leader'
+    assert handler.calls == []
+
+
+def test_includeme():
+    registry = {}
+    config = pretend.stub(
+        registry=pretend.stub(settings={'page_cache.max_bytes': 1024},
+                              __setitem__=registry.__setitem__),
+        add_request_method=pretend.call_recorder(lambda *args: None),
+        add_tween=pretend.call_recorder(lambda *args, **kwargs: None)
+    )
+
+    pages.includeme(config)
+
+    assert registry['cache.pages'].max_bytes == 1024
+    assert len(config.add_request_method.calls) == 1
+    assert config.add_tween.calls[0].args == ('armonaut.cache.pages.page_cache_tween_factory',)
+
+
+def test_includeme_disabled():
+    config = pretend.stub(registry=pretend.stub(settings={}))
+
+    pages.includeme(config)
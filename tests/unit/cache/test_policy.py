@@ -0,0 +1,257 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import urllib.error
+import urllib.request
+import pretend
+import pytest
+from pyramid.request import Request
+from pyramid.response import Response
+from armonaut.cache import policy
+from armonaut.cache.pages import PageCache
+from armonaut.cache.policy import (
+    CachePolicy, LocalPurger, FastlyPurger, cache_policy_view, cache_policy_tween_factory,
+    purge_cache
+)
+
+
+def _apply(cache_policy, response=None, method='GET', matchdict=None, vary=None):
+    request = Request.blank('/', method=method)
+    request.matchdict = matchdict
+    if vary is not None:
+        request.response_vary = frozenset(vary)
+    response = response or Response(body=b'page')
+    cache_policy.apply(None, request, response)
+    return response
+
+
+def test_apply_all_headers():
+    response = _apply(
+        CachePolicy(max_age=60, s_maxage=300, stale_while_revalidate=30,
+                    surrogate_keys=['projects', 'project/{name}']),
+        matchdict={'name': 'armonaut'}
+    )
+
+    cache_control = response.cache_control
+    assert cache_control.public
+    assert cache_control.max_age == 60
+    assert cache_control.s_maxage == 300
+    assert cache_control.stale_while_revalidate == 30
+    assert response.headers['Surrogate-Control'] == 'max-age=300, stale-while-revalidate=30'
+    assert response.headers['Surrogate-Key'] == 'projects project/armonaut'
+
+
+def test_apply_shared_max_age_falls_back():
+    response = _apply(CachePolicy(max_age=60))
+
+    assert response.cache_control.public
+    assert response.cache_control.max_age == 60
+    assert response.cache_control.s_maxage is None
+    assert response.headers['Surrogate-Control'] == 'max-age=60'
+    assert 'Surrogate-Key' not in response.headers
+
+
+def test_apply_surrogate_keys_callable():
+    keys = pretend.call_recorder(lambda context, request: ['project/1', 'builds'])
+    response = Response(body=b'page')
+    response.headers['Surrogate-Key'] = 'builds'
+
+    _apply(CachePolicy(surrogate_keys=keys), response)
+
+    assert response.headers['Surrogate-Key'] == 'builds project/1'
+    assert 'Surrogate-Control' not in response.headers
+    assert len(keys.calls) == 1
+
+
+@pytest.mark.parametrize(
+    'response',
+    [
+        Response(status=500),
+        Response(cache_control='no-store'),
+        Response(cache_control='private'),
+        Response(cache_control='no-cache')
+    ]
+)
+def test_apply_skips_uncacheable(response):
+    cache_control = response.headers.get('Cache-Control')
+
+    _apply(CachePolicy(max_age=60, surrogate_keys=['projects']), response)
+
+    assert response.headers.get('Cache-Control') == cache_control
+    assert 'Surrogate-Key' not in response.headers
+
+
+def test_apply_skips_unsafe_methods():
+    response = _apply(CachePolicy(max_age=60), method='POST')
+
+    assert 'Cache-Control' not in response.headers
+
+
+@pytest.mark.parametrize(
+    ['headers', 'vary'],
+    [
+        ({'Set-Cookie': 'session=1'}, None),
+        ({'Vary': 'Authorization'}, None),
+        ({}, ['Cookie'])
+    ]
+)
+def test_apply_personal(headers, vary):
+    response = Response(body=b'page')
+    response.headers.update(headers)
+
+    _apply(CachePolicy(max_age=60, s_maxage=300, surrogate_keys=['projects']),
+           response, vary=vary)
+
+    assert response.cache_control.private
+    assert not response.cache_control.public
+    assert response.cache_control.max_age == 60
+    assert response.cache_control.s_maxage is None
+    assert 'Surrogate-Control' not in response.headers
+    assert 'Surrogate-Key' not in response.headers
+
+
+def test_local_purger():
+    purger = LocalPurger()
+
+    purger.purge(['a', 'b'])
+    purger.purge(('c',))
+
+    assert list(purger.purged) == ['a', 'b', 'c']
+
+
+def test_local_purger_bounded():
+    purger = LocalPurger(max_keys=2)
+
+    purger.purge(['a', 'b', 'c'])
+
+    assert list(purger.purged) == ['b', 'c']
+
+
+def test_fastly_purger_batches(monkeypatch):
+    response = pretend.stub(__enter__=lambda: None, __exit__=lambda *args: None)
+    urlopen = pretend.call_recorder(lambda request, timeout: response)
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+    purger = FastlyPurger('service', 'key')
+
+    purger.purge([str(key) for key in range(300)])
+
+    assert len(urlopen.calls) == 2
+    request = urlopen.calls[0].args[0]
+    assert request.full_url == 'https://api.fastly.com/service/service/purge'
+    assert request.get_method() == 'POST'
+    assert request.headers['Fastly-key'] == 'key'
+    assert len(request.headers['Surrogate-key'].split()) == 256
+    assert len(urlopen.calls[1].args[0].headers['Surrogate-key'].split()) == 44
+
+
+def test_fastly_purger_logs_errors(monkeypatch):
+    def urlopen(request, timeout):
+        raise urllib.error.URLError('unreachable')
+
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+    warning = pretend.call_recorder(lambda *args, **kwargs: None)
+    monkeypatch.setattr(policy.logger, 'warning', warning)
+
+    FastlyPurger('service', 'key').purge(['projects'])
+
+    assert len(warning.calls) == 1
+
+
+def test_view_without_options():
+    view = pretend.stub()
+
+    assert cache_policy_view(view, pretend.stub(options={}, exception_only=False)) is view
+
+
+def test_view_records_policy():
+    response = Response()
+    view = pretend.call_recorder(lambda context, request: response)
+    info = pretend.stub(options={'max_age': 60, 'surrogate_keys': ['projects']},
+                        exception_only=False)
+    request = pretend.stub()
+
+    assert cache_policy_view(view, info)(None, request) is response
+    assert request.cache_policy.max_age == 60
+    assert request.cache_policy.surrogate_keys == ('projects',)
+    assert request.cache_policy.s_maxage is None
+
+
+def test_tween():
+    response = Response(body=b'page')
+    request = Request.blank('/')
+    handler = pretend.call_recorder(lambda request: response)
+    tween = cache_policy_tween_factory(handler, pretend.stub())
+
+    assert tween(request) is response
+    assert 'Cache-Control' not in response.headers
+
+    request.cache_policy = CachePolicy(max_age=60)
+    tween(request)
+    assert response.cache_control.max_age == 60
+
+
+def _purge_request(tm=None, pages=None):
+    request = pretend.stub(registry={'cache.purger': LocalPurger(), 'cache.pages': pages})
+    if tm is not None:
+        request.tm = tm
+    return request
+
+
+def test_purge_cache():
+    pages = PageCache()
+    pages.purge = pretend.call_recorder(lambda *tags: None)
+    request = _purge_request(pages=pages)
+
+    purge_cache(request, 'projects', 'project/1')
+
+    assert list(request.registry['cache.purger'].purged) == ['projects', 'project/1']
+    assert pages.purge.calls == [pretend.call('projects', 'project/1')]
+
+
+@pytest.mark.parametrize('success', [True, False])
+def test_purge_cache_after_commit(success):
+    hooks = []
+    transaction = pretend.stub(addAfterCommitHook=hooks.append)
+    request = _purge_request(tm=pretend.stub(get=lambda: transaction))
+
+    purge_cache(request, 'projects')
+    assert list(request.registry['cache.purger'].purged) == []
+
+    hooks[0](success)
+    assert list(request.registry['cache.purger'].purged) == (['projects'] if success else [])
+
+
+@pytest.mark.parametrize(
+    ['settings', 'purger_cls'],
+    [
+        ({}, LocalPurger),
+        ({'cache.purger': 'fastly', 'cache.fastly_service_id': 'service',
+          'cache.fastly_api_key': 'key'}, FastlyPurger)
+    ]
+)
+def test_includeme(settings, purger_cls):
+    registry = {}
+    config = pretend.stub(
+        registry=pretend.stub(settings=settings, __setitem__=registry.__setitem__),
+        add_request_method=pretend.call_recorder(lambda *args: None),
+        add_view_deriver=pretend.call_recorder(lambda deriver: None),
+        add_tween=pretend.call_recorder(lambda *args, **kwargs: None)
+    )
+
+    policy.includeme(config)
+
+    assert isinstance(registry['cache.purger'], purger_cls)
+    assert config.add_request_method.calls == [pretend.call(purge_cache, 'purge_cache')]
+    assert config.add_view_deriver.calls == [pretend.call(cache_policy_view)]
+    assert config.add_tween.calls[0].args == ('armonaut.cache.policy.cache_policy_tween_factory',)
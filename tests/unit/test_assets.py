@@ -0,0 +1,148 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+import os
+import pretend
+import pytest
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.request import Request
+from armonaut import assets
+from armonaut.utils import compression
+
+CSS = b'body { font-family: sans-serif; }\n' * 20
+
+
+@pytest.fixture
+def static_assets(tmpdir):
+    source = tmpdir.mkdir('static')
+    source.mkdir('css').join('site.css').write_binary(CSS)
+    source.join('robots.txt').write_binary(b'x')
+    output = tmpdir.join('dist')
+
+    assets.build(str(source), str(output))
+    return assets.StaticAssets(str(source), str(output))
+
+
+def _request(static_assets, subpath, accept_encoding='gzip'):
+    request = Request.blank('/', headers={'Accept-Encoding': accept_encoding})
+    request.registry = {'static.assets': static_assets}
+    request.matchdict = {'subpath': tuple(subpath.split('/'))}
+    request.route_url = lambda name, subpath: f'/static/{subpath}'
+    return request
+
+
+def test_build(static_assets):
+    hashed_name = static_assets.manifest['css/site.css']
+
+    assert hashed_name.startswith('css/site.') and hashed_name.endswith('.css')
+    assert static_assets.manifest['robots.txt'].startswith('robots.')
+
+    path = os.path.join(static_assets.output, *hashed_name.split('/'))
+    with open(path, 'rb') as f:
+        assert f.read() == CSS
+    with open(path + '.gz', 'rb') as f:
+        assert gzip.decompress(f.read()) == CSS
+    with open(os.path.join(static_assets.output, assets.MANIFEST), 'rb') as f:
+        assert json.loads(f.read().decode('utf-8')) == static_assets.manifest
+
+
+def test_build_name_changes_with_content(tmpdir, static_assets):
+    tmpdir.join('static', 'css', 'site.css').write_binary(CSS + b'a { color: red; }\n')
+
+    manifest = assets.build(static_assets.source, static_assets.output)
+
+    assert manifest['css/site.css'] != static_assets.manifest['css/site.css']
+
+
+def test_static_assets_encodings(static_assets):
+    hashed_name = static_assets.manifest['css/site.css']
+
+    assert 'gzip' in static_assets.encodings[hashed_name]
+    # Variants that don't save anything aren't written.
+    assert static_assets.encodings[static_assets.manifest['robots.txt']] == ['identity']
+
+
+def test_static_assets_without_build(tmpdir):
+    static_assets = assets.StaticAssets(str(tmpdir), str(tmpdir.join('dist')))
+
+    assert static_assets.manifest == {}
+    assert static_assets.url_path('css/site.css') == 'css/site.css'
+
+
+def test_asset_url(static_assets):
+    request = _request(static_assets, 'css/site.css')
+
+    url = assets.asset_url(request, 'css/site.css')
+
+    assert url == '/static/' + static_assets.manifest['css/site.css']
+
+
+@pytest.mark.parametrize('accept_encoding', ['gzip', 'br', 'zstd', 'gzip, br, zstd'])
+def test_static_view_precompressed(static_assets, accept_encoding):
+    hashed_name = static_assets.manifest['css/site.css']
+    request = _request(static_assets, hashed_name, accept_encoding)
+
+    response = assets.static_view(request)
+
+    encoding = request.accept_encoding.best_match(
+        compression.ENCODINGS, default_match='identity'
+    )
+    assert response.content_encoding == (None if encoding == 'identity' else encoding)
+    assert response.content_type == 'text/css'
+    assert response.cache_control.max_age == 31536000
+    assert 'Accept-Encoding' in response.vary
+    if encoding == 'gzip':
+        assert gzip.decompress(b''.join(response.app_iter)) == CSS
+
+
+def test_static_view_identity(static_assets):
+    hashed_name = static_assets.manifest['css/site.css']
+
+    response = assets.static_view(_request(static_assets, hashed_name, 'identity'))
+
+    assert response.content_encoding is None
+    assert b''.join(response.app_iter) == CSS
+
+
+def test_static_view_unbuilt_asset(static_assets):
+    response = assets.static_view(_request(static_assets, 'css/site.css'))
+
+    assert response.content_encoding is None
+    assert response.cache_control.max_age is None
+    assert b''.join(response.app_iter) == CSS
+
+
+@pytest.mark.parametrize('subpath', ['css/missing.css', '../static/css/site.css', 'css/./site.css'])
+def test_static_view_not_found(static_assets, subpath):
+    with pytest.raises(HTTPNotFound):
+        assets.static_view(_request(static_assets, subpath))
+
+
+def test_includeme(monkeypatch):
+    static_assets = pretend.stub()
+    monkeypatch.setattr(assets, 'StaticAssets', pretend.call_recorder(lambda **kw: static_assets))
+    registry = {}
+    config = pretend.stub(
+        registry=pretend.stub(settings={'static.output': 'dist'},
+                              __setitem__=registry.__setitem__),
+        add_request_method=pretend.call_recorder(lambda *args: None)
+    )
+
+    assets.includeme(config)
+
+    assert registry == {'static.assets': static_assets}
+    assert assets.StaticAssets.calls == [pretend.call(source=assets.STATIC_DIR, output='dist')]
+    assert config.add_request_method.calls == [pretend.call(assets.asset_url, 'asset_url')]
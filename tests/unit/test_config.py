@@ -37,7 +37,7 @@ def test_configurator_middlewares():
 def test_maybe_set_from_os_environ(monkeypatch):
     env = os.environ.copy()
     env['ARMONAUT_SECRET'] = 'value'
-    env['REDIS_URL'] = 'url'
+    env['REDIS_URL'] = 'redis://localhost:6379/0'
     monkeypatch.setattr(os, 'environ', env)
 
     config = configure()
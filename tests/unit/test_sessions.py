@@ -15,9 +15,15 @@
 import pytest
 import time
 import pretend
+import fakeredis
 import redis
-from armonaut.utils import crypto
-from armonaut.sessions import InvalidSession, Session, RedisSessionFactory
+import pyramid.testing
+from pyramid.decorator import reify
+from armonaut.utils import connections, crypto, serialization
+from armonaut.sessions import (
+    CookieSessionFactory, InvalidSession, LazySession, Session,
+    SessionCache, SessionCacheEvents, RedisSessionFactory, logger, session_view
+)
 
 
 @pytest.mark.parametrize(
@@ -46,7 +52,8 @@ from armonaut.sessions import InvalidSession, Session, RedisSessionFactory
      'new_csrf_token',
      'pop_flash',
      'peek_flash',
-     'should_save']
+     'should_save',
+     'touch']
 )
 def test_invalid_session_methods(method):
     """Assert that InvalidSession can't have any methods
@@ -288,25 +295,32 @@ def test_session_renew_csrf_token(monkeypatch):
 def test_session_factory_init(monkeypatch):
     timestamp_signer_obj = pretend.stub()
     timestamp_signer_create = pretend.call_recorder(
-        lambda secret, salt: timestamp_signer_obj
+        lambda secret, salt, cache_size: timestamp_signer_obj
     )
     monkeypatch.setattr(crypto, 'TimestampSigner', timestamp_signer_create)
 
+    pool = pretend.stub()
+    get_connection_pool = pretend.call_recorder(lambda url, **kw: pool)
+    monkeypatch.setattr(connections, 'get_connection_pool', get_connection_pool)
+
     strict_redis_obj = pretend.stub()
-    strict_redis_cls = pretend.stub(
-        from_url=pretend.call_recorder(lambda url: strict_redis_obj)
-    )
+    strict_redis_cls = pretend.call_recorder(lambda connection_pool: strict_redis_obj)
     monkeypatch.setattr(redis, 'StrictRedis', strict_redis_cls)
 
-    session_factory = RedisSessionFactory('secret', 'url')
+    session_factory = RedisSessionFactory(
+        'secret', 'url', pool_options={'max_connections': 10}
+    )
 
     assert session_factory.signer is timestamp_signer_obj
     assert session_factory.redis is strict_redis_obj
     assert timestamp_signer_create.calls == [
-        pretend.call('secret', salt='session')
+        pretend.call('secret', salt='session', cache_size=1024)
+    ]
+    assert get_connection_pool.calls == [
+        pretend.call('url', max_connections=10)
     ]
-    assert strict_redis_cls.from_url.calls == [
-        pretend.call('url')
+    assert strict_redis_cls.calls == [
+        pretend.call(connection_pool=pool)
     ]
 
 
@@ -326,7 +340,8 @@ def test_no_current_session(pyramid_request):
 
     assert len(pyramid_request.response_callbacks) == 1
     assert pyramid_request.response_callbacks[0] is session_factory._process_response
-    assert isinstance(session, Session)
+    assert isinstance(session, LazySession)
+    assert isinstance(session._load(), Session)
     assert session._sid is None
     assert session.new
 
@@ -340,6 +355,892 @@ def test_invalid_session_id(pyramid_request):
 
     assert len(pyramid_request.response_callbacks) == 1
     assert pyramid_request.response_callbacks[0] is session_factory._process_response
-    assert isinstance(session, Session)
+    assert isinstance(session, LazySession)
+    assert isinstance(session._load(), Session)
     assert session._sid is None
     assert session.new
+
+
+def test_session_cache_miss_then_hit():
+    cache = SessionCache()
+
+    assert cache.get('1', 'a') is None
+    cache.set('1', 'a', {'foo': ['bar']})
+
+    assert cache.get('1', 'a') == {'foo': ['bar']}
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_session_cache_version_mismatch():
+    cache = SessionCache()
+    cache.set('1', 'a', {'foo': 'bar'})
+
+    assert cache.get('1', 'b') is None
+    assert cache.misses == 1
+
+
+def test_session_cache_returns_copies():
+    cache = SessionCache()
+    data = {'foo': ['bar']}
+    cache.set('1', 'a', data)
+    data['foo'].append('baz')
+
+    cached = cache.get('1', 'a')
+    cached['foo'].append('bel')
+
+    assert cache.get('1', 'a') == {'foo': ['bar']}
+
+
+def test_session_cache_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+
+    cache = SessionCache(ttl=10)
+    cache.set('1', 'a', {'foo': 'bar'})
+
+    now[0] = 111.0
+    assert cache.get('1', 'a') is None
+
+
+def test_session_cache_evicts_least_recently_used():
+    cache = SessionCache(max_size=2)
+    cache.set('1', 'a', {})
+    cache.set('2', 'a', {})
+    cache.get('1', 'a')
+    cache.set('3', 'a', {})
+
+    assert cache.get('2', 'a') is None
+    assert cache.get('1', 'a') == {}
+    assert cache.get('3', 'a') == {}
+
+
+def test_session_cache_invalidate():
+    cache = SessionCache()
+    cache.set('1', 'a', {'foo': 'bar'})
+    cache.invalidate('1')
+    cache.invalidate('2')
+
+    assert cache.get('1', 'a') is None
+
+
+def test_session_loaded_from_cache(pyramid_request):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', cache=SessionCache()
+    )
+    session_factory.redis = pretend.stub(get=pretend.call_recorder(lambda key: None))
+    session_factory.cache.set('1', 'a', {'foo': 'bar'})
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1.a').decode('utf-8')
+
+    session = session_factory(pyramid_request)
+
+    assert session == {'foo': 'bar'}
+    assert session.sid == '1'
+    assert session.version == 'a'
+    assert not session.new
+    assert session_factory.redis.get.calls == []
+
+
+def _cache_events(monkeypatch):
+    monkeypatch.setattr(SessionCacheEvents, 'retry_delay', 0.01)
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', cache=SessionCache(), cache_events=True
+    )
+    session_factory.redis = fakeredis.FakeStrictRedis()
+    session_factory.redis.flushall()
+    return session_factory
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_session_deleted_by_another_worker_evicted(pyramid_request, monkeypatch):
+    session_factory = _cache_events(monkeypatch)
+    session_factory.cache_events.start([session_factory.redis])
+    assert _wait_for(lambda: session_factory.redis.publish('__keyevent@0__:del', 'other'))
+    session_factory.redis.set('armonaut/session/1', b'\x81\xa4user\xa5alice')
+    session_factory.redis.set('armonaut/session/2', b'\x81\xa4user\xa3bob')
+    for sid in ['1', '2']:
+        pyramid_request.cookies['session'] = session_factory.signer.sign(
+            f'{sid}.a'.encode('utf-8')
+        ).decode('utf-8')
+        session_factory._process_request(pyramid_request)
+    assert session_factory.cache.get('1', 'a') == {'user': 'alice'}
+
+    # Another worker logs the session out and the other one expires.
+    session_factory.redis.publish('__keyevent@0__:del', 'armonaut/session/1')
+    session_factory.redis.publish('__keyevent@0__:expired', 'armonaut/session/2')
+    session_factory.redis.publish('__keyevent@0__:del', 'armonaut/other/3')
+
+    assert _wait_for(lambda: not session_factory.cache._entries)
+
+
+def test_cache_events_enable_notifications():
+    flags = {'notify-keyspace-events': 'Kl'}
+    client = pretend.stub(
+        config_get=lambda name: flags,
+        config_set=pretend.call_recorder(lambda name, value: True)
+    )
+
+    SessionCacheEvents(SessionCache(), 'armonaut/session/')._enable(client)
+
+    assert client.config_set.calls == [pretend.call('notify-keyspace-events', 'KlEgx')]
+
+
+def test_cache_events_already_enabled():
+    client = pretend.stub(
+        config_get=lambda name: {'notify-keyspace-events': 'AKE'},
+        config_set=pretend.call_recorder(lambda name, value: True)
+    )
+
+    SessionCacheEvents(SessionCache(), 'armonaut/session/')._enable(client)
+
+    assert client.config_set.calls == []
+
+
+def test_cache_events_resubscribe_clears_cache(monkeypatch):
+    monkeypatch.setattr(SessionCacheEvents, 'retry_delay', 0)
+    cache = SessionCache()
+    cache.set('1', 'a', {'user': 'alice'})
+    events = SessionCacheEvents(cache, 'armonaut/session/')
+    warning = pretend.call_recorder(lambda *args, **kwargs: None)
+    monkeypatch.setattr(logger, 'warning', warning)
+
+    class Stop(Exception):
+        pass
+
+    def pubsub(ignore_subscribe_messages):
+        if warning.calls:
+            raise Stop()
+        raise redis.ConnectionError()
+
+    client = pretend.stub(
+        connection_pool=pretend.stub(connection_kwargs={'db': 0}),
+        config_get=lambda name: {'notify-keyspace-events': 'Egx'},
+        pubsub=pubsub
+    )
+
+    with pytest.raises(Stop):
+        events._run(client)
+
+    assert len(warning.calls) == 1
+    assert cache.get('1', 'a') is None
+
+
+def _stored_session(pyramid_request, storage):
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0', storage=storage)
+    session_factory.redis = fakeredis.FakeStrictRedis()
+    session_factory.redis.flushall()
+    if storage == 'hash':
+        session_factory.redis.hset('armonaut/session/1', 'user', b'\xa5alice')
+        session_factory.redis.hset('armonaut/session/1', 'seen', b'\xc2')
+    else:
+        session_factory.redis.set('armonaut/session/1', b'\x82\xa4user\xa5alice\xa4seen\xc2')
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1.a').decode('utf-8')
+    return session_factory, session_factory._process_request(pyramid_request)
+
+
+@pytest.mark.parametrize('storage', ['string', 'hash'])
+def test_invalidated_session_not_written_back(pyramid_request, storage):
+    session_factory, session = _stored_session(pyramid_request, storage)
+
+    # Another worker logs the session out before this request saves it.
+    session_factory.redis.delete('armonaut/session/1')
+    session['seen'] = True
+    _save(session_factory, pyramid_request, session)
+
+    assert session_factory.redis.keys('armonaut/session/*') == []
+
+
+@pytest.mark.parametrize('changed', [False, True])
+def test_stored_hash_session_written(pyramid_request, changed):
+    session_factory, session = _stored_session(pyramid_request, 'hash')
+
+    session['user'] = 'bob'
+    del session['seen']
+    if changed:
+        session.changed()
+    _save(session_factory, pyramid_request, session)
+
+    assert session_factory.redis.hgetall('armonaut/session/1') == {b'user': b'\xa3bob'}
+    assert 0 < session_factory.redis.ttl('armonaut/session/1') <= session_factory.max_age
+
+
+def test_session_cache_filled_from_redis(pyramid_request):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', cache=SessionCache()
+    )
+    session_factory.redis = pretend.stub(
+        get=pretend.call_recorder(lambda key: b'\x81\xa3foo\xa3bar'),
+        exists=lambda key: True
+    )
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1.a').decode('utf-8')
+
+    assert session_factory(pyramid_request) == {'foo': 'bar'}
+    assert session_factory(pyramid_request) == {'foo': 'bar'}
+    assert session_factory.redis.get.calls == [pretend.call('armonaut/session/1')]
+
+
+def test_unversioned_cookie_bypasses_cache(pyramid_request):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', cache=SessionCache()
+    )
+    session_factory.redis = pretend.stub(
+        get=pretend.call_recorder(lambda key: b'\x81\xa3foo\xa3bar')
+    )
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1').decode('utf-8')
+
+    session = session_factory(pyramid_request)
+
+    assert session == {'foo': 'bar'}
+    assert session.version is None
+    assert session_factory.cache.misses == 0
+
+
+def test_save_updates_cache_and_cookie_version(pyramid_request, monkeypatch):
+    monkeypatch.setattr(crypto, 'random_token', lambda nbytes=32: 'v2' if nbytes == 6 else '1')
+
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', cache=SessionCache()
+    )
+    session_factory.redis = fakeredis.FakeStrictRedis()
+    session_factory.redis.flushall()
+    session_factory.redis.set('armonaut/session/0', b'\x81\xa3foo\xa3bar')
+    session_factory.cache.set('0', 'v1', {'foo': 'bar'})
+
+    session = Session({'foo': 'bar'}, '0', False, 'v1')
+    session.invalidate()
+    session['foo'] = 'bel'
+    pyramid_request.session = session
+    pyramid_request.scheme = 'https'
+    response = pretend.stub(set_cookie=pretend.call_recorder(lambda *a, **kw: None))
+
+    session_factory._process_response(pyramid_request, response)
+
+    assert session.version == 'v2'
+    assert session_factory.redis.get('armonaut/session/0') is None
+    assert session_factory.redis.get('armonaut/session/1') == b'\x81\xa3foo\xa3bel'
+    assert session_factory.cache.get('0', 'v1') is None
+    assert session_factory.cache.get('1', 'v2') == {'foo': 'bel'}
+
+    name, value = response.set_cookie.calls[0].args
+    assert session_factory.signer.unsign(value) == b'1.v2'
+
+
+def test_lazy_session_loads_on_first_use():
+    loader = pretend.call_recorder(lambda: Session({'foo': 'bar'}))
+    session = LazySession(loader)
+
+    assert not session.loaded
+    assert loader.calls == []
+
+    assert session['foo'] == 'bar'
+    assert 'foo' in session
+    assert len(session) == 1
+    assert list(session) == ['foo']
+    assert session == {'foo': 'bar'}
+    assert session.get_csrf_token() is not None
+    assert session.loaded
+    assert loader.calls == [pretend.call()]
+
+
+def test_lazy_session_writes_load_session():
+    session = LazySession(lambda: Session({}))
+    session['foo'] = 'bar'
+
+    assert session.loaded
+    assert session.should_save()
+
+
+def test_lazy_session_does_not_verify_cookie(pyramid_request):
+    pyramid_request.cookies['session'] = 'invalid'
+
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+    session_factory.signer = pretend.stub()
+    session_factory.redis = pretend.stub()
+
+    session = session_factory(pyramid_request)
+
+    assert isinstance(session, LazySession)
+    assert not session.loaded
+
+
+def test_unloaded_session_not_saved(pyramid_request):
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+    session_factory.redis = pretend.stub()
+    pyramid_request.session = session_factory(pyramid_request)
+    response = pretend.stub()
+
+    session_factory._process_response(pyramid_request, response)
+
+
+def test_session_view_does_not_load_session():
+    class Request:
+        @reify
+        def session(self):
+            raise AssertionError('session factory called')
+
+    response = pretend.stub()
+
+    def view(context, request):
+        assert isinstance(request.session, InvalidSession)
+        return response
+
+    info = pretend.stub(options={}, exception_only=False)
+    request = Request()
+
+    assert session_view(view, info)(pretend.stub(), request) is response
+    assert 'session' not in vars(request)
+
+
+def test_session_view_restores_session():
+    original = pretend.stub()
+    request = pretend.stub(session=original)
+    info = pretend.stub(options={}, exception_only=False)
+
+    session_view(lambda context, request: None, info)(pretend.stub(), request)
+
+    assert request.session is original
+
+
+@pytest.mark.parametrize(
+    ('func', 'args', 'dirty'),
+    [('__setitem__', ('foo', 'bar'), set()),
+     ('__setitem__', ('foo', 'bel'), {'foo'}),
+     ('__setitem__', ('bar', 'foo'), {'bar'}),
+     ('__delitem__', ('foo',), {'foo'}),
+     ('pop', ('foo',), {'foo'}),
+     ('pop', ('bar', None), set()),
+     ('popitem', (), {'foo'}),
+     ('update', ({'foo': 'bar', 'bar': 'foo'},), {'bar'}),
+     ('setdefault', ('bar', 'foo'), {'bar'}),
+     ('flash', ('message',), {'_flash_messages'}),
+     ('clear', (), None),
+     ('changed', (), None)]
+)
+def test_session_dirty_keys(func, args, dirty):
+    session = Session({'foo': 'bar'})
+    getattr(session, func)(*args)
+
+    assert session.dirty == dirty
+    assert session.should_save() == (dirty != set())
+
+
+def test_session_flash_existing_queue_is_dirty():
+    session = Session({'_flash_messages': ['message1']})
+    session.flash('message2')
+
+    assert session.should_save()
+    assert session.dirty == {'_flash_messages'}
+
+
+def test_session_invalidate_resets_dirty():
+    session = Session({'foo': 'bar'}, '1', False)
+    session['bar'] = 'foo'
+    session.invalidate()
+
+    assert session.dirty == set()
+
+
+def test_unknown_session_storage():
+    with pytest.raises(ValueError):
+        RedisSessionFactory('secret', 'redis://localhost:6379/0', storage='unknown')
+
+
+def test_hash_session_loaded(pyramid_request):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', storage='hash'
+    )
+    session_factory.redis = pretend.stub(
+        hgetall=pretend.call_recorder(
+            lambda key: {b'foo': b'\xa3bar', b'bar': b'\x92\x01\x02'}
+        )
+    )
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1.a').decode('utf-8')
+
+    session = session_factory(pyramid_request)
+
+    assert session == {'foo': 'bar', 'bar': [1, 2]}
+    assert not session.new
+    assert session_factory.redis.hgetall.calls == [pretend.call('armonaut/session/1')]
+
+
+def test_hash_session_missing(pyramid_request):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', storage='hash'
+    )
+    session_factory.redis = pretend.stub(hgetall=lambda key: {})
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1.a').decode('utf-8')
+
+    assert session_factory(pyramid_request).new
+
+
+class FakePipeline:
+    def __init__(self):
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name,) + args + ((kwargs,) if kwargs else ()))
+        return command
+
+
+def _hash_factory():
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', storage='hash'
+    )
+    return session_factory, FakePipeline()
+
+
+def test_hash_session_writes_changed_fields():
+    session_factory, pipeline = _hash_factory()
+
+    session = Session({'foo': 'bar', 'bar': 'foo', 'big': 'x' * 1024}, '1', False)
+    session['foo'] = 'bel'
+    del session['bar']
+
+    session_factory._save_data(pipeline, session)
+
+    assert pipeline.commands == [
+        ('hset', 'armonaut/session/1', {'mapping': {'foo': b'\xa3bel'}}),
+        ('hdel', 'armonaut/session/1', 'bar'),
+        ('expire', 'armonaut/session/1', session_factory.max_age)
+    ]
+
+
+@pytest.mark.parametrize('new', [True, False])
+def test_hash_session_writes_all_fields(new):
+    session_factory, pipeline = _hash_factory()
+
+    session = Session({'foo': 'bar'}, '1', new)
+    session.changed()
+
+    session_factory._save_data(pipeline, session)
+
+    assert pipeline.commands == [
+        ('delete', 'armonaut/session/1'),
+        ('hset', 'armonaut/session/1', {'mapping': {'foo': b'\xa3bar'}}),
+        ('expire', 'armonaut/session/1', session_factory.max_age)
+    ]
+
+
+class RoundTripRedis:
+    """Wraps a FakeStrictRedis and counts round trips to it."""
+    def __init__(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.round_trips = 0
+
+    def pipeline(self):
+        pipeline = self.redis.pipeline()
+        execute = pipeline.execute
+
+        def counted_execute():
+            self.round_trips += 1
+            return execute()
+
+        pipeline.execute = counted_execute
+        return pipeline
+
+    def __getattr__(self, name):
+        self.round_trips += 1
+        return getattr(self.redis, name)
+
+
+@pytest.mark.parametrize('storage', ['string', 'hash'])
+def test_invalidate_and_save_in_one_round_trip(pyramid_request, storage):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', storage=storage
+    )
+    session_factory.redis = RoundTripRedis()
+    for sid in ['1', '2', '3']:
+        session_factory.redis.redis.set(f'armonaut/session/{sid}', b'\x80')
+
+    session = Session({'user': 1}, '1', False)
+    session.invalidated.update({'2', '3'})
+    session.invalidate()
+    session['user'] = 2
+    pyramid_request.session = session
+    pyramid_request.scheme = 'https'
+    response = pretend.stub(set_cookie=pretend.call_recorder(lambda *a, **kw: None))
+
+    session_factory._process_response(pyramid_request, response)
+
+    assert session_factory.redis.round_trips == 1
+    assert session_factory.redis.redis.keys('armonaut/session/*') == [
+        f'armonaut/session/{session.sid}'.encode('utf-8')
+    ]
+    assert len(response.set_cookie.calls) == 1
+
+
+def test_invalidate_without_save_deletes_cookie(pyramid_request):
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+    session_factory.redis = RoundTripRedis()
+
+    session = Session({'user': 1}, '1', False)
+    session.invalidate()
+    pyramid_request.session = session
+    response = pretend.stub(delete_cookie=pretend.call_recorder(lambda name: None))
+
+    session_factory._process_response(pyramid_request, response)
+
+    assert session_factory.redis.round_trips == 1
+    assert response.delete_cookie.calls == [pretend.call('session')]
+
+
+def test_touch_refreshes_expiry(pyramid_request):
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+    session_factory.redis = RoundTripRedis()
+    session_factory.redis.redis.setex('armonaut/session/1', 10, b'\x81\xa3foo\xa3bar')
+
+    session = Session({'foo': 'bar'}, '1', False, 'a')
+    session.touch()
+    pyramid_request.session = session
+    pyramid_request.scheme = 'https'
+    response = pretend.stub(set_cookie=pretend.call_recorder(lambda *a, **kw: None))
+
+    session_factory._process_response(pyramid_request, response)
+
+    assert session_factory.redis.round_trips == 1
+    assert session_factory.redis.redis.ttl('armonaut/session/1') == session_factory.max_age
+    assert session_factory.redis.redis.get('armonaut/session/1') == b'\x81\xa3foo\xa3bar'
+
+    name, value = response.set_cookie.calls[0].args
+    assert session_factory.signer.unsign(value) == b'1.a'
+
+
+def test_touch_new_session_does_nothing(pyramid_request):
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+    session_factory.redis = RoundTripRedis()
+
+    session = Session()
+    session.touch()
+    pyramid_request.session = session
+
+    session_factory._process_response(pyramid_request, pretend.stub())
+
+    assert session_factory.redis.round_trips == 0
+
+
+def test_session_factory_max_age():
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0', max_age=60)
+
+    assert session_factory.max_age == 60
+    assert RedisSessionFactory.max_age == 12 * 60 * 60
+
+
+@pytest.mark.parametrize(
+    ('refresh_interval', 'cookie_age', 'touched'),
+    [(None, 3600, False),
+     (300, 0, False),
+     (300, 290, False),
+     (300, 300, True),
+     (300, 3600, True)]
+)
+def test_sliding_expiry(pyramid_request, refresh_interval, cookie_age, touched):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', refresh_interval=refresh_interval
+    )
+    session_factory.redis = pretend.stub(get=lambda key: b'\x81\xa3foo\xa3bar')
+
+    now = int(time.time())
+    session_factory.signer.get_timestamp = lambda: now - cookie_age
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1.a').decode('utf-8')
+
+    session = session_factory(pyramid_request)
+
+    assert session == {'foo': 'bar'}
+    assert session.touched is touched
+    assert not session.should_save()
+
+
+def test_session_serializer(pyramid_request):
+    serializer = serialization.CompactSerializer(threshold=0)
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', serializer=serializer
+    )
+    session_factory.redis = RoundTripRedis()
+
+    session = Session({'_csrf_token': 'token', 'foo': 'bar'})
+    session.changed()
+    pyramid_request.session = session
+    pyramid_request.scheme = 'https'
+    response = pretend.stub(set_cookie=pretend.call_recorder(lambda *a, **kw: None))
+    session_factory._process_response(pyramid_request, response)
+
+    data = session_factory.redis.redis.get(f'armonaut/session/{session.sid}')
+    assert data[:2] == b'\xc1\x11'
+
+    name, value = response.set_cookie.calls[0].args
+    pyramid_request.cookies[name] = value.decode('utf-8')
+
+    assert session_factory(pyramid_request) == {'_csrf_token': 'token', 'foo': 'bar'}
+
+
+def test_invalid_session_data(pyramid_request):
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+    session_factory.redis = pretend.stub(get=lambda key: b'\xc1\x01invalid')
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1.a').decode('utf-8')
+
+    session = session_factory(pyramid_request)
+
+    assert session == {}
+    assert session.new
+
+
+def _cookie_factory(**kwargs):
+    session_factory = CookieSessionFactory('secret', 'redis://localhost:6379/0', **kwargs)
+    session_factory.redis = RoundTripRedis()
+    return session_factory
+
+
+def _save(session_factory, request, session):
+    request.session = session
+    request.scheme = 'https'
+    response = pretend.stub(
+        set_cookie=pretend.call_recorder(lambda *a, **kw: None),
+        delete_cookie=pretend.call_recorder(lambda name: None)
+    )
+    session_factory._process_response(request, response)
+    return response
+
+
+def _reload(session_factory, response):
+    request = pyramid.testing.DummyRequest()
+    name, value = response.set_cookie.calls[0].args
+    request.cookies[name] = value if isinstance(value, str) else value.decode('utf-8')
+    return request, session_factory(request)
+
+
+def test_cookie_session_stored_in_cookie(pyramid_request):
+    session_factory = _cookie_factory()
+    session = Session()
+    session['foo'] = 'bar'
+
+    response = _save(session_factory, pyramid_request, session)
+
+    name, value = response.set_cookie.calls[0].args
+    assert name == 'session'
+    assert value.startswith('~')
+    assert session_factory.redis.round_trips == 0
+
+    _, session = _reload(session_factory, response)
+    assert session == {'foo': 'bar'}
+    assert not session.new
+    assert session_factory.redis.round_trips == 0
+
+
+def test_cookie_session_too_large_stored_in_redis(pyramid_request):
+    session_factory = _cookie_factory(max_size=256)
+    session = Session()
+    session['foo'] = large = crypto.random_token(192)
+
+    response = _save(session_factory, pyramid_request, session)
+
+    name, value = response.set_cookie.calls[0].args
+    assert not value.decode('utf-8').startswith('~')
+    assert session_factory.redis.round_trips == 1
+
+    _, loaded = _reload(session_factory, response)
+    assert loaded == {'foo': large}
+    assert loaded.sid == session.sid
+
+
+@pytest.mark.parametrize('storage', ['string', 'hash'])
+def test_cookie_session_grows_into_redis(pyramid_request, storage):
+    session_factory = _cookie_factory(max_size=256, storage=storage)
+    session = Session()
+    session.update({'a': 'x', 'b': 'keep-me'})
+    response = _save(session_factory, pyramid_request, session)
+
+    request, session = _reload(session_factory, response)
+    session['a'] = large = crypto.random_token(400)
+    response = _save(session_factory, request, session)
+
+    name, value = response.set_cookie.calls[0].args
+    assert not value.decode('utf-8').startswith('~')
+
+    _, loaded = _reload(session_factory, response)
+    assert loaded == {'a': large, 'b': 'keep-me'}
+
+
+def test_cookie_session_moved_out_of_redis(pyramid_request):
+    session_factory = _cookie_factory(max_size=256)
+    session = Session()
+    session['foo'] = crypto.random_token(192)
+    response = _save(session_factory, pyramid_request, session)
+
+    request, session = _reload(session_factory, response)
+    session['foo'] = 'bar'
+    response = _save(session_factory, request, session)
+
+    name, value = response.set_cookie.calls[0].args
+    assert value.startswith('~')
+    assert session_factory.redis.redis.keys('armonaut/session/*') == []
+
+
+def test_cookie_session_invalidated(pyramid_request):
+    session_factory = _cookie_factory()
+    session = Session()
+    session['foo'] = 'bar'
+    response = _save(session_factory, pyramid_request, session)
+
+    request, session = _reload(session_factory, response)
+    session.invalidate()
+    response = _save(session_factory, request, session)
+
+    assert response.set_cookie.calls == []
+    assert response.delete_cookie.calls == [pretend.call('session')]
+    assert session_factory.redis.round_trips == 0
+
+
+def test_cookie_session_touched(pyramid_request, monkeypatch):
+    session_factory = _cookie_factory(refresh_interval=300)
+    now = int(time.time())
+    session = Session()
+    session['foo'] = 'bar'
+    with monkeypatch.context() as m:
+        m.setattr(crypto.TimestampSigner, 'get_timestamp', lambda self: now - 600)
+        response = _save(session_factory, pyramid_request, session)
+
+    request, session = _reload(session_factory, response)
+    assert session.touched
+    response = _save(session_factory, request, session)
+
+    assert len(response.set_cookie.calls) == 1
+    assert session_factory.redis.round_trips == 0
+
+
+@pytest.mark.parametrize('value', ['~invalid', '~' + 'a' * 10, '~é'])
+def test_cookie_session_tampered(pyramid_request, value):
+    session_factory = _cookie_factory()
+    pyramid_request.cookies['session'] = value
+
+    session = session_factory(pyramid_request)
+
+    assert session == {}
+    assert session.new
+
+
+def test_cookie_session_expired(pyramid_request):
+    session_factory = _cookie_factory(max_age=60)
+    pyramid_request.cookies['session'] = '~' + crypto.URLSafeSerializer(
+        'secret', salt='session-cookie',
+        signer_kwargs={'key_derivation': 'hmac'}
+    ).dumps({'foo': 'bar'})
+
+    assert session_factory(pyramid_request) == {'foo': 'bar'}
+
+    session_factory.max_age = -1
+    assert session_factory(pyramid_request) == {}
+
+
+@pytest.mark.skipif(crypto.Fernet is None, reason='cryptography is not installed')
+def test_cookie_session_encrypted(pyramid_request):
+    session_factory = _cookie_factory(encrypt=True, max_size=4096)
+    session = Session()
+    session['foo'] = 'bar'
+
+    response = _save(session_factory, pyramid_request, session)
+
+    name, value = response.set_cookie.calls[0].args
+    assert value.startswith('~')
+    with pytest.raises(crypto.BadData):
+        _cookie_factory().cookie_serializer.loads(value[1:])
+
+    _, session = _reload(session_factory, response)
+    assert session == {'foo': 'bar'}
+
+
+def _sharded_factory(**kwargs):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0, redis://localhost:6379/1', **kwargs
+    )
+    # Each shard is a separate fakeredis database.
+    for db, shard in enumerate(sorted(session_factory.shards)):
+        session_factory.shards[shard] = fakeredis.FakeStrictRedis(db=db)
+        session_factory.shards[shard].flushdb()
+    return session_factory
+
+
+def test_sharded_session_factory_init():
+    session_factory = _sharded_factory()
+
+    assert session_factory.redis is None
+    assert session_factory.ring.nodes == [
+        'redis://localhost:6379/0', 'redis://localhost:6379/1'
+    ]
+
+
+@pytest.mark.parametrize('storage', ['string', 'hash'])
+def test_sharded_sessions_round_trip(pyramid_request, storage):
+    session_factory = _sharded_factory(storage=storage)
+
+    sessions = {}
+    for i in range(20):
+        session = Session()
+        session['user'] = i
+        response = _save(session_factory, pyramid_request, session)
+        sessions[i] = _reload(session_factory, response)[1]
+
+    assert {i: session['user'] for i, session in sessions.items()} == {i: i for i in range(20)}
+    for i, session in sessions.items():
+        shard = session_factory.shards[session_factory.ring.get_node(session.sid)]
+        assert shard.exists(f'armonaut/session/{session.sid}')
+    assert all(shard.keys() for shard in session_factory.shards.values())
+
+
+def test_sharded_invalidate_deletes_from_every_shard(pyramid_request):
+    session_factory = _sharded_factory()
+    session_ids = [crypto.random_token() for _ in range(10)]
+    for sid in session_ids:
+        session_factory._client(session_factory._shard(sid)).set(
+            f'armonaut/session/{sid}', b'\x80'
+        )
+
+    session = Session({'user': 1}, session_ids[0], False)
+    session.invalidated.update(session_ids[1:])
+    session.invalidate()
+    _save(session_factory, pyramid_request, session)
+
+    assert all(not shard.keys() for shard in session_factory.shards.values())
+
+
+def test_unreachable_shard_gives_new_session(pyramid_request):
+    session_factory = RedisSessionFactory('secret', 'redis://localhost:6379/0')
+
+    def unreachable(*args):
+        raise redis.ConnectionError()
+
+    session_factory.redis = pretend.stub(get=unreachable)
+    pyramid_request.cookies['session'] = session_factory.signer.sign(b'1.a').decode('utf-8')
+
+    session = session_factory._process_request(pyramid_request)
+
+    assert session.new
+    assert dict(session) == {}
+
+
+def test_unreachable_shard_on_save(pyramid_request):
+    session_factory = RedisSessionFactory(
+        'secret', 'redis://localhost:6379/0', cache=SessionCache()
+    )
+
+    def unreachable():
+        raise redis.ConnectionError()
+
+    session_factory.redis = pretend.stub(
+        pipeline=lambda: pretend.stub(setex=lambda *args: None,
+                                      __len__=lambda: 1, execute=unreachable)
+    )
+    session = Session()
+    session['user'] = 1
+
+    response = _save(session_factory, pyramid_request, session)
+
+    assert len(response.set_cookie.calls) == 1
+    assert session_factory.cache.get(session.sid, session.version) is None
@@ -12,14 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import queue
+import threading
+import time
 import mock
+import fakeredis
 import pretend
 import pytest
+import celery
 import transaction
 from celery import Celery
+from celery.app.task import Context
+from celery.schedules import crontab
+from kombu import serialization as kombu_serialization
 from pyramid import scripting
+from pyramid.config import Configurator
+from pyramid.threadlocal import get_current_request
 from pyramid_retry import RetryableException
 from armonaut import tasks
+from armonaut.utils import connections, serialization
 
 
 def test_header():
@@ -92,61 +103,228 @@ def test_without_request(monkeypatch):
     assert inner_super.calls == [pretend.call()]
 
 
-def test_request_after_commit(monkeypatch):
-    manager = pretend.stub(
-        addAfterCommitHook=pretend.call_recorder(lambda *a, **kw: None)
-    )
-    request = pretend.stub(
-        tm=pretend.stub(get=pretend.call_recorder(lambda: manager))
+def _published(monkeypatch, fail=()):
+    published = []
+
+    def apply_async(task, *args, **kwargs):
+        if args[0][0] in fail:
+            raise ConnectionError()
+        published.append((task.name, args, kwargs))
+
+    monkeypatch.setattr(celery.Task, 'apply_async', apply_async)
+    return published
+
+
+def _transaction_request(monkeypatch):
+    request = pretend.stub(tm=transaction.TransactionManager(explicit=True))
+    monkeypatch.setattr(tasks, 'get_current_request', lambda: request)
+    return request
+
+
+def _producer_app():
+    producer = pretend.stub()
+    app = Celery(set_as_current=False)
+    app.producer_or_acquire = pretend.call_recorder(
+        lambda: pretend.stub(__enter__=lambda: producer, __exit__=lambda *args: None)
     )
-    get_current_request = pretend.call_recorder(lambda: request)
-    monkeypatch.setattr(tasks, 'get_current_request', get_current_request)
+    return app, producer
 
-    task = tasks.Task()
-    task.app = Celery()
 
-    args = (pretend.stub(), pretend.stub())
-    kwargs = {'foo': pretend.stub()}
+def _tasks(app, *names):
+    return [type(name, (tasks.Task,), {'name': name, 'app': app})() for name in names]
 
-    assert task.apply_async(*args, **kwargs) is None
-    assert get_current_request.calls == [pretend.call()]
-    assert request.tm.get.calls == [pretend.call()]
-    assert manager.addAfterCommitHook.calls == [
-        pretend.call(task._after_commit_hook, args=args, kwargs=kwargs)
+
+def test_request_after_commit(monkeypatch):
+    published = _published(monkeypatch)
+    request = _transaction_request(monkeypatch)
+    app, producer = _producer_app()
+    build, notify = _tasks(app, 'build', 'notify')
+
+    with request.tm:
+        assert build.apply_async((1,), countdown=5) is None
+        assert notify.apply_async((2,)) is None
+        assert build.apply_async((3,)) is None
+        assert published == []
+
+    assert published == [
+        ('build', ((1,),), {'countdown': 5, 'producer': producer}),
+        ('notify', ((2,),), {'producer': producer}),
+        ('build', ((3,),), {'producer': producer})
     ]
+    assert len(app.producer_or_acquire.calls) == 1
 
 
-@pytest.mark.parametrize('success', [True, False])
-def test_after_commit_hook(monkeypatch, success):
-    args = [pretend.stub(), pretend.stub()]
-    kwargs = {'foo': pretend.stub(), 'bar': pretend.stub()}
+def test_request_after_abort(monkeypatch):
+    published = _published(monkeypatch)
+    request = _transaction_request(monkeypatch)
+    app, _ = _producer_app()
+    build, = _tasks(app, 'build')
 
-    super_class = pretend.stub(
-        apply_async=pretend.call_recorder(lambda *a, **kw: None)
-    )
-    real_super = __builtins__['super']
-    inner_super = pretend.call_recorder(lambda *a, **kw: super_class)
+    request.tm.begin()
+    build.apply_async((1,))
+    request.tm.abort()
 
-    def fake_super(*args, **kwargs):
-        if not args and not kwargs:
-            return inner_super(*args, **kwargs)
-        else:
-            return real_super(*args, **kwargs)
+    assert published == []
+    assert app.producer_or_acquire.calls == []
 
-    get_current_request = pretend.call_recorder(lambda: None)
-    monkeypatch.setattr(tasks, 'get_current_request', get_current_request)
 
-    task = tasks.Task()
-    task.app = Celery()
+def test_after_commit_hook_reports_failures(monkeypatch):
+    published = _published(monkeypatch, fail={1})
+    error = pretend.call_recorder(lambda *args, **kwargs: None)
+    monkeypatch.setattr(tasks.logger, 'error', error)
+    app, producer = _producer_app()
+    build, = _tasks(app, 'build')
 
-    monkeypatch.setitem(__builtins__, 'super', fake_super)
+    tasks._after_commit_hook(True, app, [(build, ((1,),), {}), (build, ((2,),), {})])
+
+    assert published == [('build', ((2,),), {'producer': producer})]
+    assert error.calls == [pretend.call('Unable to publish task %s', 'build', exc_info=mock.ANY)]
+
+
+def test_after_commit_hook_without_producer(monkeypatch):
+    error = pretend.call_recorder(lambda *args, **kwargs: None)
+    monkeypatch.setattr(tasks.logger, 'error', error)
+    app = Celery(set_as_current=False)
+
+    def producer_or_acquire():
+        raise ConnectionError()
+
+    app.producer_or_acquire = producer_or_acquire
+    build, notify = _tasks(app, 'build', 'notify')
+
+    tasks._after_commit_hook(True, app, [(build, ((1,),), {}), (notify, ((2,),), {})])
+
+    assert [call.args[1] for call in error.calls] == ['build', 'notify']
+
+
+def test_after_commit_hook_uses_publisher(monkeypatch):
+    published = _published(monkeypatch)
+    app, _ = _producer_app()
+    app.task_publisher = pretend.stub(submit=pretend.call_recorder(lambda pending: None))
+    build, = _tasks(app, 'build')
+    pending = [(build, ((1,),), {})]
+
+    tasks._after_commit_hook(True, app, pending)
 
-    task._after_commit_hook(success, *args, **kwargs)
+    assert app.task_publisher.submit.calls == [pretend.call(pending)]
+    assert published == []
 
-    if success:
-        assert inner_super.calls == [pretend.call()]
-    else:
-        assert inner_super.calls == []
+
+def test_publisher_publishes_in_background(monkeypatch):
+    published = _published(monkeypatch)
+    app, producer = _producer_app()
+    build, = _tasks(app, 'build')
+    publisher = tasks.TaskPublisher(app)
+
+    publisher.submit([(build, ((1,),), {}), (build, ((2,),), {})])
+    publisher.submit([(build, ((3,),), {})])
+
+    assert publisher.flush(timeout=5)
+    assert [args for _, (args,), _ in published] == [(1,), (2,), (3,)]
+    assert publisher._thread.name == 'armonaut-task-publisher'
+    metrics = publisher.metrics()
+    assert metrics['depth'] == 0
+    assert metrics['batches'] == 2
+    assert metrics['published'] == 3
+    assert metrics['failed'] == 0
+    assert metrics['latency_max'] >= metrics['latency_avg'] > 0
+    publisher.close()
+    assert not publisher._thread.is_alive()
+
+
+def test_publisher_retries_with_jitter(monkeypatch):
+    failures = {1: 2}
+    published = []
+
+    def apply_async(task, args, **kwargs):
+        if failures.get(args[0]):
+            failures[args[0]] -= 1
+            raise ConnectionError()
+        published.append(args)
+
+    monkeypatch.setattr(celery.Task, 'apply_async', apply_async)
+    sleep = pretend.call_recorder(lambda seconds: None)
+    monkeypatch.setattr(tasks.time, 'sleep', sleep)
+    monkeypatch.setattr(tasks.random, 'uniform', lambda low, high: high)
+    app, _ = _producer_app()
+    build, = _tasks(app, 'build')
+    publisher = tasks.TaskPublisher(app, retry_delay=0.1)
+
+    publisher._publish(0.0, [(build, ((1,),), {}), (build, ((2,),), {})])
+
+    assert published == [(2,), (1,)]
+    assert [round(call.args[0], 2) for call in sleep.calls] == [0.15, 0.3]
+    assert publisher.metrics()['retried'] == 2
+    assert publisher.metrics()['published'] == 2
+
+
+def test_publisher_gives_up(monkeypatch):
+    _published(monkeypatch, fail={1})
+    monkeypatch.setattr(tasks.time, 'sleep', lambda seconds: None)
+    error = pretend.call_recorder(lambda *args, **kwargs: None)
+    monkeypatch.setattr(tasks.logger, 'error', error)
+    app, _ = _producer_app()
+    build, = _tasks(app, 'build')
+    publisher = tasks.TaskPublisher(app, retries=2)
+
+    publisher._publish(0.0, [(build, ((1,),), {})])
+
+    assert len(error.calls) == 1
+    assert publisher.metrics()['failed'] == 1
+    assert publisher.metrics()['retried'] == 2
+
+
+def test_publisher_backpressure(monkeypatch):
+    published = _published(monkeypatch)
+    app, _ = _producer_app()
+    build, = _tasks(app, 'build')
+    publisher = tasks.TaskPublisher(app, max_size=1, put_timeout=0.01)
+    full = queue.Queue(maxsize=1)
+    full.put(None)
+    publisher._start = lambda: full
+
+    publisher.submit([(build, ((1,),), {})])
+
+    assert len(published) == 1
+    assert publisher.metrics()['overflowed'] == 1
+    assert publisher.metrics()['depth'] == 0
+
+
+def test_publisher_close_drops_backlog(monkeypatch):
+    published = threading.Event()
+    blocked = threading.Event()
+
+    def apply_async(task, args, **kwargs):
+        published.set()
+        blocked.wait(5)
+
+    monkeypatch.setattr(celery.Task, 'apply_async', apply_async)
+    warning = pretend.call_recorder(lambda *args: None)
+    monkeypatch.setattr(tasks.logger, 'warning', warning)
+    app, _ = _producer_app()
+    build, = _tasks(app, 'build')
+    publisher = tasks.TaskPublisher(app, max_size=1)
+
+    publisher.submit([(build, ((1,),), {})])
+    assert published.wait(5)
+    publisher.submit([(build, ((2,),), {})])
+
+    start = time.monotonic()
+    publisher.close(timeout=0.05)
+
+    assert time.monotonic() - start < 1
+    assert warning.calls == [
+        pretend.call('Dropping %d task batches that were not published', 1)
+    ]
+    blocked.set()
+
+
+def test_publisher_close_without_thread():
+    publisher = tasks.TaskPublisher(Celery(set_as_current=False))
+
+    assert publisher.flush()
+    publisher.close()
+    assert publisher.metrics()['depth'] == 0
 
 
 def test_creates_request(monkeypatch):
@@ -303,6 +481,204 @@ def test_after_return_closes_env_runs_request_callbacks():
     assert obj.request.pyramid_env['closer'].calls == [pretend.call()]
 
 
+def _registry():
+    config = Configurator()
+    config.add_request_method(lambda request: object(), 'thing', reify=True)
+    config.commit()
+    return config.registry
+
+
+def test_environment_pool_reuses_environment():
+    registry = _registry()
+    pool = tasks.EnvironmentPool()
+
+    env = pool.acquire(registry)
+    request = env['request']
+    thing = request.thing
+    tm = request.tm
+    assert get_current_request() is request
+    pool.release(env)
+    assert get_current_request() is None
+
+    assert pool.acquire(registry) is env
+    assert get_current_request() is request
+    assert request.thing is not thing
+    assert request.tm is not tm
+    assert isinstance(request.tm, transaction.TransactionManager)
+    pool.release(env)
+
+
+def test_environment_pool_resets_request():
+    registry = _registry()
+    pool = tasks.EnvironmentPool()
+    env = pool.acquire(registry)
+    request = env['request']
+    finished = pretend.call_recorder(lambda request: None)
+
+    request.user = 'user'
+    request.environ['armonaut.thing'] = 1
+    request.add_finished_callback(finished)
+    pool.release(env)
+    pool.acquire(registry)
+
+    assert finished.calls == [pretend.call(request)]
+    assert not hasattr(request, 'user')
+    assert 'armonaut.thing' not in request.environ
+    assert request.registry is registry
+    pool.release(env)
+
+
+def test_environment_pool_size():
+    registry = _registry()
+    pool = tasks.EnvironmentPool(size=1)
+
+    first, second = pool.acquire(registry), pool.acquire(registry)
+    pool.release(second)
+    pool.release(first)
+
+    assert pool._idle == [second]
+    assert list(pool._snapshots) == [id(second)]
+    assert get_current_request() is None
+
+
+def test_task_uses_environment_pool():
+    registry = _registry()
+    obj = tasks.Task()
+    obj.app = Celery(set_as_current=False)
+    obj.app.pyramid_config = pretend.stub(registry=registry)
+
+    request = obj.get_request()
+    obj.after_return(None, None, None, None, None, None)
+
+    assert obj.app.pyramid_environments._idle == [obj.request.pyramid_env]
+    assert obj.request.pyramid_env['request'] is request
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib', 'lz4'])
+def test_serializers(compression):
+    if compression is not None and compression not in serialization.COMPRESSIONS:
+        pytest.skip(f'{compression} is not installed')
+    tasks.register_serializers(threshold=64)
+    name = tasks.serializer_name(compression)
+    body = ([{'build': 12, 'log': 'x' * 200}], {'project': 'Armonaut/armonaut'}, {})
+
+    content_type, content_encoding, data = kombu_serialization.dumps(body, serializer=name)
+    small = kombu_serialization.dumps({'build': 12}, serializer=name)[2]
+
+    assert content_type == tasks.CONTENT_TYPE
+    assert content_encoding == 'binary'
+    assert kombu_serialization.loads(data, content_type, content_encoding,
+                                     accept={tasks.CONTENT_TYPE}) == list(body)
+    assert (data[:1] == b'\xc1') is (compression is not None)
+    assert small[:1] != b'\xc1'
+
+
+def test_serializer_name():
+    assert tasks.serializer_name() == 'armonaut'
+    assert tasks.serializer_name('zlib') == 'armonaut+zlib'
+    with pytest.raises(ValueError):
+        tasks.serializer_name('gzip')
+
+
+@pytest.mark.parametrize(
+    ['options', 'expected'],
+    [
+        ({}, {'shared': False}),
+        ({'compression': None}, {'shared': False, 'serializer': 'armonaut'}),
+        ({'compression': 'zlib', 'shared': True}, {'shared': True, 'serializer': 'armonaut+zlib'}),
+        ({'serializer': 'json'}, {'shared': False, 'serializer': 'json'}),
+        ({'result': 'ignore'}, {'shared': False, 'ignore_result': True, 'result_policy': 'ignore'}),
+        ({'result': 'compressed', 'result_ttl': 60},
+         {'shared': False, 'ignore_result': False, 'result_policy': 'compressed', 'result_ttl': 60})
+    ]
+)
+def test_task_options(monkeypatch, options, expected):
+    callbacks = []
+    monkeypatch.setattr(tasks.venusian, 'attach', lambda wrapped, callback: callbacks.append(callback))
+    app = pretend.stub(task=pretend.call_recorder(lambda **kwargs: lambda wrapped: wrapped))
+    scanner = pretend.stub(config=pretend.stub(registry={'celery.app': app}))
+
+    def build(request):
+        pass
+
+    assert tasks.task(**options)(build) is build
+    callbacks[0](scanner, 'build', build)
+
+    assert app.task.calls == [pretend.call(**expected)]
+
+
+def test_task_unknown_result_policy():
+    with pytest.raises(ValueError):
+        tasks.task(result='forever')
+
+
+def _result_backend(monkeypatch, serializer='armonaut+zlib'):
+    monkeypatch.setattr(connections, 'get_connection_pool', lambda url, **kwargs: None)
+    tasks.register_serializers(threshold=64)
+    app = Celery(set_as_current=False)
+    app.conf.update(
+        result_backend=tasks._result_backend('redis://localhost:6379/3'),
+        result_serializer=serializer,
+        result_expires=3600,
+        accept_content=['armonaut', 'json']
+    )
+    backend = app.backend
+    backend.client = fakeredis.FakeStrictRedis()
+    backend.client.flushall()
+    return app, backend
+
+
+@pytest.mark.parametrize(
+    ['serializer', 'options', 'ttl', 'compressed'],
+    [
+        ('armonaut+zlib', {}, 3600, True),
+        ('armonaut+zlib', {'result_policy': 'store', 'result_ttl': 60}, 60, False),
+        ('armonaut', {'result_policy': 'compressed'}, 3600, True),
+        ('json', {'result_policy': 'compressed', 'result_ttl': 60}, 60, False)
+    ]
+)
+def test_result_policies(monkeypatch, serializer, options, ttl, compressed):
+    app, backend = _result_backend(monkeypatch, serializer)
+
+    @app.task(shared=False, **options)
+    def build():
+        pass
+
+    result = {'log': 'x' * 200}
+    backend.store_result('task-1', result, 'SUCCESS', request=Context(task=build.name))
+    key = backend.get_key_for_task('task-1')
+
+    assert 0 < backend.client.ttl(key) <= ttl
+    assert (backend.client.get(key)[:1] == b'\xc1') is compressed
+    assert backend.get_task_meta('task-1')['result'] == result
+    assert backend.serializer == serializer
+    assert backend.expires == 3600
+
+
+def test_expire_results(monkeypatch):
+    app, backend = _result_backend(monkeypatch)
+    client = backend.client
+    client.set(backend.get_key_for_task('old-1'), b'1')
+    client.set(backend.get_key_for_task('old-2'), b'2')
+    client.setex(backend.get_key_for_task('new'), 60, b'3')
+    client.set('unrelated', b'4')
+    request = pretend.stub(registry=pretend.stub(settings={}, __getitem__={'celery.app': app}.__getitem__))
+
+    assert tasks.expire_results(request, batch_size=1) == 2
+
+    assert 0 < client.ttl(backend.get_key_for_task('old-1')) <= 3600
+    assert 0 < client.ttl(backend.get_key_for_task('new')) <= 60
+    assert client.ttl('unrelated') in {None, -1}
+
+
+def test_expire_results_other_backend():
+    app = Celery(set_as_current=False)
+    app.conf.result_backend = 'cache+memory://'
+    request = pretend.stub(registry={'celery.app': app})
+
+    assert tasks.expire_results(request) == 0
+
+
 def test_get_task():
     task_func = pretend.stub(__name__='task_func', __module__='tests.foo')
     task_obj = pretend.stub()
@@ -381,13 +757,15 @@ def test_includeme():
         action=pretend.call_recorder(lambda *a, **kw: None),
         add_directive=pretend.call_recorder(lambda *a, **kw: None),
         add_request_method=pretend.call_recorder(lambda *a, **kw: None),
+        add_periodic_task=pretend.call_recorder(lambda *a, **kw: None),
         registry=pretend.stub(
             __getitem__=registry_dict.__getitem__,
             __setitem__=registry_dict.__setitem__,
             settings={
-                'celery.broker_url': pretend.stub(),
-                'celery.result_url': pretend.stub(),
-                'celery.scheduler_url': pretend.stub(),
+                'celery.broker_url': 'redis://localhost:6379/0',
+                'celery.result_url': 'redis://localhost:6379/1',
+                'celery.scheduler_url': 'redis://localhost:6379/2',
+                'celery.max_connections': 20,
             },
         ),
     )
@@ -397,15 +775,21 @@ def test_includeme():
 
     assert app.Task is tasks.Task
     assert app.pyramid_config is config
+    assert app.pyramid_environments.size == 4
     for key, value in {
             'broker_url': config.registry.settings['celery.broker_url'],
+            'broker_pool_limit': 20,
+            'broker_transport_options': {'max_connections': 20},
+            'redis_max_connections': 20,
             'worker_disable_rate_limits': True,
-            'result_backend': config.registry.settings['celery.result_url'],
-            'result_serializer': 'json',
-            'task_serializer': 'json',
-            'accept_content': ['msgpack', 'json'],
-            'result_compression': 'gzip',
+            'result_backend': 'armonaut.tasks:RedisBackend+redis://localhost:6379/1',
+            'result_serializer': 'armonaut+zlib',
+            'task_serializer': 'armonaut+zlib',
+            'accept_content': ['armonaut', 'msgpack', 'json'],
+            'result_compression': None,
             'task_queue_ha_policy': 'all',
+            'task_ignore_result': True,
+            'result_expires': 86400,
             'REDBEAT_REDIS_URL': (
                 config.registry.settings['celery.scheduler_url'])}.items():
         assert app.conf[key] == value
@@ -428,3 +812,105 @@ def test_includeme():
     assert config.add_request_method.calls == [
         pretend.call(tasks._get_task_from_request, name='task', reify=True),
     ]
+    assert config.add_periodic_task.calls == [
+        pretend.call(crontab(minute=0), tasks.expire_results)
+    ]
+
+
+def _includeme_config(**settings):
+    registry_dict = {}
+    return pretend.stub(
+        action=lambda *a, **kw: None,
+        add_directive=lambda *a, **kw: None,
+        add_request_method=lambda *a, **kw: None,
+        add_periodic_task=lambda *a, **kw: None,
+        registry=pretend.stub(
+            __getitem__=registry_dict.__getitem__,
+            __setitem__=registry_dict.__setitem__,
+            settings={
+                'celery.broker_url': 'redis://localhost:6379/0',
+                'celery.result_url': 'redis://localhost:6379/1',
+                'celery.scheduler_url': 'redis://localhost:6379/2',
+                **settings
+            },
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    ['settings', 'ignore_result', 'result_serializer'],
+    [
+        ({'celery.result_policy': 'store'}, False, 'armonaut'),
+        ({'celery.result_policy': 'compressed'}, False, 'armonaut+zlib'),
+        ({'celery.result_policy': 'compressed', 'celery.serializer': 'armonaut'},
+         False, 'armonaut+zlib'),
+        ({'celery.result_policy': 'store', 'celery.serializer': 'json'}, False, 'json'),
+        ({'celery.serializer': 'armonaut'}, True, 'armonaut')
+    ]
+)
+def test_includeme_result_policy(settings, ignore_result, result_serializer):
+    config = _includeme_config(**settings)
+
+    tasks.includeme(config)
+
+    app = config.registry['celery.app']
+    assert app.conf.task_ignore_result is ignore_result
+    assert app.conf.result_serializer == result_serializer
+
+
+def test_includeme_unknown_result_policy():
+    with pytest.raises(ValueError):
+        tasks.includeme(_includeme_config(**{'celery.result_policy': 'ignored'}))
+
+
+def test_includeme_publish_async(monkeypatch):
+    register = pretend.call_recorder(lambda func: None)
+    monkeypatch.setattr(tasks.atexit, 'register', register)
+    connect = pretend.call_recorder(lambda receiver, weak: None)
+    monkeypatch.setattr(celery.signals.worker_process_shutdown, 'connect', connect)
+    registry_dict = {}
+    config = pretend.stub(
+        action=lambda *a, **kw: None,
+        add_directive=lambda *a, **kw: None,
+        add_request_method=lambda *a, **kw: None,
+        add_periodic_task=lambda *a, **kw: None,
+        registry=pretend.stub(
+            __getitem__=registry_dict.__getitem__,
+            __setitem__=registry_dict.__setitem__,
+            settings={
+                'celery.broker_url': 'redis://localhost:6379/0',
+                'celery.result_url': 'redis://localhost:6379/1',
+                'celery.scheduler_url': 'redis://localhost:6379/2',
+                'celery.publish_async': True,
+                'celery.publish_queue_size': 10
+            },
+        ),
+    )
+
+    tasks.includeme(config)
+
+    publisher = registry_dict['celery.app'].task_publisher
+    assert publisher.max_size == 10
+    assert register.calls == [pretend.call(publisher.close)]
+    assert len(connect.calls) == 1
+
+
+@pytest.mark.parametrize(
+    ('url', 'expected'),
+    [('redis://localhost:6379/0', 'armonaut.tasks:RedisBackend+redis://localhost:6379/0'),
+     ('rediss://localhost:6379/0', 'armonaut.tasks:RedisBackend+rediss://localhost:6379/0'),
+     ('rpc://', 'rpc://')]
+)
+def test_result_backend(url, expected):
+    assert tasks._result_backend(url) == expected
+
+
+def test_redis_backend_shares_connection_pool(monkeypatch):
+    monkeypatch.setattr(connections, '_pools', {})
+    pool = connections.get_connection_pool('redis://localhost:6379/3')
+
+    app = Celery(set_as_current=False)
+    app.conf.result_backend = tasks._result_backend('redis://localhost:6379/3')
+
+    assert isinstance(app.backend, tasks.RedisBackend)
+    assert app.backend.client.connection_pool is pool
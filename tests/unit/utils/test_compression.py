@@ -12,33 +12,69 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
+import zlib
 import pytest
 import pretend
 from pyramid.response import Response
-from webob.acceptparse import Accept, NoAccept
-from webob.response import gzip_app_iter
-from armonaut.utils.compression import (
-    _compressor as compressor,
-    compression_tween_factory
+from pyramid.request import Request
+from armonaut.cache.compressed import CompressedResponseCache
+from armonaut.cache.http import ResponseFinaliser
+from armonaut.cache.etag import body_etag
+from armonaut.utils import compression
+
+requires_brotli = pytest.mark.skipif(
+    compression.brotli is None, reason='brotli is not installed'
 )
+requires_zstandard = pytest.mark.skipif(
+    compression.zstandard is None, reason='zstandard is not installed'
+)
+
+
+def _decompress(data, encoding):
+    # Streaming decompressors also accept output that was only flushed.
+    if encoding == 'br':
+        return compression.brotli.Decompressor().process(data)
+    elif encoding == 'zstd':
+        return compression.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+
+ENCODINGS = [
+    'gzip',
+    pytest.param('br', marks=requires_brotli),
+    pytest.param('zstd', marks=requires_zstandard)
+]
+
+
+def _request(encoding='identity', **attrs):
+    request = Request.blank('/', headers={'Accept-Encoding': encoding})
+    for name, value in attrs.items():
+        setattr(request, name, value)
+    return request
 
 
 @pytest.mark.parametrize('vary', [['Cookie'], ['Authorization'], ['Cookie', 'Authorization']])
 def test_compression_stops_on_vary(vary):
-    request = pretend.stub()
-    response = pretend.stub(vary=vary)
+    request = _request('gzip')
+    response = Response(body=b'x' * 1000)
+    response.vary = vary
 
-    compressor(request, response)
+    ResponseFinaliser()(request, response)
+
+    assert response.content_encoding is None
+    assert response.vary == tuple(vary)
 
 
 def test_compression_stops_if_content_encoded():
-    request = pretend.stub()
-    response = pretend.stub(
-        headers={'Content-Encoding': 'anything'},
-        vary=None
-    )
+    request = _request('gzip')
+    response = Response(body=b'x' * 1000)
+    response.content_encoding = 'anything'
 
-    compressor(request, response)
+    ResponseFinaliser()(request, response)
+
+    assert response.body == b'x' * 1000
+    assert response.vary is None
 
 
 @pytest.mark.parametrize(
@@ -49,101 +85,300 @@ def test_compression_stops_if_content_encoded():
     ]
 )
 def test_sets_vary_accept_encoding(vary, expected):
-    request = pretend.stub(accept_encoding=NoAccept())
-    response = Response(body=b'foo')
+    request = _request()
+    response = Response(body=b'foo' * 100)
     response.vary = vary
 
-    compressor(request, response)
+    ResponseFinaliser()(request, response)
 
     assert set(response.vary) == expected
 
 
-def test_compresses_non_streaming():
-    body = b'x' * 100
-    compressed = b''.join(list(gzip_app_iter([body])))
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_compresses_non_streaming(encoding):
+    body = b'x' * 1000
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = _request(encoding)
     response = Response(body=body)
     response.md5_etag()
 
     original_etag = response.etag
 
-    compressor(request, response)
+    ResponseFinaliser()(request, response)
 
-    assert response.content_encoding == 'gzip'
-    assert response.content_length == len(compressed)
-    assert response.body == compressed
+    assert response.content_encoding == encoding
+    assert response.content_length == len(response.body)
+    assert _decompress(response.body, encoding) == body
     assert response.etag != original_etag
 
 
-def test_compresses_streaming():
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_compresses_streaming(encoding):
     body = b'x' * 100
-    compressed = b''.join(list(gzip_app_iter([body])))
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = _request(encoding)
     response = Response(app_iter=iter([body]))
 
-    compressor(request, response)
+    ResponseFinaliser()(request, response)
 
-    assert response.content_encoding == 'gzip'
+    assert response.content_encoding == encoding
     assert response.content_length is None
-    assert response.body == compressed
+    assert _decompress(response.body, encoding) == body
 
 
 def test_compresses_streaming_with_etag():
     body = b'x' * 100
-    compressed = b''.join(list(gzip_app_iter([body])))
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = _request('gzip')
     response = Response(app_iter=iter([body]))
     response.etag = 'foo'
 
-    compressor(request, response)
+    ResponseFinaliser()(request, response)
 
     assert response.content_encoding == "gzip"
     assert response.content_length is None
-    assert response.body == compressed
-    assert response.etag == 'rfbezwKUdGjz6VPWDLDTvA'
+    assert gzip.decompress(response.body) == body
+    assert response.etag == 'foo-gzip'
 
 
 def test_buffers_small_streaming():
-    body = b'x' * 100
-    compressed = b''.join(list(gzip_app_iter([body])))
+    body = b'x' * 1000
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = _request('gzip')
     response = Response(app_iter=iter([body]),
                         content_length=len(body))
 
-    compressor(request, response)
+    ResponseFinaliser()(request, response)
 
     assert response.content_encoding == 'gzip'
-    assert response.content_length == len(compressed)
-    assert response.body == compressed
+    assert response.content_length == len(response.body)
+    assert gzip.decompress(response.body) == body
+
+
+def test_compressed_etag_derived_from_identity():
+    request = _request('gzip')
+    response = Response(body=b'x' * 1000)
+    response.headers['ETag'] = 'W/"version"'
+
+    ResponseFinaliser()(request, response)
+
+    assert response.headers['ETag'] == 'W/"version-gzip"'
+
+
+def test_compressed_etag_from_body():
+    request = _request('gzip')
+    response = Response(body=b'x' * 1000)
+
+    ResponseFinaliser()(request, response)
+
+    assert response.etag == body_etag(b'x' * 1000) + '-gzip'
+
+
+def test_identity_not_compressed():
+    request = _request('identity')
+    response = Response(body=b'x' * 100)
+
+    ResponseFinaliser()(request, response)
+
+    assert response.content_encoding is None
+    assert response.body == b'x' * 100
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_compressed_app_iter(encoding):
+    chunks = [bytes([i % 256]) * 1024 for i in range(64)] + [b'']
+    app_iter = compression.CompressedAppIter(iter(chunks), encoding, flush_size=8 * 1024)
+
+    compressed = list(app_iter)
+
+    # The first chunk is flushed right away and after that output
+    # is produced about every `flush_size` bytes of input.
+    assert _decompress(compressed[0], encoding).startswith(b'\x00' * 1024)
+    assert 8 <= len(compressed) <= 10
+    assert _decompress(b''.join(compressed), encoding) == b''.join(chunks)
+
+
+def test_compressed_app_iter_closes_app_iter():
+    app_iter = pretend.stub(close=pretend.call_recorder(lambda: None))
+
+    compression.CompressedAppIter(app_iter, 'gzip').close()
+
+    assert app_iter.close.calls == [pretend.call()]
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_compress(encoding):
+    assert _decompress(compression.compress(b'foo' * 10, encoding), encoding) == b'foo' * 10
 
 
 def test_does_not_compress_small_bodies():
     body = b'foo'
 
-    request = pretend.stub(accept_encoding=Accept('gzip'))
+    request = _request('gzip')
     response = Response(body=body)
 
-    compressor(request, response)
+    ResponseFinaliser()(request, response)
 
     assert response.content_encoding is None
     assert response.content_length == len(body)
     assert response.body == body
 
 
-def test_compression_tween_factory():
-    registry = pretend.stub()
-    request = pretend.stub(add_response_callback=pretend.call_recorder(lambda *args, **kwargs: None))
-    response = pretend.stub()
+def test_does_not_keep_larger_bodies():
+    body = b'foo'
+
+    request = _request('gzip', compress=True)
+    response = Response(body=body)
+
+    ResponseFinaliser()(request, response)
+
+    assert response.content_encoding is None
+    assert response.body == body
+
+
+@pytest.mark.parametrize(
+    ['content_type', 'expected'],
+    [
+        ('text/html', True),
+        ('application/json', True),
+        ('application/vnd.api+json', True),
+        ('image/svg+xml', True),
+        ('image/png', False),
+        ('application/zip', False),
+        ('text/event-stream', False)
+    ]
+)
+def test_policy_content_types(content_type, expected):
+    request = _request('gzip')
+    response = Response(body=b'x' * 1000, content_type=content_type, charset=None)
+
+    ResponseFinaliser()(request, response)
+
+    assert (response.content_encoding == 'gzip') is expected
+    assert ('Accept-Encoding' in (response.vary or ())) is expected
+
+
+def test_policy_settings():
+    policy = compression.CompressionPolicy.from_settings({
+        'compression.min_size': 10,
+        'compression.allow': ['image/*'],
+        'compression.deny': ['image/png'],
+        'compression.max_load': 2.0
+    })
+
+    assert policy.should_compress(Response(body=b'x' * 10, content_type='image/bmp'))
+    assert not policy.should_compress(Response(body=b'x' * 9, content_type='image/bmp'))
+    assert not policy.should_compress(Response(body=b'x' * 10, content_type='image/png'))
+    assert not policy.should_compress(Response(body=b'x' * 10, content_type='text/html'))
+    assert policy.max_load == 2.0
+
+
+@pytest.mark.parametrize(
+    ['size', 'load', 'expected'],
+    [
+        (1024, 0.0, 9),
+        (1024, 1.5, 6),
+        (512 * 1024, 0.0, 6),
+        (512 * 1024, 1.5, 1),
+        (None, 0.0, 6),
+        (4 * 1024 * 1024, 0.0, 1),
+        (4 * 1024 * 1024, 1.5, 1)
+    ]
+)
+def test_policy_level(monkeypatch, size, load, expected):
+    policy = compression.CompressionPolicy()
+    monkeypatch.setattr(policy, 'load', lambda: load)
+
+    assert policy.level('gzip', size) == expected
+
+
+def test_policy_load_is_cached(monkeypatch):
+    getloadavg = pretend.call_recorder(lambda: (4.0, 0.0, 0.0))
+    monkeypatch.setattr(compression.os, 'getloadavg', getloadavg)
+    monkeypatch.setattr(compression.os, 'cpu_count', lambda: 2)
+    policy = compression.CompressionPolicy()
+
+    assert policy.load() == 2.0
+    assert policy.load() == 2.0
+    assert len(getloadavg.calls) == 1
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_compress_view_option(compress):
+    request = _request('gzip', compress=compress)
+    response = Response(body=b'x' * 1000, content_type='image/bmp')
+
+    ResponseFinaliser()(request, response)
+
+    assert (response.content_encoding == 'gzip') is compress
+
+
+def test_compression_view():
+    view = pretend.call_recorder(lambda context, request: request.compress)
+    request = pretend.stub()
+
+    wrapped = compression.compression_view(view, pretend.stub(options={'compress': False}))
+
+    assert wrapped(None, request) is False
+    assert compression.compression_view.options == {'compress'}
+
+
+def test_compression_view_without_option():
+    view = pretend.stub()
+
+    assert compression.compression_view(view, pretend.stub(options={})) is view
+
+
+def _cached_compress(cache, body=b'x' * 1000, **headers):
+    request = Request.blank('/badge.svg', headers={'Accept-Encoding': 'gzip'})
+    response = Response(body=body)
+    response.headers.update(headers)
+    ResponseFinaliser(cache=cache)(request, response)
+    return response
+
+
+def test_compression_uses_cache(monkeypatch):
+    cache = CompressedResponseCache()
+    first = _cached_compress(cache)
+
+    compress = pretend.call_recorder(lambda *args: b'')
+    monkeypatch.setattr(compression, 'compress', compress)
+    second = _cached_compress(cache)
+
+    assert compress.calls == []
+    assert second.body == first.body
+    assert second.etag == first.etag
+    assert second.content_encoding == 'gzip'
+    assert second.content_length == len(first.body)
+    assert cache.metrics()['hit_rate'] == 0.5
+
+
+def test_compression_cache_keyed_by_etag():
+    cache = CompressedResponseCache()
+
+    first = _cached_compress(cache, ETag='"v1"')
+    second = _cached_compress(cache, body=b'y' * 1000, ETag='"v1"')
+    third = _cached_compress(cache, body=b'y' * 1000, ETag='"v2"')
+
+    assert second.body == first.body
+    assert gzip.decompress(third.body) == b'y' * 1000
+    assert cache.hits == 1
+
+
+def test_compression_cache_keeps_weak_etag():
+    cache = CompressedResponseCache()
+
+    first = _cached_compress(cache, ETag='W/"abc"')
+    second = _cached_compress(cache, ETag='W/"abc"')
+
+    assert cache.hits == 1
+    assert first.headers['ETag'] == second.headers['ETag'] == 'W/"abc-gzip"'
+
 
-    def handler(inner_request):
-        assert inner_request is request
-        return response
+def test_compression_does_not_cache_private():
+    cache = CompressedResponseCache()
 
-    tween = compression_tween_factory(handler, registry)
+    _cached_compress(cache, **{'Cache-Control': 'private'})
+    _cached_compress(cache, **{'Cache-Control': 'private'})
 
-    assert tween(request) is response
-    assert request.add_response_callback.calls == [pretend.call(compressor)]
+    assert cache.metrics()['entries'] == 0
@@ -0,0 +1,135 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fakeredis
+import pretend
+import pytest
+import redis
+from armonaut.utils import connections
+
+requires_fake_connection = pytest.mark.skipif(
+    not hasattr(fakeredis, 'FakeConnection'),
+    reason='fakeredis is too old to provide FakeConnection'
+)
+
+
+def _pool(**kwargs):
+    return connections.InstrumentedConnectionPool(
+        connection_class=fakeredis.FakeConnection,
+        server=fakeredis.FakeServer(),
+        **kwargs
+    )
+
+
+@requires_fake_connection
+def test_pool_metrics_track_connections():
+    pool = _pool(max_connections=2)
+
+    first = pool.get_connection('GET')
+    second = pool.get_connection('GET')
+    metrics = pool.metrics()
+
+    assert metrics['max_connections'] == 2
+    assert metrics['in_use'] == 2
+    assert metrics['idle'] == 0
+    assert metrics['created'] == 2
+
+    pool.release(first)
+    pool.release(second)
+    assert pool.get_connection('GET') is second
+
+    metrics = pool.metrics()
+    assert metrics['in_use'] == 1
+    assert metrics['idle'] == 1
+    assert metrics['created'] == 2
+    assert metrics['creation_rate'] > 0
+    assert metrics['wait_time'] >= 0
+
+
+@requires_fake_connection
+def test_pool_is_bounded():
+    pool = _pool(max_connections=1, timeout=0.01)
+    pool.get_connection('GET')
+
+    with pytest.raises(redis.ConnectionError):
+        pool.get_connection('GET')
+
+    assert pool.metrics()['created'] == 1
+
+
+@requires_fake_connection
+def test_pool_runs_commands():
+    client = redis.StrictRedis(connection_pool=_pool(max_connections=1))
+
+    client.set('a', 1)
+
+    assert client.get('a') == b'1'
+    assert client.connection_pool.metrics()['in_use'] == 0
+
+
+def test_get_connection_pool_shared_by_url(monkeypatch):
+    monkeypatch.setattr(connections, '_pools', {})
+    monkeypatch.setattr(connections, '_pool_options', {})
+
+    pool = connections.get_connection_pool('redis://localhost:6379/0', max_connections=5)
+
+    assert isinstance(pool, connections.InstrumentedConnectionPool)
+    assert pool.max_connections == 5
+    assert connections.get_connection_pool('redis://localhost:6379/0') is pool
+    assert connections.get_connection_pool('redis://localhost:6379/1') is not pool
+
+
+def test_get_connection_pool_uses_process_options(monkeypatch):
+    monkeypatch.setattr(connections, '_pools', {})
+    monkeypatch.setattr(connections, '_pool_options', {})
+
+    connections.configure(max_connections=7, socket_timeout=2.0)
+    pool = connections.get_connection_pool('redis://localhost:6379/0')
+
+    assert pool.max_connections == 7
+    assert pool.connection_kwargs['socket_timeout'] == 2.0
+
+
+def test_get_connection_pool_warns_of_ignored_options(monkeypatch):
+    monkeypatch.setattr(connections, '_pools', {})
+    monkeypatch.setattr(connections, '_pool_options', {})
+    warning = pretend.call_recorder(lambda *args: None)
+    monkeypatch.setattr(connections.logger, 'warning', warning)
+
+    pool = connections.get_connection_pool('redis://:hunter2@localhost:6379/0', max_connections=5)
+    connections.get_connection_pool('redis://:hunter2@localhost:6379/0', max_connections=5)
+    assert warning.calls == []
+
+    assert connections.get_connection_pool(
+        'redis://:hunter2@localhost:6379/0', max_connections=10, socket_timeout=1.0
+    ) is pool
+    assert pool.max_connections == 5
+    assert warning.calls == [
+        pretend.call(
+            'Connection pool for %s already exists, ignoring options %r',
+            'redis://:***@localhost:6379/0', {'max_connections': 10, 'socket_timeout': 1.0}
+        )
+    ]
+
+
+def test_pool_metrics_redacts_passwords(monkeypatch):
+    monkeypatch.setattr(connections, '_pools', {})
+
+    connections.get_connection_pool('redis://:hunter2@localhost:6379/0')
+    connections.get_connection_pool('redis://localhost:6379/1')
+
+    metrics = connections.pool_metrics()
+
+    assert set(metrics) == {'redis://:***@localhost:6379/0', 'redis://localhost:6379/1'}
+    assert metrics['redis://localhost:6379/1']['in_use'] == 0
@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
 import pretend
+import pytest
+from armonaut.utils import crypto
 from armonaut.utils.crypto import random_token
 
 
@@ -25,3 +28,116 @@ def test_random_token(monkeypatch):
 
     assert token == 'N2bS4sSXOHAl89wtOHJpvAKemq8-S6aHniRDcEWKZr0'
     assert urandom.calls == [pretend.call(32)]
+
+
+@pytest.mark.skipif(crypto.Fernet is None, reason='cryptography is not installed')
+def test_encrypter_round_trip():
+    encrypter = crypto.Encrypter('secret', 'salt')
+    token = encrypter.encrypt(b'value')
+
+    assert b'value' not in token
+    assert encrypter.decrypt(token) == b'value'
+
+
+@pytest.mark.skipif(crypto.Fernet is None, reason='cryptography is not installed')
+@pytest.mark.parametrize(('secret', 'salt'), [('secret', 'other'), ('other', 'salt')])
+def test_encrypter_different_keys(secret, salt):
+    token = crypto.Encrypter('secret', 'salt').encrypt(b'value')
+
+    with pytest.raises(crypto.BadData):
+        crypto.Encrypter(secret, salt).decrypt(token)
+
+
+def test_encrypter_requires_cryptography(monkeypatch):
+    monkeypatch.setattr(crypto, 'Fernet', None)
+
+    with pytest.raises(RuntimeError):
+        crypto.Encrypter('secret', 'salt')
+
+
+def test_signer_derives_key_once(monkeypatch):
+    signer = crypto.TimestampSigner('secret', salt='salt')
+    derive_key = pretend.call_recorder(lambda self, secret_key=None: b'key')
+    monkeypatch.setattr(crypto._TimestampSigner, 'derive_key', derive_key)
+
+    signer.unsign(signer.sign(b'value'))
+    signer.unsign(signer.sign(b'value'))
+
+    assert len(derive_key.calls) == 1
+
+
+def test_signer_compatible_with_itsdangerous():
+    signer = crypto.Signer('secret', salt='salt')
+    other = crypto._Signer('secret', salt='salt', digest_method=hashlib.sha512,
+                           key_derivation='hmac')
+
+    assert signer.sign(b'value') == other.sign(b'value')
+    assert other.unsign(signer.sign(b'value')) == b'value'
+
+
+@pytest.mark.parametrize('cache_size', [0, 16])
+def test_timestamp_signer_unsign(cache_size):
+    signer = crypto.TimestampSigner('secret', salt='salt', cache_size=cache_size)
+    signed = signer.sign(b'value')
+
+    for _ in range(2):
+        assert signer.unsign(signed, max_age=60) == b'value'
+        value, signed_at = signer.unsign(signed.decode('utf-8'), return_timestamp=True)
+        assert value == b'value'
+        assert signed_at == signer.timestamp_to_datetime(signer.get_timestamp())
+
+
+def test_timestamp_signer_cache_skips_hmac(monkeypatch):
+    signer = crypto.TimestampSigner('secret', salt='salt', cache_size=16)
+    signed = signer.sign(b'value')
+    signer.unsign(signed)
+
+    verify_signature = pretend.call_recorder(lambda *args: True)
+    monkeypatch.setattr(signer, 'verify_signature', verify_signature)
+
+    assert signer.unsign(signed, max_age=60) == b'value'
+    assert verify_signature.calls == []
+
+
+def test_timestamp_signer_cache_rejects_tampering():
+    signer = crypto.TimestampSigner('secret', salt='salt', cache_size=16)
+    signed = signer.sign(b'value')
+    signer.unsign(signed)
+
+    with pytest.raises(crypto.BadSignature):
+        signer.unsign(b'other' + signed[len(b'value'):])
+    assert len(signer._verified) == 1
+
+
+@pytest.mark.parametrize('age', [61, -5])
+def test_timestamp_signer_cache_checks_max_age(monkeypatch, age):
+    signer = crypto.TimestampSigner('secret', salt='salt', cache_size=16)
+    signed = signer.sign(b'value')
+    now = signer.get_timestamp()
+    signer.unsign(signed, max_age=60)
+
+    monkeypatch.setattr(signer, 'get_timestamp', lambda: now + age)
+
+    with pytest.raises(crypto.SignatureExpired) as e:
+        signer.unsign(signed, max_age=60)
+    assert e.value.payload == b'value'
+
+
+def test_timestamp_signer_cache_is_bounded():
+    signer = crypto.TimestampSigner('secret', salt='salt', cache_size=2)
+    first, second, third = (signer.sign(str(i).encode('utf-8')) for i in range(3))
+
+    signer.unsign(first)
+    signer.unsign(second)
+    signer.unsign(first)
+    signer.unsign(third)
+
+    assert list(signer._verified) == [first, third]
+
+
+def test_url_safe_serializer_reuses_signer():
+    serializer = crypto.URLSafeSerializer('secret', salt='salt')
+
+    assert serializer.make_signer() is serializer.make_signer()
+    assert serializer.make_signer('other') is not serializer.make_signer()
+    assert serializer.loads(serializer.dumps({'a': 1})) == {'a': 1}
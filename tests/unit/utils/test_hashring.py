@@ -0,0 +1,54 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import pytest
+from armonaut.utils.hashring import HashRing
+
+KEYS = [f'session-{i}' for i in range(10000)]
+
+
+def test_hash_ring_requires_nodes():
+    with pytest.raises(ValueError):
+        HashRing([])
+
+
+def test_hash_ring_single_node():
+    ring = HashRing(['a'])
+
+    assert {ring.get_node(key) for key in KEYS[:100]} == {'a'}
+
+
+def test_hash_ring_is_deterministic():
+    assert ([HashRing(['a', 'b', 'c']).get_node(key) for key in KEYS[:100]] ==
+            [HashRing(['c', 'b', 'a']).get_node(key) for key in KEYS[:100]])
+
+
+def test_hash_ring_spreads_keys():
+    ring = HashRing(['a', 'b', 'c', 'd'])
+    counts = collections.Counter(ring.get_node(key) for key in KEYS)
+
+    assert set(counts) == {'a', 'b', 'c', 'd'}
+    assert all(count > len(KEYS) / 4 * 0.75 for count in counts.values())
+
+
+def test_hash_ring_adding_node_moves_few_keys():
+    before = HashRing(['a', 'b', 'c', 'd'])
+    after = HashRing(['a', 'b', 'c', 'd', 'e'])
+
+    moved = [key for key in KEYS if before.get_node(key) != after.get_node(key)]
+
+    # Only keys that now belong to the new node move.
+    assert {after.get_node(key) for key in moved} == {'e'}
+    assert len(moved) < len(KEYS) / 5 * 1.25
@@ -0,0 +1,123 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zlib
+import msgpack
+import pytest
+from armonaut.utils import serialization
+from armonaut.utils.serialization import (
+    CompactSerializer, MsgpackSerializer, SerializationError
+)
+
+SESSION = {
+    '_csrf_token': 'N2bS4sSXOHAl89wtOHJpvAKemq8-S6aHniRDcEWKZr0',
+    '_flash_messages': ['Saved!'],
+    '_flash_messages.error': [],
+    'user_id': 1
+}
+
+SERIALIZERS = [
+    MsgpackSerializer(),
+    MsgpackSerializer(compression='zlib', threshold=0),
+    MsgpackSerializer(intern_keys=True),
+    CompactSerializer(),
+    CompactSerializer(threshold=0)
+]
+
+
+@pytest.mark.parametrize('serializer', SERIALIZERS)
+@pytest.mark.parametrize('value', [SESSION, {}, {'big': 'x' * 4096}, 'foo', [1, 2], 1])
+def test_round_trip(serializer, value):
+    assert serializer.loads(serializer.dumps(value)) == value
+
+
+@pytest.mark.parametrize('serializer', SERIALIZERS)
+def test_loads_any_payload(serializer):
+    for other in SERIALIZERS:
+        assert serializer.loads(other.dumps(SESSION)) == SESSION
+
+
+@pytest.mark.parametrize('serializer', SERIALIZERS)
+def test_loads_payloads_without_header(serializer):
+    data = msgpack.packb(SESSION, encoding='utf-8', use_bin_type=True)
+
+    assert serializer.loads(data) == SESSION
+
+
+def test_msgpack_serializer_is_plain_msgpack():
+    assert MsgpackSerializer().dumps(SESSION) == msgpack.packb(
+        SESSION, encoding='utf-8', use_bin_type=True
+    )
+
+
+def test_interned_keys():
+    data = MsgpackSerializer(intern_keys=True).dumps({'_csrf_token': 'a', 'foo': 'b'})
+
+    assert data[:2] == b'\xc1\x10'
+    assert msgpack.unpackb(data[2:], encoding='utf-8') == {0: 'a', 'foo': 'b'}
+
+
+@pytest.mark.parametrize(
+    'value',
+    [
+        {'_csrf_token': 't', 0: 'zero'},
+        {'_csrf_token': 't', 5: 'five'},
+        {0: 'zero', 1: 'one'}
+    ]
+)
+def test_integer_keys_not_interned(value):
+    serializer = CompactSerializer()
+    data = serializer.dumps(value)
+
+    assert data[:1] != b'\xc1'
+    assert serializer.loads(data) == value
+
+
+@pytest.mark.parametrize(('size', 'compressed'), [(10, False), (2000, True)])
+def test_compression_threshold(size, compressed):
+    serializer = MsgpackSerializer(compression='zlib', threshold=1024)
+    value = {'foo': 'x' * size}
+    data = serializer.dumps(value)
+
+    assert (data[:2] == b'\xc1\x01') is compressed
+    if compressed:
+        assert len(data) < size
+        assert msgpack.unpackb(zlib.decompress(data[2:]), encoding='utf-8') == value
+
+
+@pytest.mark.skipif('lz4' not in serialization.COMPRESSIONS, reason='lz4 is not installed')
+def test_lz4_compression():
+    serializer = MsgpackSerializer(compression='lz4', threshold=0)
+    data = serializer.dumps(SESSION)
+
+    assert data[:2] == b'\xc1\x02'
+    assert MsgpackSerializer().loads(data) == SESSION
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        MsgpackSerializer(compression='unknown')
+
+
+@pytest.mark.parametrize(
+    'data',
+    [b'\xc1\x01notzlib',
+     b'\xc1\x0f\x80',
+     b'\xc1\x10\x81\x09\xa0',
+     b'\x81\xa3foo',
+     b'\x80\x80']
+)
+def test_invalid_data(data):
+    with pytest.raises(SerializationError):
+        MsgpackSerializer().loads(data)